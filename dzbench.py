@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Download throughput benchmark of dzdl.py on bootloader simulator dzsim.py"""
+
+# Import statements
+import os, sys, getopt, time, subprocess, collections
+import dzimage
+import dzplan
+import dzsession
+import dztransport
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+simulator = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dzsim.py")
+files = ["app.s19", "prg.s19"]
+
+# Phases of download by log tag of requests
+phases = [("Con","connect"), ("Prb","probe"), ("Wfp","fingerprint"), ("Ers","erase"), ("Dat","write"),
+  ("Rd ","read"), ("Syn","resync"), ("Rst","reset"), ("Run","run")]
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class PhaseLog:
+  # Log writer of session which measures phases instead of writing a file.
+  # A phase lasts from a request till the next request of other phase.
+
+  def __init__(self):
+    self.time = collections.Counter() # s
+    self.frames = collections.Counter()
+    self.tx = 0 # Bytes sent
+    self.rx = 0 # Bytes received
+    self.tag = None
+    self.start = 0
+
+  def Switch(self, tag):
+    now = time.perf_counter()
+    if self.tag is not None:
+      self.time[self.tag] += now - self.start
+    self.tag = tag
+    self.start = now
+
+  def Text(self, s):
+    pass
+
+  def Tx(self, tag, data):
+    if tag != self.tag:
+      self.Switch(tag)
+    self.frames[tag] += 1
+    self.tx += len(data)
+
+  def Rx(self, tag, data):
+    self.rx += len(data)
+
+  def Raw(self, data):
+    pass
+
+  def Close(self):
+    self.Switch(None)
+
+def Downloadable(mem, usage):
+  # Bootloader image (prg.s19) cannot be downloaded by bootloader itself: its code range is
+  # prohibited and its EEPROM sectors are the configuration of simulated ECU. Code is moved
+  # into application Flash instead, so size of download is the same.
+  for a in range(0x1780, 0x1800):
+    usage[a] = 0
+  code = bytes(usage[0xEB00:0xFD00])
+  if 0 < code.count(1):
+    mem[0x1900:0x1900+len(code)] = mem[0xEB00:0xFD00]
+    usage[0x1900:0x1900+len(code)] = code
+    usage[0xEB00:0xFD00] = bytes(len(code))
+  return mem, usage
+
+def StartSimulator(simargs):
+  sim = subprocess.Popen([sys.executable, simulator] + simargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  port = sim.stdout.readline().strip()
+  if 0 == len(port):
+    raise dzsession.SessionError("Simulator did not start: "+sim.stderr.read().strip())
+  return sim, port
+
+def Bench(path, baud, turbo, window, simargs):
+  mem, usage = Downloadable(*dzimage.ReadImage(path))
+  sectors = dzplan.Plan(dzplan.Sectors(), mem, usage, dzplan.assumed_frame)
+  dzplan.Compile(sectors, dzplan.assumed_frame, dztransport.WRITE_BODY)
+  sim, port = StartSimulator(simargs)
+  log = PhaseLog()
+  s = dzsession.Session(port, baud, 14, 222, log, None)
+  s.window = window
+  s.turbo = turbo
+  try:
+    s.Open()
+    start = time.perf_counter()
+    s.Download(mem, usage, sectors, dzplan.assumed_frame)
+    total = time.perf_counter() - start
+  finally:
+    log.Close()
+    time.sleep(0.1) # Simulator processes last request (run application)
+    s.Close()
+    sim.terminate()
+    stats = sim.communicate()[1].strip()
+  return {"file":os.path.basename(path), "bytes":usage.count(1), "time":total, "log":log, "stats":stats}
+
+def Report(result, verbose):
+  log = result["log"]
+  p = sys.stdout.write
+  p(format(result["file"],"<12")+format(result["bytes"],">7")+" B "+format(result["time"],">7.2f")+" s "
+    +format(result["bytes"]/result["time"],">8.0f")+" B/s "+format(sum(log.frames.values()),">5")+" frames "
+    +format(log.tx,">7")+" B Tx "+format(log.rx,">6")+" B Rx\n")
+  for tag, name in phases:
+    if 0 < log.frames[tag]:
+      p("  "+format(name,"<12")+format(log.time[tag],">7.3f")+" s "+format(log.frames[tag],">5")+" frames\n")
+  if verbose:
+    p("  simulator "+result["stats"]+"\n")
+
+def PrintHelp():
+  p = sys.stdout.write
+  p("dzbench.py - Download throughput benchmark of dzdl.py on simulator\n")
+  p("Usage: dzbench.py [options] [file.s19 ...]   (default app.s19 prg.s19)\n")
+  p("  -b baud      Baud rate of download (default 57600)\n")
+  p("  --turbo=baud Download on higher baud rate like dzdl.py --turbo\n")
+  p("  -w window    Number of write frames in flight (default 1)\n")
+  p("  --sim=\"args\" Options of dzsim.py (default \"-l auto\": bytes at ECU baud rate)\n")
+  p("  -v           Print statistics of simulator\n")
+  p("Bootloader code of prg.s19 is downloaded into application Flash, bootloader cannot overwrite itself.\n")
+
+def Main(argv):
+  try:
+    opts, args = getopt.getopt(argv, "b:w:vh", ["baud=", "turbo=", "window=", "sim=", "help"])
+  except getopt.GetoptError as e:
+    sys.stderr.write("ERROR! "+str(e)+"\n")
+    return 1
+  baud = 57600
+  turbo = 0
+  window = 1
+  simargs = ["-l", "auto"]
+  verbose = False
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      PrintHelp()
+      return 0
+    elif opt in ("-b", "--baud"): baud = int(arg)
+    elif opt == "--turbo": turbo = int(arg)
+    elif opt in ("-w", "--window"): window = int(arg)
+    elif opt == "--sim": simargs = arg.split()
+    elif opt == "-v": verbose = True
+  here = os.path.dirname(os.path.abspath(__file__))
+  paths = args if 0 < len(args) else [os.path.join(here, f) for f in files]
+
+  sys.stdout.write("Baud "+str(baud)+(", turbo "+str(turbo) if turbo else "")+", window "+str(window)+", simulator "+" ".join(simargs)+"\n")
+  for path in paths:
+    try:
+      Report(Bench(path, baud, turbo, window, simargs), verbose)
+    except (OSError, dzimage.ImageError, dzsession.SessionError) as e:
+      sys.stderr.write("ERROR! "+path+": "+str(e)+"\n")
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
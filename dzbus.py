@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Shared CAN bus of more ECUs: one link, answers are split by source ID for session of each ECU"""
+
+# Import statements
+import time, threading, collections
+import dzsession
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class Inbox:
+  # Received answers of one source ID. They are parsed by methods of transport class on
+  # this buffer, the same way as on receive buffer of transport itself.
+
+  def __init__(self, link):
+    self.parser = type(link)
+    self.rx = collections.deque()
+    self.rx_bytes = 0
+
+  def Match(self, target, source):
+    return self.parser.Match(self, target, source)
+
+class Bus:
+  # One CAN link shared by sessions of more ECUs, each in own thread. A request is sent
+  # whole under lock, so sessions send to their ECUs while other ECUs are busy with erase
+  # or write. Received answers are split by source ID of CAN ID into inboxes, the first
+  # waiting session polls the link for all of them. SCI is not supported: other ECUs see
+  # the bytes of requests, and 't' enters their terminal (term.asm).
+
+  def __init__(self, link, toolid):
+    self.link = link
+    self.toolid = toolid
+    self.txlock = threading.Lock()
+    self.cv = threading.Condition()
+    self.inboxes = {} # Source ID: Inbox
+    self.polling = False
+
+  def Port(self, ecuid):
+    return Port(self, ecuid)
+
+  def Inbox(self, source):
+    if source not in self.inboxes:
+      self.inboxes[source] = Inbox(self.link)
+    return self.inboxes[source]
+
+  def Send(self, port, send, tag, target, *args):
+    with self.txlock:
+      tx = self.link.tx_bytes
+      ok = send(tag, target, *args)
+      port.tx_bytes += self.link.tx_bytes - tx
+      return ok
+
+  def Poll(self, timeout):
+    # Only one session reads the link, others wait till it returns with split answers
+    with self.cv:
+      if self.polling:
+        self.cv.wait(timeout)
+        return
+      self.polling = True
+    try:
+      self.link.Poll(timeout)
+    finally:
+      with self.cv:
+        self.SplitFrames()
+        self.polling = False
+        self.cv.notify_all()
+
+  def SplitFrames(self):
+    # CAN frames carry source ID, frames of other tools are dropped
+    while 0 < len(self.link.rx):
+      ident, data = self.link.rx.popleft()
+      if ((ident >> 8) & 0xFF) == self.toolid:
+        inbox = self.Inbox(ident & 0xFF)
+        inbox.rx.append((ident, data))
+        inbox.rx_bytes += 5 + len(data)
+
+# ---------------------------------------------------------------------------------------
+class Port:
+  # Transport of one ECU on bus for its session, it has the methods of transports (see
+  # dztransport.py). Answers are taken only from inbox of source.
+  changeable_baud = False # Bit rate would change for every ECU on bus
+
+  def __init__(self, bus, ecuid):
+    self.bus = bus
+    self.ecuid = ecuid
+    link = bus.link
+    self.kind = link.kind
+    self.proto = link.proto
+    self.Body = link.Body
+    self.max_frame = link.max_frame
+    self.max_read = link.max_read
+    self.log = link.log
+    self.tx_bytes = 0
+
+  @property
+  def rx_bytes(self):
+    with self.bus.cv:
+      return self.bus.Inbox(self.ecuid).rx_bytes
+
+  def Open(self):
+    pass # Link is opened and closed by owner of bus
+
+  def Close(self):
+    pass
+
+  def Speed(self):
+    return self.bus.link.Speed()
+
+  def SetBaud(self, baud):
+    pass
+
+  def WireTime(self, length):
+    return self.bus.link.WireTime(length)
+
+  def Send(self, tag, target, source, data):
+    return self.bus.Send(self, self.bus.link.Send, tag, target, source, data)
+
+  def SendWrite(self, tag, target, source, address, data, valid=True):
+    return self.bus.Send(self, self.bus.link.SendWrite, tag, target, source, address, data, valid)
+
+  def SendBody(self, tag, target, source, body):
+    return self.bus.Send(self, self.bus.link.SendBody, tag, target, source, body)
+
+  def Poll(self, timeout):
+    self.bus.Poll(timeout)
+
+  def Take(self, target, source):
+    # Answer of any source means answer of ECU of port here
+    if source is None:
+      source = self.ecuid
+    with self.bus.cv:
+      inbox = self.bus.Inbox(source)
+      return inbox.parser.Take(inbox, target, source)
+
+  def TakeRead(self, target, source, address, length, final):
+    with self.bus.cv:
+      inbox = self.bus.Inbox(source)
+      return inbox.parser.TakeRead(inbox, target, source, address, length, final)
+
+  def Break(self):
+    self.bus.link.Break()
+
+  def Flush(self):
+    with self.bus.cv:
+      self.bus.Inbox(self.ecuid).rx.clear()
+
+  def Drain(self):
+    self.bus.link.Drain()
+
+# ---------------------------------------------------------------------------------------
+class Lines:
+  # Progress text of session of one ECU. Finished lines are written with prefix into common
+  # log and console, so lines of ECUs on bus are not mixed. It is the log of session.
+
+  def __init__(self, prefix, log, out=None, lock=None):
+    self.prefix = prefix
+    self.log = log # dzlog.LogWriter
+    self.out = out
+    self.lock = lock or threading.Lock()
+    self.text = ""
+    self.flush_time = 0
+
+  def Text(self, s):
+    self.text += s
+    i = self.text.rfind("\n") + 1
+    if 0 == i:
+      return
+    lines = "".join(self.prefix+line+"\n" for line in self.text[:i].splitlines() if 0 < len(line))
+    self.text = self.text[i:]
+    self.Write(lines)
+
+  def Write(self, lines):
+    if 0 == len(lines):
+      return
+    self.log.Text(lines)
+    if self.out is None:
+      return
+    with self.lock:
+      self.out.write(lines)
+      if self.flush_time < time.perf_counter():
+        self.out.flush()
+        self.flush_time = time.perf_counter() + dzsession.flush_period
+
+  def Close(self):
+    if 0 < len(self.text):
+      self.Write(self.prefix+self.text+"\n")
+      self.text = ""
+    if self.out is not None:
+      with self.lock:
+        self.out.flush()
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Flashing daemon of dzdl.py: flash, read and scan jobs over a Unix socket, ports and images are kept open"""
+
+# Import statements
+import os, sys, getopt, time, json, socket, socketserver, threading, queue
+import dzimage
+import dzplan
+import dzlog
+import dzmetrics
+import dzsession
+import dztransport
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+socket_path = "/tmp/dzdl.sock"
+baud = 57600 # Default baud rate of jobs
+toolid = 222 # = 0xDE -> Diag Equipment
+ecuid = 14 # Default target of jobs, 256 means all ECUs found by scan of network
+log_level = dzlog.FRAMES
+
+# Default deadline of connection of a job (s). Job shall not block its port forever.
+connect_timeout = 10.0
+
+# Jobs run on a port, other requests are answered immediately
+port_jobs = ("flash", "read", "scan")
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class JobError(Exception):
+  pass
+
+# ---------------------------------------------------------------------------------------
+def LoadImage(path, frame):
+  # Compiled plan file is loaded, S19 or HEX file is read, planned and compiled for all protocols
+  if path.lower().endswith(".plan"):
+    digest, frame, sectors, mem, usage = dzplan.LoadPlan(path)
+    return mem, usage, sectors, frame
+  mem, usage = dzimage.ReadImage(path)
+  sectors = dzplan.Plan(dzplan.Sectors(), mem, usage, frame)
+  dzplan.Compile(sectors, frame, dztransport.WRITE_BODY)
+  return mem, usage, sectors, frame
+
+class Images:
+  # Images of files by path and frame length, read again only if file is changed.
+  # Planned sectors are not changed by sessions, so they are shared by ports.
+
+  def __init__(self):
+    self.cache = {} # (path, frame): (modification time and size, image)
+    self.lock = threading.Lock()
+
+  def Get(self, path, frame):
+    try:
+      st = os.stat(path)
+    except OSError as e:
+      raise JobError("Cannot open "+path+": "+e.strerror)
+    key = (os.path.abspath(path), frame)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with self.lock:
+      entry = self.cache.get(key)
+      if entry is None or entry[0] != stamp:
+        entry = (stamp, LoadImage(path, frame))
+        self.cache[key] = entry
+      return entry[1]
+
+# ---------------------------------------------------------------------------------------
+class Progress:
+  # Console of session: progress text is sent to client of job line by line
+
+  def __init__(self, job):
+    self.job = job
+    self.line = ""
+
+  def write(self, s):
+    self.line += s
+    while "\n" in self.line:
+      text, self.line = self.line.split("\n", 1)
+      self.job.Event("progress", text=text)
+
+  def flush(self):
+    pass
+
+class Job:
+  # Request of a client, events are sent back to the client with job number
+
+  def __init__(self, number, request, client):
+    self.number = number
+    self.request = request
+    self.client = client
+
+  def Event(self, event, **values):
+    values["job"] = self.number
+    values["event"] = event
+    self.client.Send(values)
+
+# ---------------------------------------------------------------------------------------
+class PortWorker(threading.Thread):
+  # Jobs of one port run one after the other in own thread, jobs of different ports parallel.
+  # Session (open port) and log of port are kept for next jobs.
+
+  def __init__(self, port, images):
+    threading.Thread.__init__(self, daemon=True)
+    self.port = port
+    self.images = images
+    self.jobs = queue.Queue()
+    self.session = None
+    self.log = None
+    self.current = None # Running job
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        break
+      self.current = job
+      try:
+        self.Run(job)
+      except Exception as e:
+        # Unexpected error fails only the job, worker stays to run the queued jobs of port.
+        # Port is opened again by next job.
+        job.Event("done", result="FAIL", message="Internal error: "+repr(e))
+        try:
+          self.CloseSession()
+        except Exception:
+          self.session = None
+      finally:
+        self.current = None
+        job.client.Finished()
+    self.CloseSession()
+    if self.log is not None:
+      self.log.Close()
+
+  def CloseSession(self):
+    if self.session is not None:
+      self.session.Close()
+      self.session = None
+
+  def Session(self, job):
+    # Session of port with parameters of job, port is opened only at first job
+    if self.log is None:
+      self.log = dzlog.LogWriter(dzlog.LogName(self.port), log_level)
+    if self.session is None:
+      s = dzsession.Session(self.port, baud, ecuid, toolid, self.log, None)
+      s.checkpoint = "./dzdl-"+dzlog.PortSuffix(self.port)+".ckpt"
+      s.timeouts = dzmetrics.Timeouts(dzsession.answer_timeout, "./dzdl-"+dzlog.PortSuffix(self.port)+".rtt", self.port)
+      s.Open()
+      self.session = s
+    s = self.session
+    r = job.request
+    s.out = Progress(job)
+    s.baud = int(r.get("baud", baud))
+    s.link.SetBaud(s.baud)
+    s.ecuid = int(r.get("ecuid", ecuid))
+    s.turbo = int(r.get("turbo", 0))
+    s.window = int(r.get("window", dzsession.Session.window))
+    s.max_frame = int(r.get("max_frame", dzsession.Session.max_frame))
+    s.conn_period, s.conn_backoff, s.conn_timeout = [float(v) for v in
+      r.get("connect", [dzsession.Session.conn_period, dzsession.Session.conn_backoff, connect_timeout])]
+    s.manifest = bool(r.get("manifest", False))
+    s.check = bool(r.get("check", False))
+    s.erase_free = bool(r.get("erase_free", False))
+    s.units = None
+    if "patch" in r:
+      s.units = dzimage.Units(*dzimage.ReadUnits(str(r["patch"])))
+      if "unit" in r and not s.units.Select(str(r["unit"])):
+        raise JobError("Unit "+str(r["unit"])+" is not found in "+str(r["patch"]))
+    s.abort.clear()
+    return s
+
+  def Run(self, job):
+    r = job.request
+    op = r["op"]
+    start = time.perf_counter()
+    values = {}
+    job.Event("start", port=self.port)
+    try:
+      s = self.Session(job)
+      s.p("Job "+str(job.number)+" "+op+"\n")
+      if op == "flash":
+        if "file" not in r:
+          raise JobError("File to be downloaded is needed")
+        mem, usage, sectors, frame = self.images.Get(r["file"], s.max_frame if s.max_frame else dzplan.assumed_frame)
+        s.p(dzsession.PlanInfo(sectors, frame))
+        s.DownloadTargets(mem, usage, sectors, frame, bool(r.get("diff", False)), bool(r.get("assign", False)))
+      elif op == "read":
+        if "file" not in r:
+          raise JobError("File of read out is needed")
+        ranges = dzsession.ParseRanges(r["range"]) if "range" in r else dzsession.read_ranges
+        if ranges is None:
+          raise JobError("Wrong address range "+r["range"])
+        mem, usage = s.ReadOut(ranges, r["file"]+".part", bool(r.get("run", True)))
+        dzimage.WriteImage(r["file"], mem, usage)
+        os.remove(r["file"]+".part")
+      elif op == "scan":
+        values["ids"] = s.FindEcus(bool(r.get("assign", False)), False)
+      values["result"] = "PASS"
+    except (dzsession.SessionError, dzimage.ImageError, dzplan.PlanError, JobError, ValueError, TypeError) as e:
+      values["result"] = "FAIL"
+      values["message"] = str(e)
+    except OSError as e:
+      # Link is lost (e.g. USB adapter is unplugged), port is opened again by next job
+      self.CloseSession()
+      values["result"] = "FAIL"
+      values["message"] = str(e)
+    if self.session is not None:
+      self.session.timeouts.Save() # Port is kept open, estimates are saved after every job
+      if 0 < len(self.session.out.line):
+        self.session.p("\n") # Unfinished line of error
+      self.session.p(values["result"]+(" "+values["message"] if "message" in values else "")+"\n")
+      self.session.out = None
+    values["time"] = round(time.perf_counter() - start, 3)
+    job.Event("done", **values)
+
+# ---------------------------------------------------------------------------------------
+class Daemon:
+  # Jobs are queued per port. Ports are started at their first job.
+
+  def __init__(self):
+    self.images = Images()
+    self.workers = {}
+    self.lock = threading.Lock()
+    self.number = 0
+    self.server = None
+
+  def Submit(self, request, client):
+    op = request.get("op") if isinstance(request, dict) else None
+    if op == "status":
+      with self.lock:
+        ports = dict((port, {"open":w.session is not None, "queued":w.jobs.qsize(),
+          "running":None if w.current is None else w.current.number}) for port, w in self.workers.items())
+      client.Send({"event":"status", "ports":ports})
+    elif op == "cancel":
+      # Running job of port stops waiting for connection or scan answers
+      w = self.workers.get(request.get("port"))
+      if w is not None and w.current is not None and w.session is not None:
+        w.session.abort.set()
+      client.Send({"event":"cancel", "port":request.get("port")})
+    elif op == "shutdown":
+      client.Send({"event":"shutdown"})
+      threading.Thread(target=self.server.shutdown).start()
+    elif op in port_jobs and isinstance(request.get("port"), str):
+      port = request["port"]
+      with self.lock:
+        self.number += 1
+        if port not in self.workers:
+          self.workers[port] = PortWorker(port, self.images)
+          self.workers[port].start()
+        w = self.workers[port]
+        job = Job(self.number, request, client)
+      client.Started()
+      job.Event("queued", port=port, position=w.jobs.qsize() + (0 if w.current is None else 1))
+      w.jobs.put(job)
+    else:
+      client.Send({"event":"error", "message":"Unknown request (op is flash, read, scan, status, cancel or shutdown, port is needed for jobs)"})
+
+  def Stop(self):
+    for w in self.workers.values():
+      w.jobs.put(None)
+    for w in self.workers.values():
+      w.join()
+
+class Handler(socketserver.StreamRequestHandler):
+  # One client connection: every line is a JSON request, events are sent back as JSON lines.
+  # Connection is closed when client stopped sending and all its jobs are done.
+
+  def setup(self):
+    socketserver.StreamRequestHandler.setup(self)
+    self.send_lock = threading.Lock()
+    self.pending = 0
+    self.idle = threading.Condition()
+
+  def Send(self, event):
+    with self.send_lock:
+      try:
+        self.wfile.write((json.dumps(event)+"\n").encode())
+        self.wfile.flush()
+      except OSError:
+        pass # Client is gone, job is continued
+
+  def Started(self):
+    with self.idle:
+      self.pending += 1
+
+  def Finished(self):
+    with self.idle:
+      self.pending -= 1
+      self.idle.notify_all()
+
+  def handle(self):
+    for line in self.rfile:
+      if 0 == len(line.strip()):
+        continue
+      try:
+        request = json.loads(line.decode())
+      except ValueError:
+        self.Send({"event":"error", "message":"Request is not JSON"})
+        continue
+      self.server.daemon.Submit(request, self)
+    with self.idle:
+      while 0 < self.pending:
+        self.idle.wait()
+
+def Serve(path):
+  if os.path.exists(path):
+    os.remove(path) # Socket of previous run
+  daemon = Daemon()
+  server = socketserver.ThreadingUnixStreamServer(path, Handler)
+  server.daemon_threads = True
+  server.daemon = daemon
+  daemon.server = server
+  sys.stdout.write("dzdaemon listens on "+path+"\n")
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  daemon.Stop()
+  os.remove(path)
+
+# ---------------------------------------------------------------------------------------
+def Submit(request, path=socket_path):
+  # Client: generator of events of request (dict). Events of a job are queued, start,
+  # progress (text) and done (result PASS or FAIL, message, time).
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(path)
+  with sock:
+    sock.sendall((json.dumps(request)+"\n").encode())
+    sock.shutdown(socket.SHUT_WR)
+    with sock.makefile("rb") as f:
+      for line in f:
+        yield json.loads(line.decode())
+
+def ParseRequest(args):
+  # Request from op and key=value arguments, e.g. flash port=/dev/ttyUSB0 file=app.s19
+  request = {"op":args[0]}
+  for arg in args[1:]:
+    key, sep, value = arg.partition("=")
+    if key == "connect":
+      request[key] = [float(v) for v in value.split(",")]
+      continue
+    if key in ("patch", "unit"):
+      request[key] = value # Unit name may look like a number
+      continue
+    try:
+      request[key] = int(value, 0)
+    except ValueError:
+      request[key] = value
+  return request
+
+def Client(path, args):
+  p = sys.stdout.write
+  passed = True
+  for event in Submit(ParseRequest(args), path):
+    if event["event"] == "progress":
+      p(event["text"]+"\n")
+    elif event["event"] == "queued":
+      p("Job "+str(event["job"])+" queued on port "+event["port"]+", "+str(event["position"])+" jobs before\n")
+    elif event["event"] == "done":
+      passed = passed and event["result"] == "PASS"
+      if "ids" in event:
+        p("ECU IDs "+" ".join(dzsession.h(i) for i in event["ids"])+"\n")
+      p("Job "+str(event["job"])+" "+event["result"]+(" "+event["message"] if "message" in event else "")+" in "+str(event["time"])+" s\n")
+    elif event["event"] == "error":
+      passed = False
+      p("ERROR! "+event["message"]+"\n")
+    elif event["event"] != "start":
+      p(json.dumps(event)+"\n")
+    sys.stdout.flush()
+  return 0 if passed else 1
+
+def PrintHelp():
+  p = sys.stdout.write
+  p("dzdaemon.py - Flashing daemon of dzdl.py, jobs over Unix socket\n")
+  p("Usage: dzdaemon.py [options]                 Run daemon\n")
+  p("       dzdaemon.py [-s socket] -c op [key=value ...]  Send a request and print its events\n")
+  p("  -s socket    Path of Unix socket (default "+socket_path+")\n")
+  p("  -b baud      Default baud rate of jobs (default 57600)\n")
+  p("  -d toolID    Downloader tool ID (default 0xDE)\n")
+  p("  --log-level=level  Log of each port into dzdl-<port>.log: off, text or frames (default)\n")
+  p("  -c           Client: op is flash, read, scan, status, cancel or shutdown\n")
+  p("Keys of jobs: port, file (.s19, .hex or .plan of flash, .bin or .s19 of read), ecuid, baud, turbo,\n")
+  p("  window, max_frame, diff, assign, range, run, connect=period,backoff,timeout, patch, unit,\n")
+  p("  manifest, check, erase_free\n")
+  p("Example: dzdaemon.py -c flash port=/dev/ttyUSB0 file=app.s19\n")
+  p("Requests are JSON lines on the socket, e.g. {\"op\":\"flash\",\"port\":\"/dev/ttyUSB0\",\"file\":\"app.s19\"}.\n")
+  p("Events are JSON lines: queued, start, progress (text) and done (result, message, time).\n")
+
+def Main(argv):
+  global baud, toolid, log_level
+  try:
+    opts, args = getopt.getopt(argv, "s:b:d:ch", ["socket=", "baud=", "toolid=", "log-level=", "client", "help"])
+  except getopt.GetoptError as e:
+    sys.stderr.write("ERROR! "+str(e)+"\n")
+    return 1
+  path = socket_path
+  client = False
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      PrintHelp()
+      return 0
+    elif opt in ("-s", "--socket"): path = arg
+    elif opt in ("-b", "--baud"): baud = int(arg)
+    elif opt in ("-d", "--toolid"): toolid = int(arg, 0)
+    elif opt == "--log-level":
+      if arg not in dzlog.levels:
+        sys.stderr.write("ERROR! Log level is off, text or frames\n")
+        return 1
+      log_level = dzlog.levels[arg]
+    elif opt in ("-c", "--client"): client = True
+  if client:
+    if 0 == len(args):
+      PrintHelp()
+      return 1
+    try:
+      return Client(path, args)
+    except OSError as e:
+      sys.stderr.write("ERROR! Cannot connect to daemon at "+path+": "+str(e)+"\n")
+      return 1
+  Serve(path)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
@@ -9,17 +9,23 @@
 #   Add my user to dialout group by 'sudo gpasswd --add ${USER} dialout'
 
 # Import statements
-import os, sys, getopt, struct
-import array
-import serial # I use Python 2.7.17. For this I needed 'sudo apt install python-pip' and 'sudo python -m pip install pyserial'
-import re
+import os, sys, getopt
 import time
 import ntpath
-from datetime import datetime
+import concurrent.futures
+import select, atexit, threading
+import dzimage
+import dzplan
+import dzlog
+import dzsession
+import dzbus
+import dztransport
+import dzterm
+import dzmetrics
 if sys.platform.startswith("win"): # Windows
   import msvcrt
 else:
-  import curses # https://docs.python.org/3/library/curses.html#module-curses
+  import termios, tty
 
 # Authorship information
 __author__ = "Janos BENCSIK"
@@ -38,23 +44,42 @@ __date__ = ""
 # ---------------------------------------------------------------------------------------
 
 inputfile = ""
+readfile = "" # Read out memory of ECU into this .bin or .s19 file
+read_ranges = dzsession.read_ranges
 if sys.platform.startswith("linux") or sys.platform.startswith("cygwin") or sys.platform.startswith("darwin"): # linux or OS X
   port = "/dev/ttyUSB0"
 elif sys.platform.startswith("win"): # Windows
   port = "COM1"
+ports = [] # More ports to be downloaded parallel with the same image
+ecuids = [] # More ECUs on bus of port downloaded interleaved, [256] means all found by scan of network
 baud = 57600
+turbo = 0 # Baud rate of download after connection, 0 means no switch
+connect = None # Period, backoff and deadline of connection, None means defaults of dzsession.py
 mem_dump = False
+diff = False
 mem = bytearray(65536)
 connected = False
 terminal = False
 see_val = False
 toolid = 222 # = 0xDE -> Diag Equipment
-ecuid = 14 # =0x0E -> ECU
-
-# One SCI frame has 6 bytes without data. (CAN needs similar amout of bytes) 
-# This means, 7 or more 0xFF value worse to not send in stream,
-# but skip those sending and send next non-FF value in another frame
-ff_treshold = 7 
+ecuid = 14 # =0x0E -> ECU, 256 -> all ECUs found by scan of network
+scan = False
+assign_ids = False
+planfile = "" # Compiled download plan, used instead of input file if it is compiled from it
+metrics_file = "" # Timing of request/answer pairs into this .json or .csv file
+patch = "" # Unit specific bytes: patch text, or .json or .csv file of units
+unit = "" # Name of unit in patch file, empty means units in order
+units = None # dzimage.Units of patch
+manifest = False # Manifest of sector hashes on ECU, download only changed sectors
+check = False # Only list sectors which differ from manifest on ECU
+erase_free = False # Read sectors and do not erase them if download writes only erased bytes
+session = None
+
+flush_time = 0 # Console output is flushed at most once in dzsession.flush_period
+
+# Number of write frames in flight and maximum write frame length (0 means probe), see dzsession.py
+window = dzsession.Session.window
+max_frame = dzsession.Session.max_frame
 
 # ---------------------------------------------------------------------------------------
 # Functions
@@ -62,267 +87,322 @@ ff_treshold = 7
 
 # ---------------------------------------------------------------------------------------
 def p(s):
-  f1.write(s)
+  global flush_time
+  f1.Text(s)
   sys.stdout.write(s)
-  sys.stdout.flush()
+  # Flush unfinished lines immediately, they are followed by waiting. Finished lines are
+  # flushed at most once in flush_period, to not slow down download by console output.
+  if not s.endswith("\n") or flush_time < time.perf_counter():
+    sys.stdout.flush()
+    flush_time = time.perf_counter() + dzsession.flush_period
 
 # ---------------------------------------------------------------------------------------
 def err(s):
   p("\nERROR! "+s+"\n\n")
-  if 'ser' in globals():
-    ser.close()
-  f1.close() # Close communication log file
+  SaveMetrics()
+  if session is not None:
+    session.Close()
+  f1.Close() # Close communication log file
   sys.exit(1)
 
 # ---------------------------------------------------------------------------------------
-def h(byte,f = "02X"):
-  return("$"+format(byte,f))
-
-# ---------------------------------------------------------------------------------------
-def ba2hs(ba): # bytearray to hex string
-  ret = ""
-  for byte in ba:
-    ret += format(byte,"02X")+" "
-  return(ret)
-
-# ---------------------------------------------------------------------------------------
-def DownloadRow(area, address, length):
-  buff = bytearray()
-
-  # Frame header
-  buff.append(0x1C)
-  buff.append(0xDA)
-  buff.append(ecuid)
-  buff.append(toolid)
-  buff.append(0x04)
-
-  # Address
-  cs = 0
-  addr_hi = (address >> 8) & 0xFF
-  cs += addr_hi
-  buff.append(addr_hi)
-  addr_lo = address & 0xFF
-  cs += addr_lo
-  buff.append(addr_lo)
-
-  # Length
-  cs += length
-  buff.append(length)
-
-  # Timeout (not yet supported)
-  buff.append(0x00)
-
-  # Data
-  dataindex = address - area['start']
-  for i in range(length):
-    byte = area['data'][i+dataindex]
-    cs += byte
-    buff.append(byte)
-
-  # Checksum
-  cs &= 0xFF
-  buff.append(cs)
-
-  # Transmission
-  f1.write("\nDat Tx: "+ba2hs(buff)+"\n")
-  num = ser.write(buff)
-  if num < len(buff):
-    err("Too less written bytes ("+h(num)+") for sector "+h(address,"04X"))
-
-  # Receive answer
-  answer = bytearray(ser.read(6))
-  f1.write("Dat Rx: "+ba2hs(answer)+"\n")
-
-  if 0==len(answer): # If there was any answer
-    err("There was no answer for sector "+h(address,"04X"))
-  elif 6>len(answer):
-    err("Too short answer for sector "+h(address,"04X"))
-  elif 6==len(answer):
-    if answer[5] == 0:
-      p(", Done.\n")
+def NewSession(port, log, out):
+  s = dzsession.Session(port, baud, ecuid, toolid, log, out)
+  s.window = window
+  s.max_frame = max_frame
+  s.turbo = turbo
+  if connect is not None:
+    s.conn_period, s.conn_backoff, s.conn_timeout = connect
+  if 0 < len(metrics_file):
+    s.metrics = dzmetrics.Metrics()
+  name = "./dzdl-"+dzlog.PortSuffix(port) if 0 < len(ports) else "./dzdl"
+  s.checkpoint = name+".ckpt"
+  s.timeouts = dzmetrics.Timeouts(dzsession.answer_timeout, name+".rtt", port)
+  s.units = units
+  s.manifest = manifest
+  s.check = check
+  s.erase_free = erase_free
+  return s
+
+def SaveMetrics():
+  # Summary of timing on console and all request/answer pairs into metrics file
+  if session is None or session.metrics is None:
+    return
+  metrics = session.metrics
+  session.metrics = None # Saved once, also if error comes later
+  p(metrics.Text())
+  try:
+    metrics.Write(metrics_file)
+  except OSError as e:
+    p("Cannot write metrics file "+metrics_file+": "+str(e)+"\n")
+
+def EscPressed():
+  # Non-blocking check of ESC button on console, other keys are dropped
+  if sys.platform.startswith("win"): # Windows
+    while msvcrt.kbhit():
+      if ord(msvcrt.getch()) == 0x1B:
+        return True
+    return False
+  if not sys.stdin.isatty():
+    return False
+  while 0 < len(select.select([sys.stdin], [], [], 0)[0]):
+    c = os.read(sys.stdin.fileno(), 1)
+    if c == b"\x1b":
       return True
-    else:
-      ShowError(answer[5])
-  
+    if 0 == len(c):
+      break
   return False
 
-# ---------------------------------------------------------------------------------------
-def ShowError(response):
-  ShowErrorNibble("Memory error: ", (response >> 4) & 0x0F)
-  ShowErrorNibble("Protocol error: ", response & 0x0F)
-
-def ShowErrorNibble(errortype, errorcode):
-  if errorcode == 0: return # No error
-  elif errorcode == 1: err(errortype+"address error. ")
-  elif errorcode == 2: err(errortype+"Protection violation. ")
-  elif errorcode == 5: err(errortype+"Length is zero. ")
-  elif errorcode == 6: err(errortype+"Length is too high. ")
-  elif errorcode == 7: err(errortype+"Unexpected command or CAN DLC. ")
-  elif errorcode == 8: err(errortype+"Unexpected subservice in request service. ")
-  elif errorcode == 0xA: err(errortype+"Address error (Bootloader code range is prohibited to be changed). ")
-  elif errorcode == 0xB: err(errortype+"Boundary violation. ")
-  elif errorcode == 0xC: err(errortype+"Checksum error. ")
-  elif errorcode == 0xD: err(errortype+"Data error (e.g. wrong filler byte value). ")
-  elif errorcode == 0xE: err(errortype+"End of time (timeout). ")
-  elif errorcode == 0xF: err(errortype+"Fingerprint not written. ")
-  else: err("Unknown error "+h(errorcode)+". ")
-
-def RunApplication():
-  run = bytearray([0x1C,0xDA,ecuid,toolid,0x01,0x52]) # Run application
-  f1.write("\nRun Tx: "+ba2hs(run))
-  ser.write(run)
-  # No response expected
-  p(", Done.\n")
-  return True
-
-
-# ---------------------------------------------------------------------------------------
-def BCD(string2): # Convert decimal to BCD, e.g. from 10 to 0x10
-  return (int(string2[0], 16)*16) + int(string2[1], 16)
-
-def WriteFingerprint():
-  d = datetime.today()
-  year = BCD(d.strftime("%y"))
-  month = BCD(d.strftime("%m"))
-  day = BCD(d.strftime("%d"))
-  t = datetime.now()
-  hour = BCD(t.strftime("%H"))
-  minute = BCD(t.strftime("%M"))
-  second = BCD(t.strftime("%S"))
-  wrfp = bytearray([0x1C, 0xDA, ecuid, toolid, 0x06, year, month, day, hour, minute, second]) 
-  goodresp = bytearray([0x1C,0xDA,toolid,ecuid,0x01,0x00])
-
-  f1.write("\nWfp Tx: "+ba2hs(wrfp))
-  ser.write(wrfp)
-
-  answer = bytearray(ser.read(6))
-  if 0<len(answer): # If there was any answer
-    f1.write("\nWfp Rx: "+ba2hs(answer))
-  if 0==len(answer):
-    err("No answer")
-  elif 6>len(answer):
-    err("Too short answer")
-  elif 6==len(answer):
-    if answer == goodresp:
-      p(", Done.\n")
-      return True
-    else:
-      ShowError(answer[5])
-  exit(1)
+def ParseConnect(arg):
+  # period[,backoff[,deadline]]
+  values = [dzsession.Session.conn_period, dzsession.Session.conn_backoff, dzsession.Session.conn_timeout]
+  try:
+    for i, v in enumerate(arg.split(",")[:3]):
+      values[i] = float(v)
+  except ValueError:
+    return None
+  if values[0] <= 0 or values[1] < 1 or values[2] < 0:
+    return None
+  return values
+
+def DownloadTargets(s, sectors, plan_frame):
+  s.DownloadTargets(mem, meminuse, sectors, plan_frame, diff, assign_ids)
+
+def MetricsName(port):
+  # Metrics file of a port in multi-port mode, e.g. run-ttyUSB0.json of --metrics=run.json
+  root, ext = os.path.splitext(metrics_file)
+  return root+"-"+dzlog.PortSuffix(port)+ext
+
+def SaveSessionMetrics(s, name):
+  # Metrics of a session of parallel download into own file of port or ECU
+  if s.metrics is None:
+    return
+  s.p(s.metrics.Text())
+  try:
+    s.metrics.Write(MetricsName(name))
+  except OSError as e:
+    s.p("Cannot write metrics file: "+str(e)+"\n")
+
+def EcuName(ecuid):
+  # Part of file names of an ECU in interleaved mode, e.g. dzdl-ecu0E.ckpt, run-ecu0E.json
+  return "ecu"+format(ecuid, "02X")
+
+def DownloadPort(port, sectors, plan_frame):
+  # Complete download on one port of multi-port mode. Runs in a thread of pool,
+  # progress goes only into own log file of port.
+  log = dzlog.LogWriter(dzlog.LogName(port), f1.level)
+  s = NewSession(port, log, None)
+  sessions.append(s)
+  start = time.perf_counter()
+  result = "PASS"
+  message = ""
+  try:
+    s.p("Port '" + port + "'\n")
+    s.Open()
+    DownloadTargets(s, sectors, plan_frame)
+  except dzsession.SessionError as e:
+    s.p("\nERROR! "+str(e)+"\n")
+    result = "FAIL"
+    message = str(e)
+  finally:
+    s.Close()
+    SaveSessionMetrics(s, port)
+    log.Close()
+  return result, message, time.perf_counter()-start
+
+def DownloadEcu(bus, ecuid, unit, sectors, plan_frame):
+  # Complete download of one ECU on bus of interleaved mode. Runs in a thread of pool,
+  # progress lines of ECU are prefixed by its ID on console and in log.
+  lines = dzbus.Lines("ECU "+dzsession.h(ecuid)+": ", f1, sys.stdout, console_lock)
+  s = NewSession(port, lines, None)
+  s.ecuid = ecuid
+  s.link = bus.Port(ecuid)
+  s.checkpoint = "./dzdl-"+EcuName(ecuid)+".ckpt"
+  s.timeouts = session.timeouts # Estimates are per ECU, file is saved once at the end
+  if units is not None:
+    s.units = dzimage.Units([] if unit is None else [unit])
+  sessions.append(s)
+  start = time.perf_counter()
+  result = "PASS"
+  message = ""
+  try:
+    s.Download(mem, meminuse, sectors, plan_frame, diff)
+  except dzsession.SessionError as e:
+    s.p("\nERROR! "+str(e)+"\n")
+    result = "FAIL"
+    message = str(e)
+  finally:
+    SaveSessionMetrics(s, EcuName(ecuid))
+    lines.Close()
+  return result, message, time.perf_counter()-start
+
+def DownloadParallel(kind, names, worker):
+  # Same image into more ports or ECUs at once, one thread of pool per name. Worker does
+  # the complete download of a name, it returns result, message and elapsed time. Serial
+  # communication waits for the targets, so threads are enough, they do not compete for CPU.
+  title = kind[0].upper() + kind[1:]
+  results = {}
+  start = time.perf_counter()
+  pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(names))
+  futures = dict((pool.submit(worker, name), name) for name in names)
+  try:
+    for future in concurrent.futures.as_completed(futures):
+      name = futures[future]
+      result, message, elapsed = results[name] = future.result()
+      p(title + " " + name + ": " + result + format(elapsed, ".1f").rjust(7) + " s" + ("  " + message if message else "") + "\n")
+  except KeyboardInterrupt:
+    for s in sessions:
+      s.abort.set()
+    p("\nUser abort, wait for " + kind + "s in progress.\n")
+  pool.shutdown(wait=True)
+  for future, name in futures.items():
+    if future.done() and not future.cancelled():
+      results[name] = future.result()
+
+  # Summary
+  passed = 0
+  width = max(8, max(len(name) for name in names) + 2)
+  p("\n" + title.ljust(width) + "Result  Time\n")
+  for name in names:
+    result, message, elapsed = results.get(name, ("FAIL", "Not started", 0.0))
+    if result == "PASS":
+      passed += 1
+    p(name.ljust(width) + result.ljust(6) + format(elapsed, ".1f").rjust(6) + " s" + ("  " + message if message else "") + "\n")
+  p(str(passed) + " of " + str(len(names)) + " " + kind + "s passed in " + format(time.perf_counter()-start, ".1f") + " s\n")
+  return passed == len(names)
+
+def DownloadEcus(sectors, plan_frame):
+  # Same image into more ECUs of one bus, one thread per ECU. Requests of ECUs are
+  # interleaved: while an ECU erases or writes Flash, others get their requests.
+  ids = ecuids
+  if ids == [dzsession.AUTO_ID]:
+    ids = session.FindEcus(assign_ids)
+  bus = dzbus.Bus(session.link, toolid)
+  # Units are given in order of ECU IDs, not in order of threads
+  todo = dict((dzsession.h(i), (i, None if units is None else units.Next())) for i in ids)
+  return DownloadParallel("ECU", [dzsession.h(i) for i in ids], lambda name: DownloadEcu(bus, *todo[name], sectors, plan_frame))
+
+def DownloadPorts(sectors, plan_frame):
+  # Same image into all ports parallel, one thread per port
+  return DownloadParallel("port", ports, lambda port: DownloadPort(port, sectors, plan_frame))
 
 # ---------------------------------------------------------------------------------------
-def ConnectDevice():
-  conn = bytearray([0x1C,0xDA,ecuid,toolid,0x00])
-  goodresp = bytearray([0xDA,toolid,ecuid,0x00])
-  ser.timeout = 0
-  conn_period_s = 0.1
-  timer = time.perf_counter() + conn_period_s
+def ReadOut():
+  # Read out memory of ECU into file. Progress is saved into .part file, interrupted
+  # read out is continued from it.
+  partfile = readfile+".part"
   try:
-    while True:
-
-      # TODO!!! Quit by keyboard ESC button
-
-      if timer < time.perf_counter():
-        f1.write("\nCon Tx: "+ba2hs(conn))
-        ser.send_break() # Send brake to reset application software for auto connect without need of manual reset
-        ser.write(conn)
-        timer = time.perf_counter() + conn_period_s
-
-      bs = ser.read(1)
-      if 0 == len(bs):
-        continue
-      if ord(bs) != 0x1C:
-        continue
-
-      ser.timeout = 1
-      answer = bytearray(ser.read(4))
-      if 0<len(answer): # If there was any answer
-        f1.write("\nCon Rx: "+ba2hs(answer))
-      if answer == goodresp:
-        break
-      #p(h(ord(resp[0])))
-  except KeyboardInterrupt:
-    p("\nUser abort.\n")
-    ser.close()
-    f1.close() # Close communication log file
+    if session.ecuid == dzsession.AUTO_ID:
+      ids = session.FindEcus(assign_ids)
+      if len(ids) != 1:
+        err("Read out needs one ECU, select it by -e")
+      session.ecuid = ids[0]
+    rmem, rusage = session.ReadOut(read_ranges, partfile, 0 == len(inputfile) and 0 == len(planfile))
+  except (dzsession.UserAbort, KeyboardInterrupt):
+    p("\nUser abort. Read out is continued by next start with the same file.\n")
+    SaveMetrics()
+    session.Close()
+    f1.Close() # Close communication log file
     sys.exit(0)
-  else:
-    ser.timeout = 1
-    p(", Done.\n")
-    return
+  except dzsession.SessionError as e:
+    err(str(e)+". Read out is continued by next start with the same file")
+  p("Write file "+ntpath.basename(readfile))
+  dzimage.WriteImage(readfile, rmem, rusage)
+  os.remove(partfile)
+  p(", Done.\n")
 
 # ---------------------------------------------------------------------------------------
-def EraseSector(address):
-  erase =  bytearray([0x1C,0xDA,ecuid,toolid,0x02,((address>>8)&0xFF),((address>>0)&0xFF)])
-  goodresp = bytearray([0x1C,0xDA,toolid,ecuid,0x01,0x00])
-
-  f1.write("\nCon Tx: "+ba2hs(erase))
-  ser.write(erase)
-
-  answer = bytearray(ser.read(6))
-  if 0<len(answer): # If there was any answer
-    f1.write("\nCon Rx: "+ba2hs(answer))
-  if answer == goodresp:
-    p(", Done.\n")
-    return True
-  if 0==len(answer):
-    err("No answer")
-  if 6>len(answer):
-    err("Too short answer")
-  if 6==len(answer):
-    ShowError(answer[5])
-  exit(1)
-
-def getaddinfo(s):
-  addinfo = ""
-  if(s == 0x17E0):addinfo = ", EEPROM SCI Baud Rate"
-  if(s == 0x17E8):addinfo = ", EEPROM CAN Baud Rate"
-  if(s == 0x17F0):addinfo = ", EEPROM Fingerprint of bootloader"
-  if(s == 0x17F8):addinfo = ", EEPROM ECU ID"
-  if(0x1900 <= s and s <= 0xEAFF):addinfo = ", Application software"
-  if(s == 0xFFAC):addinfo = ", BootLoader Configuration Register"
-  if(s == 0xFFAE):addinfo = ", FTRIM bit"
-  if(s == 0xFFAF):addinfo = ", TRIM value"
-  if(0xFFB0 <= s and s <= 0xFFB7):addinfo = ", Backdoor key"
-  if(s == 0xFFBD):addinfo = ", Flash and EEPROM Protection Register"
-  if(s == 0xFFBF):addinfo = ", Flash and EEPROM Options Register"
-  if(0xFFC0 <= s and s <= 0xFFFD):addinfo = ", Interrupt vector"
-  if(s == 0xFFFE):addinfo = ", Reset vector"
-  return addinfo
+def PrintPlan(sectors, frame):
+  p(dzsession.PlanInfo(sectors, frame))
+
+def ReadPlan(plan_frame, protos):
+  # Compiled plan of plan file as (sectors, mem, usage, frame length). With input file it is
+  # used only if it was compiled from the same file content for the same frame length and
+  # protocols, otherwise None is returned and plan is compiled again.
+  if 0 == len(planfile) or (0 < len(inputfile) and not os.path.exists(planfile)):
+    return None
+  p("Load plan file "+ntpath.basename(planfile))
+  try:
+    digest, frame, sectors, pmem, pusage = dzplan.LoadPlan(planfile)
+    if 0 < len(inputfile):
+      compiled = set(sectors[0]['frames']) if 0 < len(sectors) else set()
+      if digest != dzimage.Digest(*inputfile.split(",")) or frame != plan_frame or not set(protos) <= compiled:
+        p(", Changed, Compile again.\n")
+        return None
+  except OSError as e:
+    err("Cannot open plan file "+planfile+": "+e.strerror)
+  except (dzplan.PlanError, dzimage.ImageError) as e:
+    if 0 == len(inputfile):
+      err(str(e))
+    p(", "+str(e)+", Compile again.\n")
+    return None
+  p(", Done.\n")
+  return sectors, pmem, pusage, frame
 
 # ---------------------------------------------------------------------------------------
 def PrintHelp():
   p("dzdl.py - MC9S08DZ60 DownLoader - " + __version__ +"\n")
   p("Download software into flash memory from an S19 file through RS232\n")
-  p("Log file dzdl.com is always created/updated (See with 'cat dzdl.com')\n");
+  p("Binary log file dzdl.log is created/updated unless --log-level=off (See with 'dzdl-log dzdl.log')\n");
   p("Options: \n")
   p("  -p port      Set serial com PORT used to communicate with target (e.g. COM1 or /dev/ttyS0)\n")
+  p("               SocketCAN interface is given with prefix can:, like can:can0 or can:vcan0\n")
+  p("  --ports=p1,p2,...  Download the same file into more ports parallel, log of each port is dzdl-<port>.log\n")
   p("  -b baud      Baud rate of downloading\n")
-  p("  -f s19file   S19 file path to be downloaded\n")
-  p("  -d toolID    Downloader tool ID (default 0xDE)\n")  
-  p("  -e ecuID     Target ECU ID (default=14. 256 means auto)\n")  
-  p("  -r           Read out current sector data before erase sector. (Not yet supported)\n");
+  p("  --turbo=baud Switch ECU to higher baud rate (1000000 / n) for download, original is restored at the end\n")
+  p("  --connect=period,backoff,timeout  Connection attempt period (default 0.1 s), its grow factor (1)\n")
+  p("               and deadline of connection (default 0: wait forever, till ESC or Ctrl+C)\n")
+  p("  -f s19file   S19 (S1/S2/S3) or Intel HEX file path to be downloaded\n")
+  p("               More files are merged in order, like -f boot.s19,app.s19,config.s19\n")
+  p("  --plan=file  Compiled download plan: with -f it is written, or loaded if it is of the same file.\n")
+  p("               Without -f the plan is downloaded, S19 is not needed.\n")
+  p("  --patch=spec Unit specific bytes of image, like 0x17F8=0E,0x1080=41424344 for every ECU,\n")
+  p("               or .csv (unit,0x17F8,...) or .json file of units, every ECU gets the next unit\n")
+  p("  --unit=name  Download only unit of name of patch file\n")
+  p("  -d toolID    Downloader tool ID (default 0xDE)\n")
+  p("  -e ecuID     Target ECU ID (default=14. 256 means auto: all ECUs found by scan of network)\n")
+  p("  --scan       Scan network: list serial number and ECU ID of all ECUs\n")
+  p("  --assign-ids Assign free ECU ID to ECUs which have no own or have the same ID (with --scan or -e 256)\n")
+  p("  --ecuids=a,b,...  Download the same file into more ECUs of CAN bus of port, requests of ECUs are interleaved\n")
+  p("               (256 means all ECUs found by scan of network)\n")
+  p("  -w window    Number of write frames in flight (default 1, stop and wait)\n")
+  p("  --max-frame=n  Maximum data bytes in a write frame (default is probed at connect)\n")
+  p("  -r file      Read out memory of ECU into .bin (64k image) or .s19 file, before download if -f is also given\n")
+  p("  --range=start-end,...  Address ranges of read out (default 0x1080-0x17FF,0x1900-0xFFFF)\n")
+  p("  --diff       Read back sectors and download only the changed ones\n")
+  p("  --erase-free Read sectors, program without erase where only erased bytes are written, skip the same ones\n")
+  p("  --manifest   Write hashes of sectors into 0x1100-0x12FF and download only sectors which differ from it\n")
+  p("  --check      Compare file with manifest of ECU and list sectors which differ, no download\n")
+  p("  --log-level=level  Log into dzdl.log: off, text (progress only) or frames (default)\n")
+  p("  --metrics=file  Latency of every request/answer into .json (with summary and histograms) or .csv file,\n")
+  p("               summary at the end (throughput, wire, device and host time, retries, slowest sectors)\n")
   p("  -t           Terminal after download.\n");
   p("  -m           Memory dump into text file dzdl.mem (See with 'xxd dzdl.mem')\n")
-  p("  -s           See values of bytes (show 41 instead of A for example)\n")
+  p("  -s           Show received bytes of terminal as hex dump with ASCII column\n")
   p("  -h           Print out this HELP text\n")
   p("Examples:\n")
   p("  dzml.py -f xy.s19  Download xy.s19 software into uC\n")
   p("  dzml.py -b 9600 -p /dev/ttyUSB0 -t  Serial terminal on 9600 baud\n")
-  f1.close() # Close communication log file
+  p("  dzml.py -r backup.s19 -f xy.s19  Save current software into backup.s19, then download xy.s19\n")
+  p("  dzml.py -f xy.s19 --ports=/dev/ttyUSB0,/dev/ttyUSB1  Download xy.s19 into two uC\n")
+  p("  dzml.py -f xy.s19 -p can:can0  Download xy.s19 by CAN (bit rate is set by 'ip link')\n")
+  p("  dzml.py -f xy.s19 -p can:can0 --ecuids=14,15,16  Download xy.s19 into three ECUs of CAN bus at once\n")
+  p("  dzml.py -f xy.s19 --patch=units.csv --unit=A0012  Download xy.s19 with bytes of unit A0012\n")
+  f1.Close() # Close communication log file
   sys.exit(0)
 
 # ---------------------------------------------------------------------------------------
 # MAIN()
 # ---------------------------------------------------------------------------------------
 
-# Open communication log file
-f1 = open("./dzdl.com", "w") # "w" means: truncate file to zero length or create text file for writing. The stream is positioned at the beginning of the file.
+# Communication log file, it is created at first record. Records are written by background
+# thread of log writer.
+f1 = dzlog.LogWriter("./dzdl.log")
 
 #Parsing command line options
 argv = sys.argv[1:]
 try:
-  opts, args = getopt.getopt(argv,"p:b:f:i:e:mtsh",["port=","baud=","file=","toolid=","ecuid=","memory","terminal","seeval","help"])
+  opts, args = getopt.getopt(argv,"p:b:f:i:e:w:r:mtsh",["port=","ports=","baud=","turbo=","connect=","file=","plan=","read=","range=","toolid=","ecuid=","ecuids=","window=","max-frame=","diff","log-level=","metrics=","patch=","unit=","manifest","check","erase-free","scan","assign-ids","memory","terminal","seeval","help"])
 except getopt.GetoptError:
   p("Wrong option.\n")
   PrintHelp()
@@ -331,14 +411,70 @@ for opt, arg in opts:
     PrintHelp()
   elif opt in ("-p", "--port"):
     port = arg
+  elif opt == "--ports":
+    ports = [s for s in arg.split(",") if 0 < len(s)]
   elif opt in ("-b", "--baud"):
     baud = int(arg)
+  elif opt == "--turbo":
+    turbo = int(arg)
+    if 0 == dzsession.Divisor(turbo):
+      p("Baud rate "+arg+" is not possible for bootloader (1000000 / n).\n")
+      PrintHelp()
+  elif opt == "--connect":
+    connect = ParseConnect(arg)
+    if connect is None:
+      p("Wrong connection parameters.\n")
+      PrintHelp()
   elif opt in ("-f", "--file"):
     inputfile = arg
+  elif opt == "--plan":
+    planfile = arg
+  elif opt in ("-r", "--read"):
+    readfile = arg
+  elif opt == "--range":
+    read_ranges = dzsession.ParseRanges(arg)
+    if read_ranges is None:
+      p("Wrong range.\n")
+      PrintHelp()
   elif opt in ("-i", "--toolid"):
     toolid = int(arg)
   elif opt in ("-e", "--ecuid"):
     ecuid = int(arg)
+  elif opt == "--ecuids":
+    try:
+      ecuids = [int(s) for s in arg.split(",") if 0 < len(s)]
+    except ValueError:
+      ecuids = []
+    if 0 == len(ecuids) or (1 < len(ecuids) and dzsession.AUTO_ID in ecuids) or len(set(ecuids)) < len(ecuids):
+      p("Wrong ECU IDs.\n")
+      PrintHelp()
+  elif opt in ("-w", "--window"):
+    window = max(1,int(arg))
+  elif opt == "--max-frame":
+    max_frame = min(255,max(1,int(arg)))
+  elif opt == "--log-level":
+    if arg not in dzlog.levels:
+      p("Wrong log level.\n")
+      PrintHelp()
+    f1.level = dzlog.levels[arg]
+  elif opt == "--metrics":
+    metrics_file = arg
+  elif opt == "--patch":
+    patch = arg
+  elif opt == "--unit":
+    unit = arg
+  elif opt == "--scan":
+    scan = True
+  elif opt == "--assign-ids":
+    assign_ids = True
+  elif opt == "--diff":
+    diff = True
+  elif opt == "--manifest":
+    manifest = True
+  elif opt == "--check":
+    check = True
+  elif opt == "--erase-free":
+    erase_free = True
   elif opt in ("-m", "--memory"):
     mem_dump = True
   elif opt in ("-s", "--seeval"):
@@ -348,119 +484,129 @@ for opt, arg in opts:
 
 # Inform user about parsed parameters
 p("dzdl.py - MC9S08DZ60 DownLoader - " + __version__ + "\n")
-p("Port '" + port + "'\n")
-
-if(port != "printsectors"):
+if 0 < len(ports):
+  if 0 == len(inputfile) and 0 == len(planfile):
+    err("File to be downloaded is needed for more ports")
+  if terminal:
+    err("Terminal is supported only on one port")
+  if 0 < len(readfile):
+    err("Read out is supported only on one port")
+  p("Ports '" + "', '".join(ports) + "'\n")
   p("Baud rate is " + str(baud) + "\n")
-  
-  # Open serial port
-  p("Open serial port")
+else:
+  p("Port '" + port + "'\n")
+if 0 < len(ecuids):
+  if 0 < len(ports):
+    err("More ECUs are supported only on one port")
+  if not dztransport.IsCan(port):
+    err("More ECUs are supported only on CAN, on SCI other ECUs would take byte 't' of requests as terminal command")
+  if 0 == len(inputfile) and 0 == len(planfile):
+    err("File to be downloaded is needed for more ECUs")
+  if terminal or 0 < len(readfile):
+    err("Terminal and read out are supported only for one ECU")
+  if turbo:
+    err("Turbo baud is not supported for more ECUs, it would change baud rate of all ECUs on bus")
+
+# Unit specific patches are read before sessions, ports share them
+if 0 < len(patch):
+  if 0 == len(inputfile) and 0 == len(planfile):
+    err("File to be patched is needed")
+  try:
+    units = dzimage.Units(*dzimage.ReadUnits(patch))
+  except dzimage.ImageError as e:
+    err(str(e))
+  if 0 < len(unit) and not units.Select(unit):
+    err("Unit "+unit+" is not found in "+patch)
+
+if(port != "printsectors" and 0 == len(ports)):
+  if dztransport.IsCan(port):
+    if terminal:
+      err("Terminal is supported only on serial port")
+    p("Open CAN interface")
+  else:
+    p("Baud rate is " + str(baud) + "\n")
+    p("Open serial port")
+  session = NewSession(port, f1, sys.stdout)
+  session.quit_key = EscPressed
+  if not sys.platform.startswith("win") and sys.stdin.isatty():
+    # Keys are read without Enter and echo, to see ESC button immediately
+    stdin_mode = termios.tcgetattr(sys.stdin.fileno())
+    tty.setcbreak(sys.stdin.fileno())
+    atexit.register(termios.tcsetattr, sys.stdin.fileno(), termios.TCSADRAIN, stdin_mode)
   try:
-    ser = serial.Serial(port, baud, timeout=1)
-  except:
-    err("Cannot open serial port " + port)
+    session.Open()
+  except dzsession.SessionError as e:
+    err(str(e))
   p(", Done.\n")
 
+  # Scan network and assign unique IDs
+  if scan:
+    try:
+      session.FindEcus(assign_ids, False)
+    except dzsession.UserAbort:
+      p("\nUser abort.\n")
+    except dzsession.SessionError as e:
+      err(str(e))
+
+  # Read out memory of ECU
+  if 0 < len(readfile):
+    ReadOut()
 
 
 # ---------------------------------------------------------------------------------------
 # Download operation
-if 0 < len(inputfile):
-
-  p("Build up memory model")
-  # Build memory map of MC9S08DZ60 in sectors. This is a list of dictionary (c struct array)
-  #  Property sector and len depends on bootloader, start and length depends on used range in sector.
-  sectors =        [{"sector":0x1080, "plen":0x280, "used":False, "areas":[] }] # application identification
-  sectors.append(   {"sector":0x1300, "plen":0x100, "used":False, "areas":[] }) # bootloader and hardware identification
-  for s in range(0x1400,0x1800,0x8): # EEPROM in 8 byte mode
-    sectors.append({"sector":s, "plen":0x8, "used":False, "areas":[] })
-  for s in range(0x1900,0xF400,0x300): # Application Flash
-    sectors.append({"sector":s, "plen":0x300, "used":False, "areas":[] })
-  sectors.append({"sector":0xFD00, "plen":0x300, "used":False, "areas":[] }) # Last vector sector 
-  p(", Done.\n")
-
-  # Read S19 into data array. Not used bytes are 0xFF.
-  p("Read S19 file "+ntpath.basename(inputfile))
-  f = open(inputfile, "r")
-  mem = [0xFF] * 65536
-  meminuse = [0x00] * 65536
-
-  for line in f.readlines():
-    line = line.strip() # Trim new line characters
+if 0 < len(inputfile) or 0 < len(planfile):
 
-    pointer = 0
-
-    record_type = line[pointer:pointer+2]
-    pointer += 2
-
-    record_length = int(line[pointer:pointer+2],16)-1
-    pointer += 2
+  plan_frame = max_frame if max_frame else dzplan.assumed_frame
+  protos = sorted(set(dztransport.Protocol(x) for x in (ports if 0 < len(ports) else [port])))
+  plan = ReadPlan(plan_frame, protos)
+  if plan is not None:
+    sectors, mem, meminuse, plan_frame = plan
+  else:
+    p("Build up memory model")
+    sectors = dzplan.Sectors()
+    p(", Done.\n")
 
-    if record_type == "S1":
-      record_address = int(line[pointer:pointer+4],16)
-      record_length -= 2
-      pointer += 4
+    # Read S19 or HEX files into data array. Not used bytes are 0xFF.
+    inputfiles = inputfile.split(",")
+    if 1 < len(inputfiles):
+      p("Merge files "+", ".join(ntpath.basename(f) for f in inputfiles))
+    elif inputfile.lower().endswith((".hex",".ihx")):
+      p("Read HEX file "+ntpath.basename(inputfile))
     else:
-      continue
-
-    for x in range(record_length):
-      record_byte = line[pointer:pointer+2]
-      pointer += 2
-      mem[record_address] = int(record_byte,16)
-      meminuse[record_address] = 1
-      record_address += 1
-
-    record_cs = line[-2:] # I do not check the checksum, sorry
+      p("Read S19 file "+ntpath.basename(inputfile))
+    try:
+      mem, meminuse = dzimage.ReadImages(inputfiles)
+    except dzimage.ImageError as e:
+      err(str(e))
+    p(", Done.\n")
 
+    # Fill memory map data from S19
+    p("Fill memory sectors with data")
+    dzplan.Plan(sectors, mem, meminuse, plan_frame)
+    p(", Done.\n")
 
-  f.close()
-  p(", Done.\n")
+    # Serialize all write frames once, sessions only send them
+    p("Compile frames")
+    dzplan.Compile(sectors, plan_frame, dict((x, dztransport.WRITE_BODY[x]) for x in protos))
+    p(", Done.\n")
+    if 0 < len(planfile):
+      p("Write plan file "+ntpath.basename(planfile))
+      try:
+        dzplan.SavePlan(planfile, sectors, plan_frame, dzimage.Digest(*inputfiles), mem, meminuse)
+      except (OSError, dzimage.ImageError) as e:
+        err("Cannot write plan file: "+str(e))
+      p(", Done.\n")
+  PrintPlan(sectors, plan_frame)
 
   # Save memory content
   if mem_dump:
     p("Create or update file dzdl.mem")
     f2 = open("./dzdl.mem", "wb")
-    f2.write(bytearray(mem))
+    f2.write(mem)
     f2.close()
     p(", Done.\n")
 
-  # Fill memory map data from S19
-  p("Fill memory sectors with data")
-  for s in sectors:
-    ff_counter = 0 # Number of consecutive 0xFF value
-    start = 0
-    end = 0
-    data = bytearray() # Init with empty list
-    for a in range(s["sector"], s["sector"] + s["plen"]): # Go forward on sector addresses
-      if meminuse[a]: # non-empty data value
-        s["used"] = True # Mark as sector is used
-        ff_counter = 0 # Reset FF counter
-        if start == 0: # If used area is not yet started 
-          start = a # Start used area
-        end = 0 # Clear end address was maybe previously saved due to FF value 
-        data.append(mem[a]) # Add data byte to array
-      else: # not used
-        if start == 0: # if area not yet started 
-          continue # wait further for non-FF byte
-        if end == 0: # If end not yet saved, save since this is now an empty data byte 
-          end = a-1 # Save end address of last non-FF values area
-        data.append(mem[a]) # Add data bytes
-        ff_counter += 1 # Count number of empty (0xFF) values
-        if ff_treshold < ff_counter: # Too many consecutive FF value
-          length = end-start+1 # Get number of non empty data bytes 
-          s["areas"].append({"start":start, "len":length, "data":data[:length] }) # Add area dictionary to areas
-          ff_counter = 0 # Clear number of consecutive 0xFF value
-          start = 0     
-          end = 0       
-          data = bytearray() # Init with empty list
-    if 0 < start: # There is open area
-      length = a-start+1 # Get length of area
-      s["areas"].append({"start":start, "len":length, "data":data[:length] }) # close it
-
-  # Delete not used sectors from list
-  sectors[:] = [s for s in sectors if s.get("used") != False]
-  p(", Done.\n")
-
   # Debug service to check if sectors were processed well
   if(port == "printsectors"):
     for sector in sectors:
@@ -469,42 +615,41 @@ if 0 < len(inputfile):
         print(" Area "+hex(area['start'])+" - "+hex(area['start']+area['len']-1) + " ("+hex(area['len'])+") ")
     exit(0)
 
-  # Connecting to devive
-  p("Connect to device (Press Ctrl+C to abort)");
-  ConnectDevice()
-
-  # Write fingerprint
-  p("Write fingerprint");
-  WriteFingerprint()
-
-  # Erase start vector sector first. This will be written last time, what ensures that interrupted download will finally not be called.
-  p("Erase sector 0xFD00 - 0xFFFF"+getaddinfo(0xFFFE))
-  EraseSector(0xFFFE) # Here it is not problem, that the complete sector is erased. Content will be written again during download.
-
-  # Download sectors
-  for sector in sectors:
-    if(sector['sector'] != 0xFD00): # Do not need here to erase last (vector) page, because it was already erased before  
-      p("Erase sector "+hex(sector['sector'])+" - "+hex(sector['sector']+sector['plen']-1)+getaddinfo(sector['sector']))
-      EraseSector(sector['sector'])
-    for area in sector['areas']:
-      #p("Program area "+hex(area['start'])+" - "+hex(area['start']+area['len']-1) + " ("+hex(area['len'])+")\n")
-      cs = 0
-      l = area['len']
-      s = area['start']
-      while(0<l):
-        if(8<=l): # full frame with 8 data bytes
-          p("Program address "+hex(s)+" length 8"+getaddinfo(s))
-          DownloadRow(area,s,8)
-          s+=8
-          l-=8
-        else: # less than 8 data bytes 
-          p("Program address "+hex(s)+" length "+str(l)+getaddinfo(s))
-          DownloadRow(area,s,l)
-          l=0
-
-  # Run application immediately
-  p("Run application");
-  RunApplication()
+  if 0 < len(ports):
+    # Image is parsed and planned once, sessions of ports only read it
+    sessions = []
+    if not DownloadPorts(sectors, plan_frame):
+      f1.Close() # Close communication log file
+      sys.exit(1)
+  elif 0 < len(ecuids):
+    # ECUs of bus share the link of session
+    sessions = []
+    console_lock = threading.Lock()
+    session.metrics = None # Metrics of ECUs are written into own files
+    try:
+      passed = DownloadEcus(sectors, plan_frame)
+    except (dzsession.UserAbort, KeyboardInterrupt):
+      p("\nUser abort.\n")
+      session.Close()
+      f1.Close() # Close communication log file
+      sys.exit(0)
+    except dzsession.SessionError as e:
+      err(str(e))
+    if not passed:
+      session.Close()
+      f1.Close() # Close communication log file
+      sys.exit(1)
+  else:
+    try:
+      DownloadTargets(session, sectors, plan_frame)
+    except (dzsession.UserAbort, KeyboardInterrupt):
+      p("\nUser abort.\n")
+      SaveMetrics()
+      session.Close()
+      f1.Close() # Close communication log file
+      sys.exit(0)
+    except dzsession.SessionError as e:
+      err(str(e))
 
 
 
@@ -523,96 +668,20 @@ if 0 < len(inputfile):
 #cmd_setid =  bytearray([0x1C,0xDA,0xFF,toolid,0x07,0x23,0x03,0x10,0x22,0x28,0x41,0x0E]) 
 #cmd_wrfp =   bytearray([0x1C,0xDA,ecuid,toolid,0x06,0x23,0x03,0x10,0x22,0x28,0x41]) 
 
+SaveMetrics()
+
 if terminal:
-  f1.write("\nTerminal started\n")
-  ser.timeout = 0 # clear timeout to speed up terminal response
-  if not sys.platform.startswith("win"): # Linux
-    stdscr = curses.initscr()
-    curses.noecho() # switch off echo
-    stdscr.nodelay(True) # set getch() non-blocking
-    stdscr.scrollok(True)
-    stdscr.idlok(True)
-  while True:
-
-    if sys.platform.startswith("win"): # Windows
-      # From keyboard to UART
-      if msvcrt.kbhit():
-        c = msvcrt.getch()
-        if ord(c) == 0x1B: # ESC button
-          break
-        if ord(c) != -1:
-          ser.write(c)
-          f1.write(str(chr(c[0])))
-      # From UART to display
-      bs = ser.read(1)
-      if len(bs) != 0:
-        p(str(chr(bs[0])))
-    else: # Linux
-      # From keyboard to UART
-      c = stdscr.getch()
-#      if c == curses.KEY_F3:
-#        ser.write(cmd_connect)
-#        continue
-#      if c == ord('C'):
-#        ser.write(cmd_testpres)
-#        continue
-#      if c == ord('I'): # Instruction
-#        ser.write(cmd_reset)
-#        continue
-#      if c == ord('E'):
-#        ser.write(cmd_erase)
-#        continue
-#      if c == ord('W'):
-#        ser.write(cmd_write)
-#        continue
-#      if c == ord('R'):
-#        ser.write(cmd_read)
-#        continue
-#      if c == ord('S'):
-#        ser.write(cmd_scanet)
-#        continue
-#      if c == ord('F'):
-#        ser.write(cmd_wrfp)
-#        continue
-#      if c == ord('O'): # OWNID set
-#        ser.write(cmd_setid)
-#        continue        
-      if c == 0x1B:
-        break
-      if c != -1:
-        ser.write(chr(c).encode())
-        f1.write(chr(c))
-
-      # From UART to display
-      try:
-        bs = ser.read(1)
-      except:
-        # Restore original window mode
-        if not sys.platform.startswith("win"): # Windows
-          curses.echo()
-          curses.reset_shell_mode()
-        err("\rPort " + port + " broken")
-      if len(bs) != 0:
-        if see_val and ord(bs) != 0x0A:
-          s = format(ord(bs),"02X")
-          stdscr.addch(s[0])
-          stdscr.addch(s[1])
-          stdscr.addch(0x20)
-        else:
-          stdscr.addch(bs)
-        f1.write(str(bs))
-
-  # Restore original window mode
-  if not sys.platform.startswith("win"): # Windows
-    curses.echo()
-    curses.reset_shell_mode()
+  f1.Text("\nTerminal started\n")
+  error = dzterm.Terminal(session.link.ser, f1, see_val).Run()
+  if error is not None:
+    err("\r" + error)
   p("\n")
 
 # ---------------------------------------------------------------------------------------
 
 p("Done.\n")
-if 'ser' in globals():
-  ser.close()
-f1.close() # Close communication log file
+if session is not None:
+  session.Close()
+f1.Close() # Close communication log file
 sys.exit(0)
 
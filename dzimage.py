@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Memory image reader of S19 (S1/S2/S3) and Intel HEX files for dzdl.py"""
+
+# Import statements
+import binascii, hashlib, json, csv, threading
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+MEMSIZE = 65536 # Address space of MC9S08DZ60
+
+# Number of address bytes in S-records
+s_addrlen = {"S0":2, "S1":2, "S2":3, "S3":4, "S5":2, "S6":3, "S7":4, "S8":3, "S9":2}
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class ImageError(Exception):
+  pass
+
+# ---------------------------------------------------------------------------------------
+def NewImage():
+  # Memory content (not used bytes are 0xFF like erased Flash) and usage map
+  # (one byte per address, 1 if address is given by file). Usage map is not a bit array,
+  # because used areas can be searched in it by bytearray.find().
+  return bytearray(b"\xFF" * MEMSIZE), bytearray(MEMSIZE)
+
+def Store(mem, usage, address, data, name, linenum):
+  end = address + len(data)
+  if MEMSIZE < end:
+    raise ImageError(name+":"+str(linenum)+": address "+hex(address)+" is out of "+hex(MEMSIZE)+" memory")
+  mem[address:end] = data
+  usage[address:end] = b"\x01" * len(data)
+
+def Decode(line, name, linenum):
+  try:
+    return binascii.unhexlify(line)
+  except (binascii.Error, ValueError):
+    raise ImageError(name+":"+str(linenum)+": not hexadecimal record")
+
+# ---------------------------------------------------------------------------------------
+def ParseS19(lines, mem, usage, name=""):
+  linenum = 0
+  for line in lines:
+    linenum += 1
+    line = line.strip() # Trim new line characters
+    if 0 == len(line):
+      continue
+    record_type = line[0:2]
+    if record_type not in s_addrlen:
+      raise ImageError(name+":"+str(linenum)+": unknown record type '"+record_type+"'")
+    record = Decode(line[2:], name, linenum) # Count, address, data and checksum
+    if len(record) < 1 or record[0] != len(record)-1:
+      raise ImageError(name+":"+str(linenum)+": record length mismatch")
+    if sum(record) & 0xFF != 0xFF: # Ones' complement of sum of count, address and data
+      raise ImageError(name+":"+str(linenum)+": checksum error")
+    if record_type in ("S1", "S2", "S3"):
+      addrlen = s_addrlen[record_type]
+      if len(record) < 1+addrlen+1:
+        raise ImageError(name+":"+str(linenum)+": record too short")
+      address = int.from_bytes(record[1:1+addrlen], "big")
+      Store(mem, usage, address, record[1+addrlen:-1], name, linenum)
+    elif record_type in ("S7", "S8", "S9"): # Termination
+      break
+
+def ParseHex(lines, mem, usage, name=""):
+  linenum = 0
+  base = 0 # Extended segment or linear address
+  for line in lines:
+    linenum += 1
+    line = line.strip() # Trim new line characters
+    if 0 == len(line):
+      continue
+    if line[0] != ":":
+      raise ImageError(name+":"+str(linenum)+": record does not start with ':'")
+    record = Decode(line[1:], name, linenum) # Length, address, type, data and checksum
+    if len(record) < 5 or record[0] != len(record)-5:
+      raise ImageError(name+":"+str(linenum)+": record length mismatch")
+    if sum(record) & 0xFF != 0: # Two's complement of sum of all previous bytes
+      raise ImageError(name+":"+str(linenum)+": checksum error")
+    record_type = record[3]
+    data = record[4:-1]
+    if record_type == 0x00: # Data
+      Store(mem, usage, base + ((record[1] << 8) | record[2]), data, name, linenum)
+    elif record_type == 0x01: # End of file
+      break
+    elif record_type == 0x02: # Extended segment address
+      base = int.from_bytes(data, "big") << 4
+    elif record_type == 0x04: # Extended linear address
+      base = int.from_bytes(data, "big") << 16
+    elif record_type in (0x03, 0x05): # Start address, not used
+      continue
+    else:
+      raise ImageError(name+":"+str(linenum)+": unknown record type "+format(record_type,"02X"))
+
+# ---------------------------------------------------------------------------------------
+def S19Record(record_type, address, data):
+  record = bytes([len(data)+3, address >> 8, address & 0xFF]) + bytes(data)
+  return record_type + binascii.hexlify(record).decode().upper() + format(0xFF - (sum(record) & 0xFF), "02X") + "\n"
+
+def S19Lines(mem, usage, name=b"dzdl", width=32):
+  # Lines of S19 file of used addresses of image (S0 header, S1 data, S9 termination)
+  lines = [S19Record("S0", 0, name)]
+  a = usage.find(1)
+  while a != -1:
+    end = usage.find(0, a)
+    if end == -1:
+      end = len(usage)
+    while a < end:
+      n = min(width, end-a)
+      lines.append(S19Record("S1", a, mem[a:a+n]))
+      a += n
+    a = usage.find(1, end)
+  lines.append(S19Record("S9", 0, b""))
+  return lines
+
+def WriteS19(path, mem, usage, name=b"dzdl", width=32):
+  with open(path, "w") as f:
+    f.writelines(S19Lines(mem, usage, name, width))
+
+def WriteImage(path, mem, usage):
+  # S19 file by extension, otherwise 64k memory image (offset is address, not used bytes are 0xFF)
+  if path.lower().endswith((".s19",".s28",".s37",".srec",".mot")):
+    WriteS19(path, mem, usage)
+  else:
+    with open(path, "wb") as f:
+      f.write(mem)
+
+# ---------------------------------------------------------------------------------------
+def ReadImage(path, mem=None, usage=None):
+  # Read S19 or Intel HEX file into memory image. Format is detected from first character.
+  # Given image is updated, this way more files can be merged.
+  if mem is None:
+    mem, usage = NewImage()
+  try:
+    f = open(path, "r")
+  except OSError as e:
+    raise ImageError("Cannot open "+path+": "+e.strerror)
+  with f:
+    lines = f.readlines()
+  ParseImage(lines, mem, usage, path)
+  return mem, usage
+
+def ParseImage(lines, mem, usage, name=""):
+  # Lines of S19 or Intel HEX file, format is detected from first character
+  first = ""
+  for line in lines:
+    first = line.strip()[0:1]
+    if first:
+      break
+  if first == ":":
+    ParseHex(lines, mem, usage, name)
+  elif first == "S":
+    ParseS19(lines, mem, usage, name)
+  else:
+    raise ImageError(name+": neither S19 nor Intel HEX file")
+
+def ReadImages(paths):
+  # Merge of S19 and HEX files (e.g. bootloader, application, configuration) in order,
+  # content of later file overwrites the earlier one
+  mem, usage = NewImage()
+  for path in paths:
+    ReadImage(path, mem, usage)
+  return mem, usage
+
+def Digest(*paths):
+  # SHA-256 of content of files, key of compiled download plan of the files
+  h = hashlib.sha256()
+  for path in paths:
+    try:
+      with open(path, "rb") as f:
+        h.update(f.read())
+    except OSError as e:
+      raise ImageError("Cannot open "+path+": "+e.strerror)
+  return h.hexdigest()
+
+# ---------------------------------------------------------------------------------------
+def PatchItem(address, data, name):
+  # (address, bytes) of patch from texts like 0x17F8 and 0E or 41424344
+  try:
+    a = int(address, 0)
+    d = binascii.unhexlify(data.strip().replace(" ", ""))
+  except (binascii.Error, ValueError, TypeError, AttributeError):
+    raise ImageError(name+": wrong patch "+str(address)+"="+str(data))
+  if 0 == len(d) or a < 0 or MEMSIZE < a + len(d):
+    raise ImageError(name+": wrong patch "+str(address)+"="+str(data))
+  return a, d
+
+def ParsePatch(spec, name="patch"):
+  # Patch [(address, bytes)] from text like 0x17F8=0E,0x1080=41424344
+  patch = []
+  for item in spec.split(","):
+    if "=" not in item:
+      raise ImageError(name+": wrong patch "+item)
+    address, data = item.split("=", 1)
+    patch.append(PatchItem(address.strip(), data, name))
+  return patch
+
+def ReadUnits(spec):
+  # Unit specific patches as list of (unit name, patch). Spec is a patch text, or a file:
+  #  .json: object {"0x17F8":"0E", ...} or list of such objects, name of unit is its "unit" value
+  #  .csv:  header is unit and addresses, a line is a unit, empty cell is not patched
+  # Patch text and JSON object is one patch for all units (name is empty), lists are one per unit.
+  if not spec.lower().endswith((".json", ".csv")):
+    return [("", ParsePatch(spec))], True
+  try:
+    with open(spec, "r", newline="") as f:
+      if spec.lower().endswith(".json"):
+        content = json.load(f)
+      else:
+        content = list(csv.DictReader(f))
+  except OSError as e:
+    raise ImageError("Cannot open "+spec+": "+e.strerror)
+  except ValueError as e:
+    raise ImageError(spec+": "+str(e))
+  common = isinstance(content, dict)
+  units = []
+  for i, unit in enumerate([content] if common else content):
+    if not isinstance(unit, dict):
+      raise ImageError(spec+": unit "+str(i+1)+" is not an object")
+    name = str(unit.get("unit", i+1))
+    patch = [PatchItem(a, d, spec) for a, d in unit.items() if a != "unit" and d]
+    units.append((name, patch))
+  return units, common
+
+class Units:
+  # Patches of downloaded ECUs: the common patch for every ECU, or the next unit of list.
+  # Sessions of ports share it, so it is locked.
+
+  def __init__(self, units, common=False):
+    self.units = list(units)
+    self.common = common
+    self.lock = threading.Lock()
+
+  def Select(self, name):
+    # Only the unit of name is downloaded, False if there is no such unit
+    self.units = [unit for unit in self.units if unit[0] == name]
+    self.common = False
+    return 0 < len(self.units)
+
+  def Next(self):
+    # (unit name, patch), None if all units are downloaded
+    with self.lock:
+      if 0 == len(self.units):
+        return None
+      if self.common:
+        return self.units[0]
+      return self.units.pop(0)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Binary communication log writer and decoder for dzdl.py"""
+
+# Import statements
+import sys, re, struct, time, threading, atexit
+import queue
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+MAGIC = b"DZLOG\x01"
+
+# Record header: timestamp (s), kind, tag (3 characters), length of data
+RECORD = struct.Struct("<dB3sH")
+
+# Record kinds
+TEXT = 0 # Progress text printed by downloader, UTF-8
+TX = 1   # Frame sent to target
+RX = 2   # Frame received from target
+RAW = 3  # Bytes of terminal, rendered as text
+
+# Log levels
+OFF = 0    # No log at all
+PROGRESS = 1 # Only progress text
+FRAMES = 2 # Progress text and every frame
+levels = {"off":OFF, "text":PROGRESS, "frames":FRAMES}
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class LogWriter:
+  # Records are put into a queue by caller and written into file by a background thread,
+  # so serial communication never waits for disk or text formatting. File is created at
+  # the first record, so nothing is created on level OFF.
+
+  def __init__(self, path, level=FRAMES):
+    self.path = path
+    self.level = level
+    self.f = None
+    self.q = queue.Queue()
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def Put(self, record):
+    with self.lock:
+      if self.thread is None:
+        self.f = open(self.path, "wb")
+        self.f.write(MAGIC)
+        self.thread = threading.Thread(target=self.Writer, daemon=True)
+        self.thread.start()
+        atexit.register(self.Close)
+    self.q.put(record)
+
+  def Writer(self):
+    while True:
+      record = self.q.get()
+      if record is None:
+        break
+      t, kind, tag, data = record
+      if len(data) > 0xFFFF:
+        data = data[:0xFFFF]
+      self.f.write(RECORD.pack(t, kind, tag, len(data)))
+      self.f.write(data)
+    self.f.close()
+
+  def Text(self, s):
+    if PROGRESS <= self.level:
+      self.Put((time.time(), TEXT, b"   ", s.encode("utf-8")))
+
+  def Tx(self, tag, data):
+    if FRAMES <= self.level:
+      self.Put((time.time(), TX, tag.encode("ascii"), bytes(data)))
+
+  def Rx(self, tag, data):
+    if FRAMES <= self.level:
+      self.Put((time.time(), RX, tag.encode("ascii"), bytes(data)))
+
+  def Raw(self, data):
+    if FRAMES <= self.level:
+      self.Put((time.time(), RAW, b"Trm", bytes(data)))
+
+  def Close(self):
+    with self.lock:
+      if self.thread is None:
+        return
+      atexit.unregister(self.Close)
+      if self.thread.is_alive():
+        self.q.put(None)
+        self.thread.join()
+
+def PortSuffix(port):
+  # Part of file name from port name, e.g. ttyUSB0 or COM3
+  if port.startswith("/dev/"):
+    port = port[5:]
+  return re.sub(r"[^0-9A-Za-z]+", "_", port)
+
+def LogName(port):
+  # Log file of a port when more ports are used, e.g. dzdl-ttyUSB0.log or dzdl-COM3.log
+  return "./dzdl-"+PortSuffix(port)+".log"
+
+# ---------------------------------------------------------------------------------------
+def ReadLog(path):
+  # Generator of (timestamp, kind, tag, data) records of a binary log file
+  with open(path, "rb") as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(path+" is not a dzdl binary log")
+    while True:
+      header = f.read(RECORD.size)
+      if len(header) < RECORD.size:
+        break # End of file or truncated last record
+      t, kind, tag, length = RECORD.unpack(header)
+      data = f.read(length)
+      yield t, kind, tag.decode("ascii"), data
+
+def Render(records, out, timestamps=False):
+  # Render records in text format of former dzdl.com. Frames are printed in own line.
+  start = None
+  newline = True # Output is at beginning of line
+  for t, kind, tag, data in records:
+    if start is None:
+      start = t
+    if kind == TEXT or kind == RAW:
+      text = data.decode("utf-8" if kind == TEXT else "latin-1")
+      out.write(text)
+      if 0 < len(text):
+        newline = text.endswith("\n")
+    else:
+      if not newline:
+        out.write("\n")
+      if timestamps:
+        out.write(format(t-start,"10.6f")+" ")
+      out.write(tag+(" Tx: " if kind == TX else " Rx: "))
+      out.write(" ".join(format(byte,"02X") for byte in data)+"\n")
+      newline = True
+
+# ---------------------------------------------------------------------------------------
+def Main(argv):
+  timestamps = False
+  paths = []
+  for arg in argv:
+    if arg in ("-t", "--time"):
+      timestamps = True
+    elif arg in ("-h", "--help"):
+      paths = []
+      break
+    else:
+      paths.append(arg)
+  if 0 == len(paths):
+    sys.stdout.write("dzdl-log - Decode binary communication log of dzdl.py\n")
+    sys.stdout.write("Usage: dzdl-log [-t] dzdl.log\n")
+    sys.stdout.write("  -t   Print time of frames relative to start of log\n")
+    return 1
+  for path in paths:
+    try:
+      Render(ReadLog(path), sys.stdout, timestamps)
+    except (OSError, ValueError) as e:
+      sys.stderr.write("ERROR! "+str(e)+"\n")
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
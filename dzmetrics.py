@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Request/answer timing and metrics export of dzdl.py"""
+
+# Import statements
+import os, time, json, csv, bisect, collections
+import dzplan
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+# Upper limits of latency histogram buckets (ms), last bucket is above the last limit
+buckets = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+# Number of slowest sectors in summary
+slowest = 5
+
+# Start addresses of sectors, to find sector of a request
+sector_starts = [s["sector"] for s in dzplan.Sectors()]
+sector_lens = dict((s["sector"], s["plen"]) for s in dzplan.Sectors())
+
+# Adaptive answer timeout (like TCP retransmission timeout): gains of smoothed device time
+# and of its variation, weight of variation, and margin of scheduling and USB adapter (s)
+rtt_gain = 0.125
+rttvar_gain = 0.25
+rttvar_factor = 4
+timeout_margin = 0.03
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+def SectorOf(address):
+  # Start address of sector of address, None if address is not in a sector (e.g. RAM)
+  if address is None:
+    return None
+  i = bisect.bisect_right(sector_starts, address) - 1
+  if i < 0 or sector_starts[i] + sector_lens[sector_starts[i]] <= address:
+    return None
+  return sector_starts[i]
+
+def Percentile(values, fraction):
+  # Values are sorted
+  if 0 == len(values):
+    return 0
+  return values[min(len(values)-1, int(fraction * len(values)))]
+
+def Histogram(latencies):
+  counts = [0] * (len(buckets) + 1)
+  for latency in latencies:
+    counts[bisect.bisect_left(buckets, latency * 1000)] += 1
+  labels = ["<="+format(b,"g")+"ms" for b in buckets] + [">"+format(buckets[-1],"g")+"ms"]
+  return collections.OrderedDict(zip(labels, counts))
+
+# ---------------------------------------------------------------------------------------
+class Metrics:
+  # Every request/answer pair of a session: service, address, data length, start time,
+  # latency (request sent till answer received), answer code (None: no answer) and bytes
+  # on wire since previous pair. Wire time is estimated from bytes by transport (SCI only).
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.end = None
+    self.requests = []
+    self.tx_mark = 0
+    self.rx_mark = 0
+    self.wire_mark = None # Transport of last pair, to restart byte counting on new link
+    self.wire_bytes = 0
+    self.wire_time = 0.0
+    self.wire_known = True
+
+  def Add(self, link, service, start, code, address=None, length=0):
+    now = time.perf_counter()
+    if link is not self.wire_mark:
+      self.wire_mark = link
+      self.tx_mark = 0
+      self.rx_mark = 0
+    tx = link.tx_bytes - self.tx_mark
+    rx = link.rx_bytes - self.rx_mark
+    self.tx_mark = link.tx_bytes
+    self.rx_mark = link.rx_bytes
+    wire = link.WireTime(tx + rx)
+    if wire is None:
+      self.wire_known = False
+    else:
+      self.wire_time += wire
+    self.wire_bytes += tx + rx
+    self.requests.append({"service":service, "sector":SectorOf(address), "address":address, "length":length,
+      "start":start - self.start, "latency":now - start, "code":code, "tx":tx, "rx":rx, "wire":wire})
+
+  def Finish(self):
+    if self.end is None:
+      self.end = time.perf_counter()
+
+  # -------------------------------------------------------------------------------------
+  def Services(self):
+    services = collections.OrderedDict()
+    for r in self.requests:
+      services.setdefault(r["service"], []).append(r)
+    result = collections.OrderedDict()
+    for service, requests in services.items():
+      latencies = sorted(r["latency"] for r in requests)
+      result[service] = collections.OrderedDict([
+        ("count", len(requests)),
+        ("failed", sum(1 for r in requests if r["code"] != 0)),
+        ("total", sum(latencies)),
+        ("mean", sum(latencies) / len(latencies)),
+        ("min", latencies[0]),
+        ("p50", Percentile(latencies, 0.5)),
+        ("p95", Percentile(latencies, 0.95)),
+        ("max", latencies[-1]),
+        ("histogram", Histogram(latencies))])
+    return result
+
+  def Sectors(self):
+    sectors = collections.OrderedDict()
+    for r in self.requests:
+      if r["sector"] is None or r["service"] not in ("erase", "write", "read"):
+        continue
+      s = sectors.setdefault(r["sector"], collections.OrderedDict([("sector", r["sector"]),
+        ("time", 0.0), ("erase", 0.0), ("write", 0.0), ("read", 0.0), ("frames", 0), ("bytes", 0), ("retries", 0)]))
+      s["time"] += r["latency"]
+      s[r["service"]] += r["latency"]
+      s["frames"] += 1
+      if r["code"] == 0 and r["service"] == "write":
+        s["bytes"] += r["length"]
+      if r["code"] != 0:
+        s["retries"] += 1
+    return list(sectors.values())
+
+  def Summary(self):
+    self.Finish()
+    total = self.end - self.start
+    waited = sum(r["latency"] for r in self.requests)
+    written = sum(r["length"] for r in self.requests if r["service"] == "write" and r["code"] == 0)
+    read = sum(r["length"] for r in self.requests if r["service"] == "read" and r["code"] == 0)
+    summary = collections.OrderedDict([
+      ("time", total),
+      ("requests", len(self.requests)),
+      ("written", written),
+      ("read", read),
+      ("throughput", (written + read) / total if 0 < total else 0),
+      ("retries", sum(1 for r in self.requests if r["service"] in ("write", "read") and r["code"] != 0)),
+      ("wire_bytes", self.wire_bytes),
+      ("wait", waited), # Request sent till answer: wire and device
+      ("host", total - waited)]) # Time not waiting for an answer
+    if self.wire_known:
+      summary["wire"] = self.wire_time
+      summary["device"] = max(0.0, waited - self.wire_time) # Flash programming and bootloader
+    summary["slowest_sectors"] = [collections.OrderedDict([("sector", s["sector"]), ("time", s["time"])])
+      for s in sorted(self.Sectors(), key=lambda s: -s["time"])[:slowest]]
+    return summary
+
+  def Text(self):
+    # End of run summary for console
+    s = self.Summary()
+    text = "Metrics: "+str(s["written"]+s["read"])+" bytes in "+format(s["time"],".2f")+" s, "+format(s["throughput"],".0f")+" B/s"
+    if "wire" in s:
+      text += ", wire "+format(s["wire"],".2f")+" s, device "+format(s["device"],".2f")+" s"
+    else:
+      text += ", wire and device "+format(s["wait"],".2f")+" s"
+    text += ", host "+format(s["host"],".2f")+" s, "+str(s["retries"])+" retries\n"
+    for name, service in self.Services().items():
+      text += "  "+format(name,"<12")+format(service["count"],">5")+" x  mean "+format(service["mean"]*1000,">8.1f")+" ms  p95 "+format(service["p95"]*1000,">8.1f")+" ms  max "+format(service["max"]*1000,">8.1f")+" ms\n"
+    if 0 < len(s["slowest_sectors"]):
+      text += "  Slowest sectors: "+", ".join(hex(x["sector"])+" "+format(x["time"],".3f")+" s" for x in s["slowest_sectors"])+"\n"
+    return text
+
+  def Write(self, path):
+    # CSV file has one line per request/answer pair, JSON has summary, services and sectors too
+    self.Finish()
+    if path.lower().endswith(".csv"):
+      with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["service", "sector", "address", "length", "start", "latency", "code", "tx", "rx", "wire"])
+        for r in self.requests:
+          w.writerow([r["service"], "" if r["sector"] is None else hex(r["sector"]), "" if r["address"] is None else hex(r["address"]),
+            r["length"], format(r["start"],".6f"), format(r["latency"],".6f"), "" if r["code"] is None else r["code"],
+            r["tx"], r["rx"], "" if r["wire"] is None else format(r["wire"],".6f")])
+    else:
+      with open(path, "w") as f:
+        json.dump(collections.OrderedDict([("summary", self.Summary()), ("services", self.Services()),
+          ("sectors", self.Sectors()), ("requests", self.requests)]), f, indent=1)
+
+# ---------------------------------------------------------------------------------------
+class Timeouts:
+  # Answer timeout of a request is wire time of request and answer at baud rate plus
+  # smoothed device time (latency without wire time) of service and 4 times its variation.
+  # Estimates are per port, ECU and service, they are kept in file between runs.
+  # Without estimate, and after a lost answer (doubled), timeout is limit.
+
+  def __init__(self, limit, path=None, port=""):
+    self.limit = limit
+    self.path = path
+    self.port = port
+    self.estimates = {} # "port ecuid": {service: [device time, variation]}
+    self.backoff = {} # (ecuid, service): factor after lost answers
+    if path is not None and os.path.exists(path):
+      try:
+        with open(path) as f:
+          self.estimates = json.load(f)
+      except (OSError, ValueError):
+        self.estimates = {} # Estimates are learned again
+
+  def Key(self, ecuid):
+    return self.port+" "+str(ecuid)
+
+  def Timeout(self, link, ecuid, service, size):
+    # Timeout (s) of answer of request, size is number of bytes of request and answer on wire
+    estimate = self.estimates.get(self.Key(ecuid), {}).get(service)
+    if estimate is None:
+      return self.limit
+    timeout = (link.WireTime(size) or 0) + estimate[0] + rttvar_factor * estimate[1] + timeout_margin
+    return min(self.limit, timeout * self.backoff.get((ecuid, service), 1))
+
+  def Sample(self, link, ecuid, service, size, latency):
+    # Latency of a received answer updates estimate of service
+    device = max(0.0, latency - (link.WireTime(size) or 0))
+    estimates = self.estimates.setdefault(self.Key(ecuid), {})
+    estimate = estimates.get(service)
+    if estimate is None:
+      estimates[service] = [device, device / 2]
+    else:
+      estimate[1] += rttvar_gain * (abs(device - estimate[0]) - estimate[1])
+      estimate[0] += rtt_gain * (device - estimate[0])
+    self.backoff.pop((ecuid, service), None)
+
+  def Lost(self, ecuid, service):
+    # Answer did not arrive in timeout, next timeouts of service are doubled till an answer
+    self.backoff[(ecuid, service)] = 2 * self.backoff.get((ecuid, service), 1)
+
+  def Save(self):
+    # Estimates of other ports in file are kept
+    if self.path is None or 0 == len(self.estimates):
+      return
+    estimates = {}
+    if os.path.exists(self.path):
+      try:
+        with open(self.path) as f:
+          estimates = json.load(f)
+      except (OSError, ValueError):
+        pass
+    for key, services in self.estimates.items():
+      if key.startswith(self.port+" "):
+        estimates[key] = services
+    with open(self.path, "w") as f:
+      json.dump(estimates, f, indent=1, sort_keys=True)
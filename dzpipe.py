@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Offline benchmark and golden regression of host side download pipeline of dzdl.py"""
+
+# Import statements
+import os, sys, getopt, time, json, hashlib, random, subprocess, tempfile, tracemalloc, binascii
+import dzimage
+import dzplan
+import dztransport
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+here = os.path.dirname(os.path.abspath(__file__))
+golden_file = os.path.join(here, "dzpipe.json")
+files = ["app.s19", "prg.s19"]
+
+# Timing is the best of this many runs
+repeat = 5
+
+# Synthetic images: large (all Flash and EEPROM), sparse (one byte in every 0x61), worst
+# (short runs with gaps around frame overhead, planner has the most choices) and EEPROM
+synthetic = ["large", "sparse", "worst", "eeprom"]
+
+# Malformed input: name and lines, parser shall refuse them with the golden message
+malformed = [
+  ("bad-type", ["SA0300FC\n"]),
+  ("bad-hex", ["S1050000ZZFF00\n"]),
+  ("bad-length", ["S1060000FFFF\n"]),
+  ("bad-checksum", ["S1050000FFFF00\n"]),
+  ("short", ["S10200FD\n"]),
+  ("out-of-memory", ["S2060100000102F5\n"]),
+  ("hex-start", [":0100000001FE\n", "0100000001FE\n"]),
+  ("hex-length", [":02000000AA55\n"]),
+  ("hex-type", [":0100000701F7\n"]),
+  ("not-image", ["This is not an image\n"]),
+]
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+def HexLines(mem, usage, width=16):
+  # Lines of Intel HEX file of used addresses of image, to measure HEX parser too
+  lines = []
+  a = usage.find(1)
+  while a != -1:
+    end = usage.find(0, a)
+    if end == -1:
+      end = len(usage)
+    while a < end:
+      n = min(width, end-a)
+      record = bytes([n, a >> 8, a & 0xFF, 0]) + bytes(mem[a:a+n])
+      lines.append(":" + binascii.hexlify(record).decode().upper() + format(-sum(record) & 0xFF, "02X") + "\n")
+      a += n
+    a = usage.find(1, end)
+  lines.append(":00000001FF\n")
+  return lines
+
+def Synthetic(name):
+  # S19 lines of a synthetic image, content is the same in every run
+  rnd = random.Random(name)
+  mem, usage = dzimage.NewImage()
+  used = []
+  if name == "large":
+    used = [(0x1080, 0x1300), (0x1400, 0x1800), (0x1900, 0xF400), (0xFD00, 0xFF9F), (0xFFC0, 0x10000)]
+  elif name == "sparse":
+    used = [(a, a+1) for a in range(0x1900, 0xF400, 0x61)]
+  elif name == "worst":
+    a = 0x1400
+    while a < 0xF400:
+      n = rnd.randint(1, 3)
+      used.append((a, min(a+n, 0xF400)))
+      a += n + rnd.randint(dzplan.write_overhead-4, dzplan.write_overhead+4)
+      if 0x1800 <= a < 0x1900:
+        a = 0x1900
+  elif name == "eeprom":
+    used = [(0x1400, 0x17E0)]
+  for start, end in used:
+    mem[start:end] = bytes(rnd.getrandbits(8) for i in range(end-start))
+    usage[start:end] = b"\x01" * (end-start)
+  return dzimage.S19Lines(mem, usage)
+
+def Cases(paths):
+  # (name, lines) of all cases: files, HEX version of first file, synthetic and malformed images
+  cases = []
+  for path in paths:
+    with open(path, "r") as f:
+      cases.append((os.path.basename(path), f.readlines()))
+  if 0 < len(cases):
+    mem, usage = dzimage.NewImage()
+    dzimage.ParseImage(cases[0][1], mem, usage)
+    cases.append((os.path.splitext(cases[0][0])[0]+".hex", HexLines(mem, usage)))
+  for name in synthetic:
+    cases.append((name, Synthetic(name)))
+  for name, lines in malformed:
+    cases.append((name, lines))
+  return cases
+
+# ---------------------------------------------------------------------------------------
+def Pipeline(name, lines):
+  # Parse, plan and compile like dzdl.py, returns image, sectors and time of stages (s)
+  times = []
+  start = time.perf_counter()
+  mem, usage = dzimage.NewImage()
+  dzimage.ParseImage(lines, mem, usage, name)
+  times.append(time.perf_counter() - start)
+  start = time.perf_counter()
+  sectors = dzplan.Plan(dzplan.Sectors(), mem, usage, dzplan.assumed_frame)
+  times.append(time.perf_counter() - start)
+  start = time.perf_counter()
+  dzplan.Compile(sectors, dzplan.assumed_frame, dztransport.WRITE_BODY)
+  times.append(time.perf_counter() - start)
+  return mem, usage, sectors, times
+
+def Result(usage, sectors):
+  # Comparable result of pipeline: areas of sectors, wire cost and hash of frame byte stream
+  result = {"used":usage.count(1), "sectors":[[s["sector"], s["plen"], [[a["start"], a["len"]] for a in s["areas"]]] for s in sectors]}
+  result["wire"] = list(dzplan.WireCost(sectors, dzplan.assumed_frame))
+  result["frames"] = {}
+  for proto in sorted(dztransport.WRITE_BODY):
+    h = hashlib.sha256()
+    count = 0
+    for s in sectors:
+      for frame in s["frames"][proto]:
+        h.update(bytes([frame["start"] >> 8, frame["start"] & 0xFF, frame["len"]]))
+        h.update(frame["body"])
+        count += 1
+    result["frames"][proto] = [count, h.hexdigest()]
+  return result
+
+def Run(name, lines, runs):
+  # Result, best time of stages and peak memory (bytes) of a case
+  try:
+    times = None
+    for i in range(runs):
+      mem, usage, sectors, t = Pipeline(name, lines)
+      times = t if times is None else [min(a, b) for a, b in zip(times, t)]
+    tracemalloc.start()
+    Pipeline(name, lines)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  except (dzimage.ImageError, dzplan.PlanError) as e:
+    if tracemalloc.is_tracing():
+      tracemalloc.stop()
+    return {"error":str(e)}, None, None
+  return Result(usage, sectors), times, peak
+
+def PrintSectors(path):
+  # Lines of debug port printsectors of dzdl.py. It runs in a temporary directory,
+  # because dzdl.py writes its log into current directory.
+  with tempfile.TemporaryDirectory() as tmp:
+    out = subprocess.run([sys.executable, os.path.join(here, "dzdl.py"), "-p", "printsectors", "-f", os.path.abspath(path)],
+      cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+  return {"lines":[line for line in out.splitlines() if line.startswith(("Sector ", " Area "))]}
+
+def Difference(golden, result):
+  # First difference of result from golden, as text
+  if golden.get("error") != result.get("error"):
+    return "error "+repr(result.get("error"))+", golden "+repr(golden.get("error"))
+  for key in ("used", "wire", "lines"):
+    if golden.get(key) != result.get(key):
+      return key+" "+str(result.get(key))+", golden "+str(golden.get(key))
+  for g, r in zip(golden.get("sectors", []), result.get("sectors", [])):
+    if g != r:
+      return "sector "+hex(g[0])+" "+str(r)+", golden "+str(g)
+  if len(golden.get("sectors", [])) != len(result.get("sectors", [])):
+    return "number of sectors "+str(len(result["sectors"]))+", golden "+str(len(golden["sectors"]))
+  for proto in golden.get("frames", {}):
+    if golden["frames"][proto] != result["frames"].get(proto):
+      return proto+" frames "+str(result["frames"].get(proto))+", golden "+str(golden["frames"][proto])
+  return ""
+
+def Verdict(golden, result):
+  if golden is None:
+    return "NEW"
+  difference = Difference(golden, result)
+  return "FAIL "+difference if difference else "PASS"
+
+def Row(name, columns, verdict):
+  # Line of result table, one long column (error or printsectors) spans all columns
+  if 1 == len(columns):
+    text = "  "+columns[0][:66]
+    text += " " * (68-len(text))
+  else:
+    text = "".join(format(c,">"+str(w)) for c, w in zip(columns, [7, 8, 7, 10, 10, 10, 8]))
+  sys.stdout.write(format(name,"<14")+text+"  "+verdict+"\n")
+
+# ---------------------------------------------------------------------------------------
+def PrintHelp():
+  p = sys.stdout.write
+  p("dzpipe.py - Offline benchmark and golden regression of download pipeline of dzdl.py\n")
+  p("Usage: dzpipe.py [options] [file.s19 ...]   (default app.s19 prg.s19)\n")
+  p("Cases are the files, HEX version of first file, synthetic images ("+", ".join(synthetic)+"),\n")
+  p("malformed input and printsectors port of dzdl.py. Parse, plan and compile time is the best of runs,\n")
+  p("peak is the peak of allocated memory. Plans (areas, wire cost) and frame bytes of SCI and CAN\n")
+  p("are compared with golden file, exit code is 1 if any differs.\n")
+  p("  -r runs      Number of runs of timing (default "+str(repeat)+")\n")
+  p("  -g file      Golden file (default dzpipe.json)\n")
+  p("  -u           Update golden file with results of this run\n")
+  p("  -h           Print out this HELP text\n")
+
+def Main(argv):
+  try:
+    opts, args = getopt.getopt(argv, "r:g:uh", ["runs=", "golden=", "update", "help"])
+  except getopt.GetoptError as e:
+    sys.stderr.write("ERROR! "+str(e)+"\n")
+    return 1
+  runs = repeat
+  path = golden_file
+  update = False
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      PrintHelp()
+      return 0
+    elif opt in ("-r", "--runs"): runs = max(1, int(arg))
+    elif opt in ("-g", "--golden"): path = arg
+    elif opt in ("-u", "--update"): update = True
+  paths = args if 0 < len(args) else [os.path.join(here, f) for f in files]
+
+  golden = {}
+  if os.path.exists(path):
+    with open(path) as f:
+      golden = json.load(f)
+  try:
+    cases = Cases(paths)
+  except (OSError, dzimage.ImageError) as e:
+    sys.stderr.write("ERROR! "+str(e)+"\n")
+    return 1
+
+  p = sys.stdout.write
+  Row("Case", ["Bytes", "Sectors", "Frames", "Parse", "Plan", "Compile", "Peak"], "Result")
+  results = {}
+  failed = 0
+  new = 0
+  for name, lines in cases:
+    result, times, peak = Run(name, lines, runs)
+    results[name] = result
+    verdict = Verdict(golden.get(name), result)
+    failed += verdict.startswith("FAIL")
+    new += verdict == "NEW"
+    if times is None:
+      Row(name, [result["error"]], verdict)
+    else:
+      Row(name, [str(result["used"]), str(len(result["sectors"])), str(result["frames"]["sci"][0])]
+        + [format(t*1000,".2f")+"ms" for t in times] + [format(peak/1024,".0f")+"kB"], verdict)
+  if 0 < len(paths):
+    name = "printsectors"
+    results[name] = PrintSectors(paths[0])
+    verdict = Verdict(golden.get(name), results[name])
+    failed += verdict.startswith("FAIL")
+    new += verdict == "NEW"
+    Row(name, [str(len(results[name]["lines"]))+" lines of "+os.path.basename(paths[0])], verdict)
+
+  if update:
+    golden.update(results)
+    with open(path, "w") as f:
+      # One case per line, so changes of cases are seen by diff
+      f.write("{\n"+",\n".join(json.dumps(name)+": "+json.dumps(golden[name], separators=(",",":"), sort_keys=True) for name in sorted(golden))+"\n}\n")
+    p("Golden file "+path+" is updated.\n")
+    return 0
+  if 0 < failed:
+    p(str(failed)+" of "+str(len(results))+" cases differ from golden file.\n")
+  elif 0 < new:
+    p(str(new)+" cases are not in golden file, add them by -u.\n")
+  else:
+    p("All cases match golden file.\n")
+  return 1 if failed else 0
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
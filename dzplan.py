@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Download planner of MC9S08DZ60 memory sectors for dzdl.py"""
+
+# Import statements
+import heapq, bisect, hashlib, json, struct
+import dzimage
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+# One SCI write frame has 10 bytes beside data (header 5, address 2, length, timeout
+# and checksum) and its answer is 6 bytes long. Erase is 7 bytes and 6 bytes answer.
+# (CAN needs similar amout of bytes)
+write_overhead = 10+6
+erase_cost = 7+6
+
+# Write frame length of current bootloader. Download is planned with this length until
+# the real one is probed from bootloader.
+assumed_frame = 127
+
+# Plan file: magic, length of JSON description, JSON, then memory of sectors and frame bodies
+PLAN_MAGIC = b"DZPLAN1\n"
+PLAN_LENGTH = struct.Struct(">I")
+
+# Manifest of programmed sectors at the end of application identification sector: magic,
+# number of sectors, fingerprint (0x17F0) of the download which wrote it, then index of
+# sector in memory map and first 4 bytes of SHA-256 of sector content per sector, finally
+# first 4 bytes of SHA-256 of fingerprint and entries
+MANIFEST = 0x1100
+MANIFEST_END = 0x1300
+MANIFEST_MAGIC = b"DZM2"
+MANIFEST_FINGERPRINT = 8
+MANIFEST_ENTRY = 5
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class PlanError(Exception):
+  pass
+
+# ---------------------------------------------------------------------------------------
+def Sectors():
+  # Build memory map of MC9S08DZ60 in sectors. This is a list of dictionary (c struct array)
+  #  Property sector and len depends on bootloader, start and length depends on used range in sector.
+  sectors =        [{"sector":0x1080, "plen":0x280, "used":False, "areas":[] }] # application identification
+  sectors.append(   {"sector":0x1300, "plen":0x100, "used":False, "areas":[] }) # bootloader and hardware identification
+  for s in range(0x1400,0x1800,0x8): # EEPROM in 8 byte mode
+    sectors.append({"sector":s, "plen":0x8, "used":False, "areas":[] })
+  for s in range(0x1900,0xF400,0x300): # Application Flash
+    sectors.append({"sector":s, "plen":0x300, "used":False, "areas":[] })
+  sectors.append({"sector":0xFD00, "plen":0x300, "used":False, "areas":[] }) # Last vector sector
+  return sectors
+
+# Memory map to find sector of an address
+sector_map = Sectors()
+sector_starts = [s["sector"] for s in sector_map]
+
+# ---------------------------------------------------------------------------------------
+def FindRuns(usage, start, end):
+  # List of (start, end) of consecutive used addresses in range
+  runs = []
+  a = usage.find(1, start, end)
+  while a != -1:
+    b = usage.find(0, a, end)
+    if b == -1:
+      b = end
+    runs.append((a, b))
+    a = usage.find(1, b, end)
+  return runs
+
+def SpanCost(length, max_frame):
+  frames = (length + max_frame - 1) // max_frame
+  return frames * write_overhead + length
+
+def PlanSector(sector, mem, usage, max_frame):
+  # Choose write frames to have minimal bytes on wire. Cost of a frame is its overhead
+  # plus its length, gaps inside a frame are written with their 0xFF content.
+  # A frame starts at first not yet covered used address and ends at end of a used
+  # run or at max_frame length. best[p] is the cheapest way to cover used addresses below p.
+  end = sector["sector"] + sector["plen"]
+  runs = FindRuns(usage, sector["sector"], end)
+  areas = []
+  if 0 < len(runs):
+    best = {sector["sector"]:(0, None, None)} # cost, previous position, frame start
+    positions = [sector["sector"]] # Heap, frames go only forward so positions are processed in order
+    done = runs[-1][1]
+    k = 0 # Index of run which contains next frame start
+    while 0 < len(positions):
+      p = heapq.heappop(positions)
+      if p == done:
+        break
+      cost = best[p][0]
+      start = usage.find(1, p, end)
+      while runs[k][1] <= start:
+        k += 1
+      limit = min(start + max_frame, end)
+      r = k
+      while r < len(runs) and runs[r][0] < limit:
+        e = min(runs[r][1], limit)
+        c = cost + write_overhead + e - start
+        if e not in best:
+          heapq.heappush(positions, e)
+          best[e] = (c, p, start)
+        elif c < best[e][0]:
+          best[e] = (c, p, start)
+        r += 1
+    # Collect frames backwards. Frames are merged into one area while previous frame
+    # is full, this way area is split into the same frames by downloader.
+    e = done
+    while e != sector["sector"]:
+      cost, p, start = best[e]
+      if 0 < len(areas) and areas[0]["start"] == e and e - start == max_frame:
+        areas[0]["len"] += areas[0]["start"] - start
+        areas[0]["start"] = start
+      else:
+        areas.insert(0, {"start":start, "len":e-start })
+      e = p
+    for area in areas:
+      area["data"] = bytes(mem[area["start"]:area["start"]+area["len"]])
+  sector["areas"] = areas
+  sector["used"] = 0 < len(areas)
+  return sector
+
+def Plan(sectors, mem, usage, max_frame):
+  # Fill memory map data from image and delete not used sectors from list
+  for s in sectors:
+    PlanSector(s, mem, usage, max_frame)
+  sectors[:] = [s for s in sectors if s["used"]]
+  return sectors
+
+def WireCost(sectors, max_frame):
+  # Number of frames and bytes on wire (both directions) to erase and download sectors
+  frames = 0
+  wire = 0
+  for s in sectors:
+    frames += 1
+    wire += erase_cost
+    for area in s["areas"]:
+      frames += (area["len"] + max_frame - 1) // max_frame
+      wire += SpanCost(area["len"], max_frame)
+  return frames, wire
+
+# ---------------------------------------------------------------------------------------
+def Frames(sector, max_frame):
+  # (start, length) of write frames of sector, areas are split at max_frame
+  frames = []
+  for area in sector["areas"]:
+    a = area["start"]
+    l = area["len"]
+    while 0 < l:
+      n = min(l, max_frame)
+      frames.append((a, n))
+      a += n
+      l -= n
+  return frames
+
+def Data(sector, address, length):
+  # Data of a write frame, frames do not cross areas
+  for area in sector["areas"]:
+    if area["start"] <= address < area["start"]+area["len"]:
+      i = address - area["start"]
+      return area["data"][i:i+length]
+  raise PlanError("Address "+hex(address)+" is not planned")
+
+def CompileSector(sector, max_frame, body):
+  # Ready to send write frames of sector: {start, len, body}, body is the serialized request
+  # after IDs built by body(address, data), see dztransport.WRITE_BODY
+  return Compile([dict(sector)], max_frame, {"": body})[0]["frames"][""]
+
+def Compile(sectors, max_frame, bodies):
+  # Serialize write frames of sectors for every protocol of bodies {proto: body function}
+  # into one contiguous buffer. Frames are sector["frames"][proto], bodies are memoryview
+  # slices of the buffer, so frames are not built or copied while link is live.
+  buff = bytearray()
+  index = [] # Frame list, start, length, offset and size of body
+  for s in sectors:
+    s["frames"] = {}
+    for proto, body in bodies.items():
+      frames = s["frames"][proto] = []
+      for a, n in Frames(s, max_frame):
+        b = body(a, Data(s, a, n))
+        index.append((frames, a, n, len(buff), len(b)))
+        buff += b
+  view = memoryview(bytes(buff))
+  for frames, a, n, o, l in index:
+    frames.append({"start":a, "len":n, "body":view[o:o+l]})
+  return sectors
+
+def Patch(sectors, mem, usage, patch, max_frame, bodies):
+  # Copy of image and compiled plan with patch [(address, data)] applied. Only the sectors
+  # touched by patch are planned and compiled again, others are shared with the original.
+  mem = bytearray(mem)
+  usage = bytearray(usage)
+  touched = set()
+  for address, data in patch:
+    end = address + len(data)
+    a = address
+    while a < end:
+      i = bisect.bisect_right(sector_starts, a) - 1
+      if i < 0 or sector_starts[i] + sector_map[i]["plen"] <= a:
+        raise PlanError("Address "+hex(a)+" is not in a downloadable sector")
+      touched.add(i)
+      a = sector_starts[i] + sector_map[i]["plen"]
+    mem[address:end] = data
+    usage[address:end] = b"\x01" * len(data)
+  planned = dict((s["sector"], s) for s in sectors)
+  for i in touched:
+    s = PlanSector(dict(sector_map[i]), mem, usage, max_frame)
+    s["frames"] = dict((proto, CompileSector(s, max_frame, body)) for proto, body in bodies.items())
+    planned[s["sector"]] = s
+  return [planned[a] for a in sorted(planned)], mem, usage
+
+# ---------------------------------------------------------------------------------------
+def SectorHash(sector, mem):
+  # Hash of sector content as programmed (not used bytes are 0xFF), without manifest area
+  start = sector["sector"]
+  data = bytearray(mem[start:start+sector["plen"]])
+  if start < MANIFEST_END and MANIFEST < start + sector["plen"]:
+    data[MANIFEST-start:MANIFEST_END-start] = b"\xFF" * (MANIFEST_END-MANIFEST)
+  return hashlib.sha256(data).digest()[:4]
+
+def Manifest(sectors, mem, usage, fingerprint=bytes(MANIFEST_FINGERPRINT)):
+  # Manifest bytes and {sector: hash} of planned sectors, fingerprint is of the download
+  if usage.find(1, MANIFEST, MANIFEST_END) != -1:
+    raise PlanError("Image uses manifest area "+hex(MANIFEST)+" - "+hex(MANIFEST_END-1))
+  hashes = {}
+  entries = bytearray()
+  for s in sectors:
+    hashes[s["sector"]] = SectorHash(s, mem)
+    entries += bytes([bisect.bisect_left(sector_starts, s["sector"])]) + hashes[s["sector"]]
+  body = bytes(fingerprint) + entries
+  manifest = MANIFEST_MAGIC + bytes([len(sectors)]) + body + hashlib.sha256(body).digest()[:4]
+  if MANIFEST_END - MANIFEST < len(manifest):
+    raise PlanError("Too many sectors ("+str(len(sectors))+") for manifest")
+  return manifest, hashes
+
+def ManifestLength(head):
+  # Length of manifest from its first 5 bytes, 0 if there is no manifest
+  length = 9 + MANIFEST_FINGERPRINT + head[4] * MANIFEST_ENTRY
+  if head[:4] != MANIFEST_MAGIC or MANIFEST_END - MANIFEST < length:
+    return 0
+  return length
+
+def ParseManifest(manifest):
+  # ({sector: hash}, fingerprint) of manifest read from device, None if it is broken
+  body = bytes(manifest[5:-4])
+  if hashlib.sha256(body).digest()[:4] != manifest[-4:]:
+    return None
+  fingerprint = body[:MANIFEST_FINGERPRINT]
+  entries = body[MANIFEST_FINGERPRINT:]
+  hashes = {}
+  for i in range(0, len(entries), MANIFEST_ENTRY):
+    if len(sector_starts) <= entries[i]:
+      return None
+    hashes[sector_starts[entries[i]]] = bytes(entries[i+1:i+MANIFEST_ENTRY])
+  return hashes, fingerprint
+
+# ---------------------------------------------------------------------------------------
+def SavePlan(path, sectors, max_frame, digest, mem, usage):
+  # Compiled plan into file: description (sectors, areas, used runs, frames) in JSON,
+  # memory content of sectors and frame bodies in binary after it. Image can be rebuilt
+  # from it, so differential download and re-planning work without the S19 file.
+  blob = bytearray()
+  desc = []
+  for s in sectors:
+    end = s["sector"] + s["plen"]
+    d = {"sector":s["sector"], "plen":s["plen"], "memory":len(blob), "runs":FindRuns(usage, s["sector"], end),
+      "areas":[[a["start"], a["len"]] for a in s["areas"]], "frames":{}}
+    blob += mem[s["sector"]:end]
+    for proto, frames in s.get("frames", {}).items():
+      d["frames"][proto] = []
+      for f in frames:
+        d["frames"][proto].append([f["start"], f["len"], len(blob), len(f["body"])])
+        blob += f["body"]
+    desc.append(d)
+  head = json.dumps({"hash":digest, "frame":max_frame, "sectors":desc}, separators=(",",":")).encode()
+  with open(path, "wb") as f:
+    f.write(PLAN_MAGIC + PLAN_LENGTH.pack(len(head)) + head)
+    f.write(blob)
+
+def LoadPlan(path):
+  # Returns image hash, frame length, compiled sectors, memory and usage of a plan file.
+  # File is read at once, frame bodies are slices of it.
+  with open(path, "rb") as f:
+    raw = f.read()
+  try:
+    if not raw.startswith(PLAN_MAGIC):
+      raise ValueError
+    i = len(PLAN_MAGIC) + PLAN_LENGTH.size
+    length = PLAN_LENGTH.unpack_from(raw, len(PLAN_MAGIC))[0]
+    head = json.loads(raw[i:i+length].decode())
+    blob = memoryview(raw)[i+length:]
+    mem, usage = dzimage.NewImage()
+    sectors = []
+    for d in head["sectors"]:
+      start = d["sector"]
+      m = d["memory"]
+      if len(blob) < m + d["plen"]:
+        raise ValueError
+      mem[start:start+d["plen"]] = blob[m:m+d["plen"]]
+      for a, b in d["runs"]:
+        usage[a:b] = b"\x01" * (b-a)
+      sector = {"sector":start, "plen":d["plen"], "used":True,
+        "areas":[{"start":a, "len":n, "data":bytes(mem[a:a+n])} for a, n in d["areas"]], "frames":{}}
+      for proto, frames in d["frames"].items():
+        sector["frames"][proto] = [{"start":a, "len":n, "body":blob[o:o+l]} for a, n, o, l in frames]
+        if 0 < len(frames) and len(blob) < frames[-1][2] + frames[-1][3]:
+          raise ValueError
+      sectors.append(sector)
+    return head["hash"], head["frame"], sectors, mem, usage
+  except (ValueError, KeyError, TypeError, struct.error):
+    raise PlanError(path+" is not a valid plan file")
@@ -0,0 +1,1091 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Bootloader session of one MC9S08DZ60 target on one port (serial or CAN) for dzdl.py"""
+
+# Import statements
+import os, time, threading, struct, hashlib
+import serial
+import dzplan
+import dztransport
+import dzmetrics
+import dzimage
+from datetime import datetime
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+# Console output of finished lines is flushed at most once in this period (s)
+flush_period = 0.1
+
+# ECU ID which means: find IDs by scan of network
+AUTO_ID = 256
+BROADCAST_ID = 0xFF
+
+# Scan network request is repeated in this period during this time window (s). Repeat catches
+# ECUs which were running application at first request (break resets them into bootloader).
+scan_period = 0.1
+scan_time = 1.0
+
+# Longest blocking wait for answers, abort and quit key are checked in this period (s)
+wait_slice = 0.1
+
+# Longest wait for answer of a request (s). Timeout of a service is adapted to its measured
+# latency and baud rate after its first answer, see dzmetrics.Timeouts.
+answer_timeout = 1.0
+
+# Bytes of a request beside its data (header and DLC) and of a one byte answer on SCI wire
+request_overhead = 5
+answer_length = 6
+
+# EEPROM sector of SCI baud rate divisor of bootloader (Baudrate = 1 Mbaud / divisor)
+EESCIBAUD = 0x17E0
+
+# EEPROM sector of ECU ID, bootloader answers from this ID
+EEECUID = 0x17F8
+
+# EEPROM sector of download fingerprint: 6 bytes of downloader, update counter and checksum
+FINGERPRINT = 0x17F0
+
+# Turbo baud: connection deadline after reset (s) and number of checksum errors which
+# cause fall back to original baud rate
+turbo_connect_time = 2.0
+turbo_max_errors = 3
+
+# Memory of read out without RAM and registers: application identification, EEPROM and Flash
+read_ranges = [(0x1080, 0x1800), (0x1900, 0x10000)]
+
+# Read out progress record: address, length, then data
+PART_RECORD = struct.Struct(">HB")
+
+# Serial number of ECU in bootloader, it identifies ECU in checkpoint of download
+SERIAL_NUMBER = 0xFCF8
+
+# Reset vector of application, moved here by bootloader at erase of vector sector
+APP_VECTOR = 0xFFA0
+
+# Deadline of resynchronisation after a lost or broken answer (s). It is longer than byte
+# timeout of bootloader (about 1 s), which ends a broken request by timeout answer.
+resync_time = 2.5
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class SessionError(Exception):
+  pass
+
+class UserAbort(SessionError):
+  pass
+
+class LinkError(SessionError):
+  pass
+
+# ---------------------------------------------------------------------------------------
+def h(byte,f = "02X"):
+  return("$"+format(byte,f))
+
+def BCD(string2): # Convert decimal to BCD, e.g. from 10 to 0x10
+  return (int(string2[0], 16)*16) + int(string2[1], 16)
+
+def getaddinfo(s):
+  addinfo = ""
+  if(s == 0x17E0):addinfo = ", EEPROM SCI Baud Rate"
+  if(s == 0x17E8):addinfo = ", EEPROM CAN Baud Rate"
+  if(s == 0x17F0):addinfo = ", EEPROM Fingerprint of bootloader"
+  if(s == 0x17F8):addinfo = ", EEPROM ECU ID"
+  if(0x1900 <= s and s <= 0xEAFF):addinfo = ", Application software"
+  if(s == 0xFFAC):addinfo = ", BootLoader Configuration Register"
+  if(s == 0xFFAE):addinfo = ", FTRIM bit"
+  if(s == 0xFFAF):addinfo = ", TRIM value"
+  if(0xFFB0 <= s and s <= 0xFFB7):addinfo = ", Backdoor key"
+  if(s == 0xFFBD):addinfo = ", Flash and EEPROM Protection Register"
+  if(s == 0xFFBF):addinfo = ", Flash and EEPROM Options Register"
+  if(0xFFC0 <= s and s <= 0xFFFD):addinfo = ", Interrupt vector"
+  if(s == 0xFFFE):addinfo = ", Reset vector"
+  return addinfo
+
+def Divisor(baud):
+  # SCI divisor of bootloader for baud rate, 0 if no divisor is close enough (4%)
+  div = max(1, min(254, int(round(1000000.0 / baud))))
+  if abs(1000000.0 / div - baud) > 0.04 * baud:
+    return 0
+  return div
+
+def SerialText(serialnum):
+  return " ".join(format(b,"02X") for b in serialnum)
+
+def FreeIds(ecus, toolid):
+  # ECU IDs to be assigned to ECUs which have no own ID (0xFF) or share their ID with an
+  # other ECU. First ECU of a shared ID keeps it. Returns list of (serial, old ID, new ID).
+  used = set()
+  needs = []
+  for serialnum, ecuid in ecus:
+    if ecuid == BROADCAST_ID or ecuid in used:
+      needs.append((serialnum, ecuid))
+    else:
+      used.add(ecuid)
+  candidates = [i for i in list(range(14,0xFF))+list(range(1,14)) if i not in used and i != toolid]
+  if len(candidates) < len(needs):
+    raise SessionError("No free ECU ID for "+str(len(needs))+" ECUs")
+  return [(serialnum, ecuid, candidates[i]) for i, (serialnum, ecuid) in enumerate(needs)]
+
+def ParseRanges(arg):
+  # List of (start, end) from text like 0x1900-0xFFFF,0x17E0-0x17E7 (end is inclusive),
+  # None if text is wrong
+  ranges = []
+  for r in arg.split(","):
+    try:
+      start, end = [int(a, 0) for a in r.split("-")]
+    except ValueError:
+      return None
+    if start < 0 or 0xFFFF < end or end < start:
+      return None
+    ranges.append((start, end+1))
+  return ranges
+
+def PlanInfo(sectors, frame):
+  frames, wire = dzplan.WireCost(sectors, frame)
+  return "Plan "+str(len(sectors))+" sectors, "+str(frames)+" frames of max "+str(frame)+" bytes, "+str(wire)+" bytes on wire\n"
+
+def ExpectedSector(sector, current, mem, usage):
+  # Content of sector after erase and download of image. Not used bytes are 0xFF.
+  start = sector['sector']
+  end = start+sector['plen']
+  expected = bytearray(mem[start:end])
+  if start == 0xFD00:
+    # Bootloader fixes last page after erase: reset vector points to bootloader, protection
+    # is released (NVPROT=0xFF, NVOPT=0xE2) and reset vector of application is moved to 0xFFA0.
+    expected[0xFFBF-start] &= 0xE2
+    if usage[0xFFFE]:
+      expected[0xFFA0-start] &= mem[0xFFFE]
+      expected[0xFFA1-start] &= mem[0xFFFF]
+    expected[0xFFFE-start:] = current[0xFFFE-start:] # Bootloader entry is not known here
+  return expected
+
+def ProgramsErased(current, expected):
+  # True if every byte which differs from expected is erased (0xFF). A programmed byte shall
+  # not be programmed again without erase, it may disturb stored data.
+  return all(c == 0xFF for c, e in zip(current, expected) if c != e)
+
+def DifferingSector(sector, current, expected):
+  # Copy of sector without erase, one area per run of differing bytes. Gaps are not bridged,
+  # so frames do not cover programmed bytes. Full sector is downloaded if it needs erase.
+  start = sector['sector']
+  usage = bytearray(dzimage.MEMSIZE)
+  for i in range(len(current)):
+    if current[i] != expected[i]:
+      usage[start+i] = 1
+  areas = [{"start":a, "len":b-a, "data":bytes(expected[a-start:b-start])} for a, b in dzplan.FindRuns(usage, start, start+sector['plen'])]
+  return {"sector":start, "plen":sector['plen'], "used":True, "areas":areas, "noerase":True, "full":sector}
+
+# ---------------------------------------------------------------------------------------
+class Session:
+  # All state of communication with one target: port, IDs, negotiated frame size and log.
+  # Errors are raised as SessionError, so more sessions can run in threads of one process.
+
+  # Number of write frames sent before the answer of the oldest one is waited for.
+  # Bootloader SCI reception is polled and unbuffered while Flash is written,
+  # so 1 (stop and wait) is the safe value for current bootloader.
+  window = 1
+
+  # Maximum data length of a write frame. 0 means probe it from bootloader after connect.
+  max_frame = 0
+
+  # Maximum data length of a read request. 0xC0 reads a Flash sector in 4 requests.
+  max_read = 0xC0
+
+  # NACK codes of write frame which are worth to re-issue, and how many times
+  row_retry_codes = (0x0C, 0x0E) # Checksum error, timeout
+  row_retries = 3
+
+  # Connection attempt period (s), its grow factor after each attempt and its maximum,
+  # and deadline of connection (s, 0 means wait till abort)
+  conn_period = 0.1
+  conn_backoff = 1.0
+  conn_period_max = 1.0
+  conn_timeout = 0
+  conn_notice = 10.0 # Period of notice while waiting without deadline (s)
+
+  def __init__(self, port, baud=57600, ecuid=14, toolid=222, log=None, out=None):
+    self.port = port
+    self.baud = baud
+    self.ecuid = ecuid
+    self.toolid = toolid
+    self.log = log # dzlog.LogWriter
+    self.out = out # Console of progress text, None to be quiet
+    self.link = None # Transport of port, see dztransport.py
+    self.turbo = 0 # Baud rate of download, 0 means download at baud
+    self.turbo_restore = None # Original EEPROM SCI baud rate sector while turbo baud is active
+    self.fingerprint = False # Fingerprint is written since connection
+    self.fingerprint_before = None # Fingerprint of ECU before first fingerprint of download, with manifest
+    self.checksum_errors = 0
+    self.flush_time = 0
+    self.abort = threading.Event() # Set by other thread to stop connection attempts
+    self.quit_key = None # Function, returns True if user wants to stop (e.g. ESC button)
+    self.connect_time = 0
+    self.metrics = None # dzmetrics.Metrics to measure request/answer pairs
+    self.checkpoint = None # Path of checkpoint file of download, None means no resume
+    self.timeouts = dzmetrics.Timeouts(answer_timeout) # Adaptive answer timeouts, file is set by caller
+    self.units = None # dzimage.Units, patch of image for every downloaded ECU
+    self.manifest = False # Write manifest of sector hashes and download only sectors which differ from it
+    self.check = False # Only compare image with manifest, no download
+    self.erase_free = False # Read sectors and program without erase where only erased bytes are written
+
+  # -------------------------------------------------------------------------------------
+  def p(self, s):
+    self.log.Text(s)
+    if self.out is None:
+      return
+    self.out.write(s)
+    # Flush unfinished lines immediately, they are followed by waiting. Finished lines are
+    # flushed at most once in flush_period, to not slow down download by console output.
+    if not s.endswith("\n") or self.flush_time < time.perf_counter():
+      self.out.flush()
+      self.flush_time = time.perf_counter() + flush_period
+
+  def err(self, s):
+    raise SessionError(s)
+
+  def Open(self):
+    link = dztransport.NewTransport(self.port, self.baud, self.log)
+    try:
+      link.Open()
+    except (serial.SerialException, ValueError, OSError):
+      self.err("Cannot open " + link.kind + " " + self.port)
+    self.link = link
+
+  def Close(self):
+    self.timeouts.Save()
+    if self.link is not None:
+      self.link.Close()
+      self.link = None
+
+  def Send(self, tag, target, data):
+    # Returns time of request, it is start of latency of answer
+    start = time.perf_counter()
+    self.link.Send(tag, target, self.toolid, data)
+    return start
+
+  def Measure(self, service, start, code, address=None, length=0):
+    # Request/answer pair from start till now, code None means no answer
+    if self.metrics is not None and start is not None:
+      self.metrics.Add(self.link, service, start, code, address, length)
+
+  def Receive(self, source, until, check=False):
+    # (source, data) of next answer from source (None means any source), None if it does
+    # not arrive till until (time.perf_counter()). With check, abort and quit key are checked.
+    while True:
+      answer = self.link.Take(self.toolid, source)
+      if answer is not None:
+        return answer
+      if check:
+        self.CheckAbort()
+      now = time.perf_counter()
+      if until <= now:
+        return None
+      self.link.Poll(min(until - now, wait_slice))
+
+  def Timeout(self, service, size):
+    # Answer timeout (s) of request of service, size is bytes of request and answer on wire
+    return self.timeouts.Timeout(self.link, self.ecuid, service, size)
+
+  def Answered(self, service, size, wait, answer):
+    # Answer waited for since wait updates timeout estimate of service, lost answer backs it off
+    if answer is None:
+      self.timeouts.Lost(self.ecuid, service)
+    else:
+      self.timeouts.Sample(self.link, self.ecuid, service, size, time.perf_counter() - wait)
+
+  def ReceiveCode(self, service, start, address=None, source=None, length=0):
+    # Response code (one data byte) of request of service with length data bytes sent at
+    # start, None if answer is lost or broken
+    size = request_overhead + length + answer_length
+    wait = time.perf_counter()
+    answer = self.Receive(self.ecuid if source is None else source, wait + self.Timeout(service, size))
+    self.Answered(service, size, wait, answer)
+    code = answer[1][0] if answer is not None and 1 == len(answer[1]) else None
+    self.Measure(service, start, code, address)
+    return code
+
+  def Request(self, service, tag, data, address=None):
+    # Request of one byte answer code. Lost or broken answer, checksum error and timeout are
+    # retried in place after resynchronisation, at most row_retries times.
+    tries = 0
+    while True:
+      start = self.Send(tag, self.ecuid, data)
+      code = self.ReceiveCode(service, start, address, None, len(data))
+      if code is not None and code not in self.row_retry_codes:
+        return code
+      tries += 1
+      if self.row_retries < tries:
+        if code is None:
+          self.err("No answer")
+        return code
+      self.log.Text(("No answer" if code is None else "NACK "+h(code))+" for "+service+", retry\n")
+      self.Glitch()
+      self.Resync()
+
+  def Glitch(self):
+    # Count of link errors, too many of them on turbo baud means fall back to original baud
+    self.checksum_errors += 1
+    if self.turbo_restore is not None and turbo_max_errors < self.checksum_errors:
+      raise LinkError("Too many checksum errors")
+
+  def Resync(self):
+    # Bootloader may still wait for bytes of a broken request, and late answers may come.
+    # Tester present is sent until its own answer arrives, other answers are dropped.
+    deadline = time.perf_counter() + resync_time
+    self.link.Flush()
+    while True:
+      now = time.perf_counter()
+      if deadline <= now:
+        self.err("No answer for resynchronisation")
+      self.Send("Syn", self.ecuid, [])
+      until = min(deadline, now + self.conn_period)
+      answer = self.Receive(self.ecuid, until, True)
+      while answer is not None and 0 != len(answer[1]):
+        answer = self.Receive(self.ecuid, until, True)
+      if answer is not None:
+        break
+    self.link.Poll(0.01) # Answers of earlier tester present requests
+    self.link.Flush()
+
+  # -------------------------------------------------------------------------------------
+  def SendRow(self, row):
+    # Send compiled write frame (see dzplan.Compile), returns time of request
+    start = time.perf_counter()
+    if not self.link.SendBody("Dat", self.ecuid, self.toolid, row['body']):
+      self.err("Too less written bytes for sector "+h(row['start'],"04X"))
+    return start
+
+  def ReceiveRowAnswer(self, address, length=0, start=None):
+    # Answer code of write frame, None if answer is lost or broken
+    size = dzplan.write_overhead + length
+    wait = time.perf_counter()
+    answer = self.Receive(self.ecuid, wait + self.Timeout("write", size))
+    self.Answered("write", size, wait, answer)
+    code = answer[1][0] if answer is not None and 1 == len(answer[1]) else None
+    self.Measure("write", start, code, address, length)
+    return code
+
+  # -------------------------------------------------------------------------------------
+  def DownloadSector(self, sector):
+    # Write frames of sector are compiled by plan for protocol of link, or here if not.
+    # Returns False if answer of a frame is lost, then sector shall be erased first.
+    frames = sector.get('frames', {}).get(self.link.proto)
+    if frames is None:
+      frames = dzplan.CompileSector(sector, self.max_frame, self.link.Body)
+    rows = [dict(frame, tries=0) for frame in frames]
+
+    # Sliding window: keep up to 'window' frames in flight. Bootloader processes frames
+    # in order, so answers belong to the oldest not yet answered frame.
+    while 0<len(rows):
+      sent = 0
+      acked = 0
+      failed = []
+      while acked < len(rows):
+        while sent < len(rows) and sent-acked < self.window and 0==len(failed):
+          row = rows[sent]
+          row['sent'] = self.SendRow(row)
+          row['tries'] += 1
+          sent += 1
+        if acked == sent: # Stop after NACK, all in flight frames are answered
+          break
+        row = rows[acked]
+        code = self.ReceiveRowAnswer(row['start'], row['len'], row['sent'])
+        acked += 1
+        if code is None:
+          # Frame may be programmed already, it is not re-issued without erase (see ProgramSector)
+          self.log.Text("No answer for address "+h(row['start'],"04X")+"\n")
+          self.Glitch()
+          self.Resync()
+          return False
+        if code == 0:
+          self.p("Program address "+hex(row['start'])+" length "+str(row['len'])+getaddinfo(row['start'])+", Done.\n")
+        elif code in self.row_retry_codes and row['tries'] <= self.row_retries:
+          # Bootloader did not program the frame (checksum error or timeout of its bytes)
+          self.log.Text("NACK "+h(code)+" for address "+h(row['start'],"04X")+", re-issue\n")
+          self.Glitch()
+          failed.append(row)
+        else:
+          self.p("Program address "+hex(row['start'])+" length "+str(row['len'])+getaddinfo(row['start']))
+          self.ShowError(code)
+      # Re-issue from the failing address: failed frames first, then never sent ones
+      rows[:] = failed + rows[sent:]
+    return True
+
+  def ProgramSector(self, sector, erase):
+    # Erase sector if needed and download it. When answer of a write frame is lost, the frame
+    # may be programmed already. A byte shall not be programmed twice without erase, so sector
+    # is erased and downloaded again, the full sector if only a part of it was downloaded.
+    tries = 0
+    while True:
+      if erase:
+        self.p("Erase sector "+hex(sector['sector'])+" - "+hex(sector['sector']+sector['plen']-1)+getaddinfo(sector['sector']))
+        self.EraseSector(sector['sector'])
+      if self.DownloadSector(sector):
+        return
+      tries += 1
+      if self.row_retries < tries:
+        self.err("There was no answer for sector "+h(sector['sector'],"04X"))
+      self.p("Answer is lost, download sector "+hex(sector['sector'])+" again\n")
+      sector = sector.get('full', sector)
+      erase = True
+
+  # -------------------------------------------------------------------------------------
+  def ProbeRow(self, length):
+    # Write frame with wrong checksum. Bootloader checks length before data is received
+    # and checksum before Flash is touched, so nothing is written. Answer is 0x06 if length
+    # is too high, 0x0C (checksum error) if length would be accepted. Lost or broken answer
+    # and any other code are retried after resynchronisation, at most row_retries times.
+    tries = 0
+    while True:
+      start = time.perf_counter()
+      self.link.SendWrite("Prb", self.ecuid, self.toolid, 0x1900, bytes(length), False) # First application sector
+      size = dzplan.write_overhead + length
+      wait = time.perf_counter()
+      answer = self.Receive(self.ecuid, wait + self.Timeout("probe", size))
+      self.Answered("probe", size, wait, answer)
+      if answer is not None and 1 == len(answer[1]) and answer[1][0] in (0x06, 0x0C):
+        self.Measure("probe", start, answer[1][0], None, length)
+        return answer[1][0] == 0x0C
+      self.Measure("probe", start, None)
+      tries += 1
+      if self.row_retries < tries:
+        self.err("No answer for frame size probe")
+      self.log.Text("No answer for frame size probe of length "+str(length)+", retry\n")
+      self.Glitch()
+      self.Resync()
+
+  def ProbeFrameSize(self):
+    good = 8 # CAN frame size is always supported
+    bad = 256
+    # Progressively larger lengths until bootloader refuses it
+    length = 16
+    while length < bad:
+      if self.ProbeRow(min(length,255)):
+        good = min(length,255)
+        length *= 2
+      else:
+        bad = length
+    # Fall back between last accepted and first refused length
+    while 1 < bad-good:
+      length = (good+bad) // 2
+      if self.ProbeRow(length):
+        good = length
+      else:
+        bad = length
+    return good
+
+  # -------------------------------------------------------------------------------------
+  def ShowError(self, response):
+    self.ShowErrorNibble("Memory error: ", (response >> 4) & 0x0F)
+    self.ShowErrorNibble("Protocol error: ", response & 0x0F)
+
+  def ShowErrorNibble(self, errortype, errorcode):
+    err = self.err
+    if errorcode == 0: return # No error
+    elif errorcode == 1: err(errortype+"address error. ")
+    elif errorcode == 2: err(errortype+"Protection violation. ")
+    elif errorcode == 5: err(errortype+"Length is zero. ")
+    elif errorcode == 6: err(errortype+"Length is too high. ")
+    elif errorcode == 7: err(errortype+"Unexpected command or CAN DLC. ")
+    elif errorcode == 8: err(errortype+"Unexpected subservice in request service. ")
+    elif errorcode == 0xA: err(errortype+"Address error (Bootloader code range is prohibited to be changed). ")
+    elif errorcode == 0xB: err(errortype+"Boundary violation. ")
+    elif errorcode == 0xC: err(errortype+"Checksum error. ")
+    elif errorcode == 0xD: err(errortype+"Data error (e.g. wrong filler byte value). ")
+    elif errorcode == 0xE: err(errortype+"End of time (timeout). ")
+    elif errorcode == 0xF: err(errortype+"Fingerprint not written. ")
+    else: err("Unknown error "+h(errorcode)+". ")
+
+  def RunApplication(self):
+    self.Send("Run", self.ecuid, [0x52]) # Run application
+    # No response expected
+    self.p(", Done.\n")
+    return True
+
+  # -------------------------------------------------------------------------------------
+  def WriteFingerprint(self):
+    d = datetime.today()
+    year = BCD(d.strftime("%y"))
+    month = BCD(d.strftime("%m"))
+    day = BCD(d.strftime("%d"))
+    t = datetime.now()
+    hour = BCD(t.strftime("%H"))
+    minute = BCD(t.strftime("%M"))
+    second = BCD(t.strftime("%S"))
+    if (self.manifest or self.check) and self.fingerprint_before is None:
+      self.fingerprint_before = self.ReadMemory(FINGERPRINT, 8)
+    code = self.Request("fingerprint", "Wfp", [year, month, day, hour, minute, second])
+    if code == 0:
+      self.fingerprint = True
+      self.p(", Done.\n")
+      return True
+    self.ShowError(code)
+    self.err("Unexpected answer")
+
+  # -------------------------------------------------------------------------------------
+  def CheckAbort(self):
+    # Abort by other thread or quit key is UserAbort wherever it is waited for (connection,
+    # scan, resynchronisation), so it is a SessionError for callers of session in threads
+    if self.abort.is_set() or (self.quit_key is not None and self.quit_key()):
+      raise UserAbort("User abort")
+
+  def ConnectDevice(self, timeout=None):
+    # Send break and Tester present until answer arrives. Period starts from conn_period and
+    # grows by conn_backoff up to conn_period_max. Deadline is timeout, or conn_timeout
+    # if not given (0 means no deadline, a notice is printed in every conn_notice then).
+    # Waiting for answer does not load CPU.
+    if timeout is None:
+      timeout = self.conn_timeout
+    start = time.perf_counter()
+    period = self.conn_period
+    timer = start
+    notice = start + self.conn_notice
+    try:
+      while True:
+        now = time.perf_counter()
+        if 0 < timeout and start + timeout <= now:
+          self.err("No connection at "+self.link.Speed()+" in "+format(timeout,"g")+" s")
+        if timeout <= 0 and notice <= now:
+          self.p("\nNo answer in "+format(now-start,".0f")+" s, reset ECU or press ESC or Ctrl+C to abort. Waiting")
+          notice += self.conn_notice
+        if timer <= now:
+          self.link.Break()
+          self.Send("Con", self.ecuid, [])
+          timer = time.perf_counter() + period
+          period = min(period * self.conn_backoff, max(self.conn_period_max, self.conn_period))
+        answer = self.Receive(self.ecuid, timer if timeout <= 0 else min(timer, start + timeout), True)
+        if answer is not None and 0 == len(answer[1]):
+          break
+    except KeyboardInterrupt:
+      raise UserAbort("User abort")
+    self.fingerprint = False
+    self.checksum_errors = 0
+    self.connect_time = time.perf_counter() - start
+    self.Measure("connect", start, 0)
+    self.p(", "+format(self.connect_time,".2f")+" s, Done.\n")
+
+  def Reset(self):
+    self.Send("Rst", self.ecuid, [0x11]) # MCU reset
+    self.link.Drain()
+    # No response expected
+    self.fingerprint = False
+
+  # -------------------------------------------------------------------------------------
+  def ScanNetwork(self):
+    # Broadcast Scan network request and collect reports of all ECUs on bus.
+    # Report is DLC 7, 6 bytes serial number and current ECU ID.
+    # Returns list of (serial number, ECU ID) sorted by serial number.
+    ecus = {}
+    deadline = time.perf_counter() + scan_time
+    timer = 0
+    try:
+      while time.perf_counter() < deadline:
+        if timer < time.perf_counter():
+          self.link.Break() # Reset application software to bootloader
+          self.Send("Scn", BROADCAST_ID, [0x22])
+          timer = time.perf_counter() + scan_period
+        answer = self.Receive(None, min(timer, deadline), True)
+        if answer is not None and 7 == len(answer[1]):
+          ecus[answer[1][:6]] = answer[1][6]
+    except KeyboardInterrupt:
+      raise UserAbort("User abort")
+    return sorted(ecus.items())
+
+  def SetEcuId(self, serialnum, newid):
+    # Broadcast Update ID request, only ECU with serial number answers, already from new ID
+    start = self.Send("Sid", BROADCAST_ID, bytes(serialnum) + bytes([newid]))
+    code = self.ReceiveCode("set id", start, None, newid, 7)
+    if code is None:
+      self.err("No answer")
+    if code == 0:
+      self.p(", Done.\n")
+      return True
+    self.ShowError(code)
+    self.err("Unexpected answer")
+
+  def FindEcus(self, assign=False, unique=True):
+    # IDs of all ECUs on bus. With assign, ECUs without own or with shared ID get a free ID.
+    # Otherwise such IDs are error if unique IDs are needed (e.g. for download).
+    self.p("Scan network")
+    ecus = self.ScanNetwork()
+    self.p(", "+str(len(ecus))+" ECU found.\n")
+    for serialnum, ecuid in ecus:
+      self.p("  Serial number "+SerialText(serialnum)+", ECU ID "+h(ecuid)+"\n")
+    if 0 == len(ecus):
+      self.err("No ECU found on network")
+    changes = FreeIds(ecus, self.toolid)
+    if 0 < len(changes):
+      if not assign:
+        if unique:
+          self.err("ECU ID "+h(changes[0][1])+" is not assigned or not unique, use --assign-ids")
+        self.p("ECU IDs are not assigned or not unique, use --assign-ids to assign them.\n")
+        return sorted(ecuid for serialnum, ecuid in ecus)
+      for serialnum, oldid, newid in changes:
+        self.p("Set ECU ID of serial number "+SerialText(serialnum)+" from "+h(oldid)+" to "+h(newid))
+        self.SetEcuId(serialnum, newid)
+      newids = dict((c[0], c[2]) for c in changes)
+      ecus = [(serialnum, newids.get(serialnum, ecuid)) for serialnum, ecuid in ecus]
+    return sorted(ecuid for serialnum, ecuid in ecus)
+
+  # -------------------------------------------------------------------------------------
+  def WriteBaudSector(self, content):
+    # Erase and write EEPROM sector of SCI baud rate, then read back. Repeated on error,
+    # because it is also used to restore original baud rate on a noisy link.
+    tries = 0
+    while True:
+      try:
+        if not self.fingerprint:
+          self.p("Write fingerprint")
+          self.WriteFingerprint()
+        self.p("Erase sector "+hex(EESCIBAUD)+" - "+hex(EESCIBAUD+7)+getaddinfo(EESCIBAUD))
+        self.EraseSector(EESCIBAUD)
+        self.p("Program address "+hex(EESCIBAUD)+" length 8"+getaddinfo(EESCIBAUD))
+        sent = self.SendRow({"start":EESCIBAUD, "body":self.link.Body(EESCIBAUD, bytes(content))})
+        self.ShowError(self.ReceiveRowAnswer(EESCIBAUD, 8, sent))
+        self.p(", Done.\n")
+        self.p("Verify EEPROM SCI baud rate")
+        if self.ReadMemory(EESCIBAUD, 8) != content:
+          self.err("EEPROM SCI baud rate differs")
+        self.p(", Done.\n")
+        return
+      except UserAbort:
+        raise
+      except SessionError as e:
+        tries += 1
+        if self.row_retries < tries:
+          raise
+        self.p(", "+str(e)+", Retry.\n")
+        time.sleep(0.1)
+        self.link.Flush()
+
+  def TurboOn(self):
+    # Write divisor of turbo baud into EEPROM and reset ECU, bootloader reads it at start
+    if not self.link.changeable_baud:
+      self.err("Turbo baud is supported only on serial port")
+    div = Divisor(self.turbo)
+    self.p("Read EEPROM SCI baud rate")
+    self.turbo_restore = self.ReadMemory(EESCIBAUD, 8)
+    self.p(", "+str(self.turbo_restore[0])+", Done.\n")
+    content = bytearray(self.turbo_restore)
+    content[0] = div
+    self.WriteBaudSector(content)
+    self.p("Reset and connect at "+str(self.turbo)+" baud")
+    self.Reset()
+    self.link.SetBaud(self.turbo)
+    try:
+      self.ConnectDevice(turbo_connect_time)
+      return
+    except UserAbort:
+      raise
+    except SessionError as e:
+      self.p(", "+str(e)+".\n")
+    # Maybe ECU was not reset, try at original baud rate
+    self.p("Connect at "+str(self.baud)+" baud")
+    self.link.SetBaud(self.baud)
+    try:
+      self.ConnectDevice(turbo_connect_time)
+    except SessionError:
+      self.err("No connection. EEPROM SCI baud rate of ECU is "+str(div)+" ("+str(1000000//div)+" baud), restore it by CAN or BDM")
+    self.TurboOff(False)
+
+  def TurboOff(self, reconnect):
+    # Restore original EEPROM SCI baud rate. With reconnect, ECU is reset to continue
+    # communication at original baud rate.
+    self.p("Restore EEPROM SCI baud rate "+str(self.turbo_restore[0])+"\n")
+    self.WriteBaudSector(self.turbo_restore)
+    self.turbo_restore = None
+    if reconnect:
+      self.p("Reset and connect at "+str(self.baud)+" baud")
+      self.Reset()
+      self.link.SetBaud(self.baud)
+      self.ConnectDevice(turbo_connect_time)
+
+  # -------------------------------------------------------------------------------------
+  def EraseSector(self, address):
+    code = self.Request("erase", "Ers", [((address>>8)&0xFF),((address>>0)&0xFF)], address)
+    if code == 0:
+      self.p(", Done.\n")
+      return True
+    self.ShowError(code)
+    self.err("Unexpected answer")
+
+  # -------------------------------------------------------------------------------------
+  def ReadMemory(self, address, length):
+    for address, data in self.ReadChunks([(address, length)]):
+      return data
+
+  def SendRead(self, address, length):
+    return self.Send("Rd ", self.ecuid, [((address>>8)&0xFF),((address>>0)&0xFF),length])
+
+  def ReceiveRead(self, address, length, start=None):
+    size = request_overhead + 3 + answer_length + length
+    wait = time.perf_counter()
+    until = wait + self.Timeout("read", size)
+    while True:
+      now = time.perf_counter()
+      answer = self.link.TakeRead(self.toolid, self.ecuid, address, length, until <= now)
+      if answer is not None:
+        break
+      self.link.Poll(min(until - now, wait_slice))
+    code, data = answer
+    self.Answered("read", size, wait, None if code is None else answer)
+    self.Measure("read", start, code, address, length)
+    if code is None:
+      raise LinkError("No answer for read of address "+h(address,"04X"))
+    if code == 0x0C:
+      raise LinkError("Checksum error in read answer of address "+h(address,"04X"))
+    if code == 0x0E:
+      raise LinkError("Timeout of read request of address "+h(address,"04X"))
+    if code != 0:
+      self.ShowError(code)
+      self.err("Unexpected answer for read of address "+h(address,"04X"))
+    return data
+
+  def ReadChunks(self, chunks):
+    # Generator of (address, data) of (address, length) chunks. Up to window requests are
+    # sent before the answer of the oldest one is waited for, answers come in order.
+    # Lost or broken answer is read again after resynchronisation, at most row_retries times.
+    starts = []
+    tries = 0
+    i = 0
+    while i < len(chunks):
+      while len(starts) < len(chunks) and len(starts)-i < self.window:
+        starts.append(self.SendRead(*chunks[len(starts)]))
+      address, length = chunks[i]
+      try:
+        data = self.ReceiveRead(address, length, starts[i])
+      except LinkError as e:
+        tries += 1
+        if self.row_retries < tries:
+          raise
+        self.log.Text(str(e)+", retry\n")
+        self.Glitch()
+        self.Resync()
+        del starts[i:] # Requests in flight are sent again
+        continue
+      tries = 0
+      i += 1
+      yield address, data
+
+  def ReadImage(self, ranges, partpath):
+    # Read memory ranges [(start, end)] into image. Every answer is appended to part file
+    # immediately, so interrupted read out is continued from it.
+    mem, usage = dzimage.NewImage()
+    if os.path.exists(partpath):
+      with open(partpath, "rb") as f:
+        part = f.read()
+      i = 0
+      while i + PART_RECORD.size <= len(part):
+        address, length = PART_RECORD.unpack_from(part, i)
+        data = part[i+PART_RECORD.size:i+PART_RECORD.size+length]
+        if len(data) < length:
+          break # Interrupted while record was written
+        mem[address:address+length] = data
+        usage[address:address+length] = b"\x01" * length
+        i += PART_RECORD.size + length
+      self.p("Resume read out, "+str(usage.count(1))+" bytes already read.\n")
+
+    # Requests of maximal length (255 on SCI), already read ones are skipped
+    chunks = []
+    for start, end in ranges:
+      a = start
+      while a < end:
+        n = min(self.link.max_read, end-a)
+        if usage.find(0, a, a+n) != -1:
+          chunks.append((a, n))
+        a += n
+
+    with open(partpath, "ab") as f:
+      for address, data in self.ReadChunks(chunks):
+        f.write(PART_RECORD.pack(address, len(data)) + data)
+        f.flush()
+        mem[address:address+len(data)] = data
+        usage[address:address+len(data)] = b"\x01" * len(data)
+        self.p("Read address "+hex(address)+" length "+str(len(data))+getaddinfo(address)+", Done.\n")
+    return mem, usage
+
+  def ReadManifest(self):
+    # (sector hashes, fingerprint) of manifest of device, None if there is no valid manifest
+    head = self.ReadMemory(dzplan.MANIFEST, 5)
+    length = dzplan.ManifestLength(head)
+    if 0 == length:
+      return None
+    step = min(self.max_read, self.link.max_read)
+    end = dzplan.MANIFEST + length
+    manifest = bytearray(head)
+    for address, data in self.ReadChunks([(a, min(step, end-a)) for a in range(dzplan.MANIFEST+5, end, step)]):
+      manifest += data
+    return dzplan.ParseManifest(manifest)
+
+  def ReadSector(self, sector):
+    data = bytearray()
+    a = sector['sector']
+    l = sector['plen']
+    while(0<l):
+      n = min(l,self.max_read,self.link.max_read)
+      data += self.ReadMemory(a,n)
+      a+=n
+      l-=n
+    return data
+
+  # -------------------------------------------------------------------------------------
+  def CheckpointKey(self, mem, usage):
+    # Download is identified by serial number of ECU and hash of image
+    serialnum = self.ReadMemory(SERIAL_NUMBER, 6)
+    return serialnum.hex().upper()+" "+hashlib.sha256(bytes(mem)+bytes(usage)).hexdigest()[:16]
+
+  def ReadCheckpoint(self, key):
+    # Sectors already downloaded by an interrupted download of key. Valid only while reset
+    # vector of application is erased: vector sector is erased first and written last.
+    done = set()
+    if not os.path.exists(self.checkpoint):
+      return done
+    with open(self.checkpoint, "r") as f:
+      for line in f:
+        fields = line.split()
+        if len(fields) == 3 and " ".join(fields[:2]) == key:
+          try:
+            done.add(int(fields[2], 16))
+          except ValueError:
+            pass
+    if 0 < len(done) and self.ReadMemory(APP_VECTOR, 2) != b"\xFF\xFF":
+      self.p("Checkpoint of download is dropped, application vector is already written.\n")
+      self.ClearCheckpoint(key)
+      return set()
+    return done
+
+  def WriteCheckpoint(self, key, sector):
+    # One line per downloaded sector, file is closed after each, so it survives interruption
+    with open(self.checkpoint, "a") as f:
+      f.write(key+" "+format(sector,"04X")+"\n")
+
+  def ClearCheckpoint(self, key):
+    # Lines of key are removed, file is removed when no other download is interrupted
+    if not os.path.exists(self.checkpoint):
+      return
+    with open(self.checkpoint, "r") as f:
+      lines = [line for line in f if not line.startswith(key+" ")]
+    if 0 == len(lines):
+      os.remove(self.checkpoint)
+    else:
+      with open(self.checkpoint, "w") as f:
+        f.writelines(lines)
+
+  # -------------------------------------------------------------------------------------
+  def Download(self, mem, usage, sectors, plan_frame, diff=False):
+    # Complete download of a planned image. Sectors planned for plan_frame are not changed,
+    # they can be shared by sessions of other ports.
+
+    # Unit specific bytes (ID, baud rates, identification), only patched sectors are planned again
+    if self.units is not None:
+      unit = self.units.Next()
+      if unit is None:
+        self.err("No more units in patch")
+      if 0 < len(unit[0]):
+        self.p("Unit "+unit[0]+"\n")
+      try:
+        sectors, mem, usage = dzplan.Patch(sectors, mem, usage, unit[1], plan_frame, {self.link.proto:self.link.Body})
+      except dzplan.PlanError as e:
+        self.err(str(e))
+
+    # Connecting to devive
+    self.p("Connect to device (Press ESC or Ctrl+C to abort)");
+    self.ConnectDevice()
+    self.fingerprint_before = None
+
+    self.RunTurbo(lambda: self.Flash(mem, usage, sectors, plan_frame, diff))
+
+    # Run application immediately
+    self.p("Run application");
+    self.RunApplication()
+    self.link.SetBaud(self.baud)
+
+  def DownloadTargets(self, mem, usage, sectors, plan_frame, diff=False, assign=False):
+    # Download into ECU ID of session, or into every ECU found by scan of network if ID is
+    # auto. With assign, ECUs without own or with shared ID get a free ID first.
+    if self.ecuid != AUTO_ID:
+      self.Download(mem, usage, sectors, plan_frame, diff)
+      return
+    max_frame = self.max_frame
+    for i in self.FindEcus(assign):
+      self.p("Download into ECU ID "+h(i)+"\n")
+      self.ecuid = i
+      self.max_frame = max_frame # ECUs may have different bootloader, probe each
+      self.Download(mem, usage, sectors, plan_frame, diff)
+
+  def ReadOut(self, ranges, partpath, run=True):
+    # Read out memory ranges of device into image (see ReadImage)
+    self.p("Connect to device (Press ESC or Ctrl+C to abort)");
+    self.ConnectDevice()
+    image = []
+    self.RunTurbo(lambda: image.append(self.ReadImage(ranges, partpath)), not run)
+    if run:
+      self.p("Run application");
+      self.RunApplication()
+      self.link.SetBaud(self.baud)
+    return image[-1]
+
+  def RunTurbo(self, job, reconnect=False):
+    # Do job on turbo baud. If it is not reliable, switch back and do job again on original
+    # baud. With reconnect, ECU is reset at the end to continue on original baud.
+    if self.turbo:
+      self.TurboOn()
+    try:
+      job()
+    except UserAbort:
+      raise
+    except SessionError as e:
+      if self.turbo_restore is None:
+        raise
+      self.p("\nERROR at "+str(self.turbo)+" baud: "+str(e)+" Fall back to "+str(self.baud)+" baud.\n")
+      self.link.Flush()
+      self.TurboOff(True)
+      job()
+    if self.turbo_restore is not None:
+      self.TurboOff(reconnect)
+
+  def Flash(self, mem, usage, sectors, plan_frame, diff):
+    # Negotiate length of write frames
+    if 0 == self.max_frame and 0 < self.link.max_frame:
+      self.max_frame = self.link.max_frame # Known limit of bootloader, no need to probe
+    if 0 == self.max_frame:
+      self.p("Probe write frame size")
+      self.max_frame = self.ProbeFrameSize()
+      self.p(", "+str(self.max_frame)+" bytes, Done.\n")
+    if self.max_frame != plan_frame:
+      sectors = dzplan.Plan(dzplan.Sectors(), mem, usage, self.max_frame)
+      dzplan.Compile(sectors, self.max_frame, {self.link.proto:self.link.Body})
+      self.p(PlanInfo(sectors, self.max_frame))
+
+    # EEPROM SCI baud rate sector of image is written at restore of original baud rate
+    if self.turbo_restore is not None:
+      for sector in sectors:
+        if sector['sector'] == EESCIBAUD:
+          self.turbo_restore = bytearray(mem[EESCIBAUD:EESCIBAUD+8])
+      sectors = [sector for sector in sectors if sector['sector'] != EESCIBAUD]
+
+    # ECU ID sector is kept by bootloader (ID, update counter, fingerprint copy) and bootloader
+    # answers from new ID immediately, so ID of image is set by Set ECU ID service at the end
+    newid = None
+    if any(sector['sector'] == EEECUID for sector in sectors):
+      if usage[EEECUID] and mem[EEECUID] != self.ecuid:
+        newid = mem[EEECUID]
+        if newid in (BROADCAST_ID, self.toolid):
+          self.err("ECU ID "+h(newid)+" of image is not possible")
+      sectors = [sector for sector in sectors if sector['sector'] != EEECUID]
+
+    # Sectors with the same hash in manifest of device are not downloaded. Manifest is in
+    # application identification sector and is written after vector sector, so it is valid
+    # only after a complete download. It contains fingerprint of its download, every later
+    # download (also without manifest) writes a new fingerprint, which makes it outdated.
+    planned = None
+    if self.manifest or self.check:
+      try:
+        hashes = dzplan.Manifest(sectors, mem, usage)[1]
+      except dzplan.PlanError as e:
+        self.err(str(e))
+      planned = sectors
+      self.p("Read manifest")
+      current = self.ReadManifest()
+      if current is not None:
+        fingerprint = self.fingerprint_before
+        if fingerprint is None:
+          fingerprint = self.ReadMemory(FINGERPRINT, 8)
+        if current[1] != fingerprint:
+          self.p(", Outdated by a later download")
+          current = None
+      if current is None:
+        self.p(", Not found.\n")
+        changed = sectors
+      else:
+        changed = [sector for sector in sectors if current[0].get(sector['sector']) != hashes[sector['sector']]]
+        self.p(", "+str(len(changed))+" of "+str(len(sectors))+" sectors differ.\n")
+      if self.check:
+        for sector in changed:
+          self.p("  Sector "+hex(sector['sector'])+" - "+hex(sector['sector']+sector['plen']-1)+getaddinfo(sector['sector'])+"\n")
+        return
+      if 0 == len(changed):
+        sectors = []
+      else:
+        # Manifest sector is erased for new manifest, vector sector is erased first
+        if sectors[0]['sector'] != 0x1080:
+          sectors = [{"sector":0x1080, "plen":0x280, "used":False, "areas":[], "frames":{}}] + sectors
+        changed = set(sector['sector'] for sector in changed) | set([0x1080, 0xFD00])
+        sectors = [sector for sector in sectors if sector['sector'] in changed]
+
+    # Differential download: skip sectors which already have the content of image.
+    # Erase free: a sector is not erased if every byte to be written is erased (0xFF) in it.
+    # Only the differing bytes are programmed, programmed bytes are not written again.
+    if diff or self.erase_free:
+      changed = []
+      for sector in sectors:
+        self.p("Compare sector "+hex(sector['sector'])+" - "+hex(sector['sector']+sector['plen']-1)+getaddinfo(sector['sector']))
+        current = self.ReadSector(sector)
+        expected = ExpectedSector(sector, current, mem, usage)
+        if current == expected:
+          self.p(", Same.\n")
+        elif self.erase_free and sector['sector'] != 0xFD00 and ProgramsErased(current, expected):
+          changed.append(DifferingSector(sector, current, expected))
+          self.p(", Differs, no erase.\n")
+        else:
+          changed.append(sector)
+          self.p(", Differs.\n")
+      # Vector sector is erased first whenever anything is downloaded, so it shall be written again (last)
+      if 0 < len(changed) and sectors[-1]['sector'] == 0xFD00 and changed[-1] is not sectors[-1]:
+        changed.append(sectors[-1])
+      sectors = changed
+
+    # Sectors done by an interrupted download of the same image into the same ECU are skipped
+    key = None
+    if self.checkpoint is not None and 0 < len(sectors):
+      key = self.CheckpointKey(mem, usage)
+      done = self.ReadCheckpoint(key)
+      if 0 < len(done):
+        sectors = [sector for sector in sectors if sector['sector'] not in done or sector['sector'] == 0xFD00]
+        self.p("Resume download, "+str(len(done))+" sectors are already done.\n")
+
+    if 0 == len(sectors):
+      self.p("Device content is same as S19, nothing to download.\n")
+    else:
+
+      # Write fingerprint
+      if not self.fingerprint:
+        self.p("Write fingerprint");
+        self.WriteFingerprint()
+
+      # Erase start vector sector first. This will be written last time, what ensures that interrupted download will finally not be called.
+      self.p("Erase sector 0xFD00 - 0xFFFF"+getaddinfo(0xFFFE))
+      self.EraseSector(0xFFFE) # Here it is not problem, that the complete sector is erased. Content will be written again during download.
+
+      # Download sectors
+      for sector in sectors:
+        # Do not need here to erase last (vector) page, because it was already erased before
+        self.ProgramSector(sector, sector['sector'] != 0xFD00 and not sector.get('noerase'))
+        if key is not None and sector['sector'] != 0xFD00:
+          self.WriteCheckpoint(key, sector['sector'])
+      if planned is not None:
+        manifest = dzplan.Manifest(planned, mem, usage, self.ReadMemory(FINGERPRINT, 8))[0]
+        self.p("Write manifest of "+str(manifest[4])+" sectors\n")
+        area = {"start":dzplan.MANIFEST, "len":len(manifest), "data":manifest}
+        ident = [s['areas'] for s in planned if s['sector'] == 0x1080]
+        full = {"sector":0x1080, "plen":0x280, "areas":sorted((ident[0] if ident else []) + [area], key=lambda a: a['start'])}
+        self.ProgramSector({"sector":0x1080, "plen":0x280, "areas":[area], "full":full}, False)
+      if key is not None:
+        self.ClearCheckpoint(key)
+
+    if newid is not None:
+      self.p("Set ECU ID from "+h(self.ecuid)+" to "+h(newid))
+      self.SetEcuId(self.ReadMemory(SERIAL_NUMBER, 6), newid)
+      self.ecuid = newid
@@ -0,0 +1,688 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Bootloader protocol simulator of MC9S08DZ60 to run dzdl.py without hardware"""
+
+# Import statements
+import os, sys, getopt, time, threading, random, signal, struct, socket, select
+import collections
+import dzimage
+if not sys.platform.startswith("win"):
+  import tty, fcntl
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+# Memory map of bootloader (see prg.asm and mem.asm)
+EESCIBAUD = 0x17E0
+FINGERPR = 0x17F0
+ECUID = 0x17F8
+BL_START = 0xEB00 # Bootloader code $EB00-$FCFF is prohibited to be changed
+BL_END = 0xFCFF
+SERIAL_NUMBER = 0xFCF8
+APPADDRESS = 0xFFA0
+BLCR = 0xFFAC # BootLoader Configuration Register, $FF (erased) is default
+BLCR_ET = 0x01 # Enable Terminal
+
+# Image of bootloader in memory of simulated ECUs
+bootloader = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prg.s19")
+
+# Timeout of bytes inside a frame (SHORTWAIT, 30 * 32ms)
+byte_timeout = 0.96
+
+# Timeout of keys in terminal (LONGWAIT, 250 * 32ms), then it resets like 'r'
+key_timeout = 8.0
+
+# CAN message header 0x1CDATTSS and Linux struct can_frame
+HEADER = 0x1CDA0000
+CAN_FRAME = struct.Struct("=IB3x8s")
+CAN_EFF_FLAG = 0x80000000
+FILLER = 0xFB
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+class Ecu:
+  # Memory and non volatile memory handling of one simulated ECU, common for SCI and CAN.
+  # Latency of Flash operations: erase_ms per sector, write_us per byte.
+
+  def __init__(self, ecuid=0x0E, serialnum=b"\x23\x10\x24\x20\x20\x25", image=None, erase_ms=20.0, write_us=40.0, faults=None, seed=None):
+    self.mem = bytearray(b"\xFF" * 0x10000) if image is None else bytearray(image)
+    self.mem[ECUID] = ecuid
+    self.mem[SERIAL_NUMBER:SERIAL_NUMBER+6] = serialnum
+    self.entry = self.mem[0xFFFE:0x10000] # Reset vector of bootloader
+    self.erase_s = erase_ms / 1e3
+    self.write_s = write_us / 1e6
+    self.faults = faults or {} # Rate of nack, corrupt, drop and corrupt_above baud
+    self.rnd = random.Random(seed)
+    self.fpavail = False
+    self.diag_sa = 0
+    self.stats = collections.Counter()
+    self.running = True
+
+  def Fault(self, name):
+    rate = self.faults.get(name)
+    if rate and self.rnd.random() < rate:
+      self.stats[name] += 1
+      return True
+    return False
+
+  def Busy(self, seconds):
+    if seconds:
+      time.sleep(seconds)
+
+  def Reset(self):
+    self.stats["reset"] += 1
+    self.fpavail = False
+
+  # -------------------------------------------------------------------------------------
+  # Non volatile memory (MEM_DoIt of mem.asm), return code is in high nibble
+  def Sector(self, address):
+    if 0x1400 <= address <= 0x17FF:
+      return address & 0xFFF8, 8 # EEPROM in 8 byte mode
+    if address < 0x1080 or 0x1800 <= address < 0x1900:
+      return None, 0x300 # RAM and registers
+    if address < 0x1300:
+      return 0x1080, 0x280
+    if address < 0x1400:
+      return 0x1300, 0x100
+    start = 0x1900 + ((address - 0x1900) // 0x300) * 0x300
+    return start, 0x300
+
+  def Nvm(self, address, data, fpcheck=True):
+    if fpcheck and not self.fpavail:
+      return 0x0F
+    start, size = self.Sector(address)
+    if start is None: # RAM write
+      if 0 == len(data):
+        return 0x50
+      self.mem[address:address+len(data)] = data
+      return 0x00
+    if BL_START <= address <= BL_END:
+      return 0xA0
+    if 0 == len(data): # Erase
+      self.stats["erase"] += 1
+      self.Busy(self.erase_s)
+      self.mem[start:start+size] = b"\xFF" * size
+      if start == 0xFD00: # Last page fix: reset vector to bootloader, protection released
+        self.mem[0xFFFE:0x10000] = self.entry
+        self.mem[0xFFBF] = 0xE2
+      return 0x00
+    if size < len(data):
+      return 0x60
+    if self.Sector(address + len(data) - 1)[0] != start:
+      return 0xB0
+    self.stats["write"] += 1
+    self.Busy(self.write_s * len(data))
+    for i, byte in enumerate(data):
+      a = address + i
+      if start == 0xFD00 and 0xFFFE <= a:
+        a = APPADDRESS + a - 0xFFFE # Reset vector of application is moved to APPADDRESS
+      self.mem[a] &= byte
+    return 0x00
+
+  def Fingerprint(self, fp):
+    fp = bytearray(fp)
+    fp.append((self.mem[FINGERPR+6] + 1) & 0xFF) # Update counter
+    fp.append(sum(fp) & 0xFF)
+    self.Nvm(FINGERPR, b"", False)
+    code = self.Nvm(FINGERPR, fp, False)
+    if code == 0:
+      self.fpavail = True
+    return code
+
+  def SetId(self, newid):
+    record = bytearray([newid, (self.mem[ECUID+1] + 1) & 0xFF]) + self.mem[FINGERPR:FINGERPR+6]
+    self.Nvm(ECUID, b"", False)
+    return self.Nvm(ECUID, record, False)
+
+  def ReadCode(self, length):
+    # Error code of read request, 0 if data will be sent
+    if 0 == length:
+      return 0x05
+    return 0x00
+
+  def WriteCode(self, length):
+    # Error code of write request detected before data
+    if 0 == length:
+      return 0x05
+    if length & 0x80:
+      return 0x06
+    return 0x00
+
+# ---------------------------------------------------------------------------------------
+class SciEcu(Ecu):
+  # ECU on SCI (ser.asm). Bytes are processed one by one like by bootloader. While Flash
+  # is written, only rxbuf bytes are received, others are lost (SCI overrun).
+
+  def __init__(self, line, rxbuf=1, **kw):
+    Ecu.__init__(self, **kw)
+    self.line = line
+    self.rxbuf = rxbuf
+    self.rx = collections.deque()
+    self.cv = threading.Condition()
+    self.busy = False
+    self.Init()
+
+  def Init(self):
+    # SCI baud rate is 1 Mbaud / EEPROM divisor, read at start of bootloader
+    div = self.mem[EESCIBAUD]
+    if div == 0xFF or div == 0:
+      div = 17
+    self.baud = 1000000.0 / div
+
+  def Reset(self):
+    Ecu.Reset(self)
+    self.Init()
+
+  def Busy(self, seconds):
+    with self.cv:
+      self.busy = True
+    Ecu.Busy(self, seconds)
+    with self.cv:
+      self.busy = False
+
+  def Receive(self, data, hostbaud):
+    if hostbaud and abs(hostbaud - self.baud) > 0.05 * self.baud:
+      self.stats["baud_mismatch"] += len(data)
+      data = bytes(self.rnd.randrange(256) for b in data) # Framing errors and garbage
+    noisy = self.baud > self.faults.get("corrupt_above", 0)
+    with self.cv:
+      for b in data:
+        if self.busy and self.rxbuf <= len(self.rx):
+          self.stats["overrun"] += 1
+          continue
+        if noisy and self.Fault("corrupt"):
+          b ^= 0x01
+        self.rx.append(b)
+      self.cv.notify()
+
+  def getc(self, timeout=byte_timeout):
+    deadline = time.monotonic() + timeout
+    with self.cv:
+      while 0 == len(self.rx):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self.running:
+          return None
+        self.cv.wait(min(remaining, 0.1))
+      return self.rx.popleft()
+
+  def g(self):
+    b = self.getc()
+    if b is None:
+      raise TimeoutError()
+    return b
+
+  def putc(self, data):
+    if self.Fault("drop"):
+      return
+    self.line.Write(self, data)
+
+  def anshead(self):
+    return bytearray([0x1C, 0xDA, self.diag_sa, self.mem[ECUID]])
+
+  def anserr(self, code):
+    self.putc(self.anshead() + bytearray([0x01, code]))
+
+  # -------------------------------------------------------------------------------------
+  def Run(self):
+    while self.running:
+      b = self.getc(0.1)
+      if b == ord('t') and self.mem[BLCR] & BLCR_ET:
+        self.Terminal()
+        continue
+      if b != 0x1C:
+        continue
+      try:
+        self.SerialTask()
+      except TimeoutError:
+        self.stats["timeout"] += 1
+        self.anserr(0x0E)
+
+  def SerialTask(self):
+    if self.g() != 0xDA:
+      return
+    target = self.g()
+    if target == 0xFF:
+      return self.Broadcast()
+    if target != self.mem[ECUID]:
+      return
+    self.diag_sa = self.g()
+    dlc = self.g()
+    self.stats["frame"] += 1
+    if dlc == 0: # Tester present
+      self.putc(self.anshead() + bytearray([0x00]))
+    elif dlc == 1:
+      code = self.g()
+      if code == 0x52:
+        self.stats["run"] += 1
+      elif code == 0x11:
+        self.Reset()
+      else:
+        self.anserr(0x08)
+    elif dlc == 2: # Erase
+      address = (self.g() << 8) | self.g()
+      self.anserr(self.Nvm(address, b""))
+    elif dlc == 3: # Read
+      hi = self.g(); lo = self.g(); length = self.g()
+      code = self.ReadCode(length)
+      if code:
+        return self.anserr(code)
+      address = (hi << 8) | lo
+      data = bytes(self.mem[(address+i) & 0xFFFF] for i in range(length))
+      cs = (hi + lo + length + sum(data)) & 0xFF
+      self.putc(self.anshead() + data + bytearray([cs]))
+    elif dlc == 4: # Write
+      hi = self.g(); lo = self.g(); length = self.g()
+      code = self.WriteCode(length)
+      if code:
+        return self.anserr(code)
+      timeout = self.g()
+      data = bytearray(self.g() for i in range(length))
+      cs = self.g()
+      if cs != (hi + lo + length + timeout + sum(data)) & 0xFF or self.Fault("nack"):
+        return self.anserr(0x0C)
+      self.anserr(self.Nvm((hi << 8) | lo, data))
+    elif dlc == 6:
+      self.anserr(self.Fingerprint(bytes(self.g() for i in range(6))))
+    else:
+      self.anserr(0x07)
+
+  def Broadcast(self):
+    self.diag_sa = self.g()
+    dlc = self.g()
+    if dlc == 7:
+      for i in range(6):
+        if self.g() != self.mem[SERIAL_NUMBER+i]:
+          return
+      self.anserr(self.SetId(self.g()))
+    elif dlc == 1:
+      if self.g() != 0x22:
+        return self.anserr(0x08)
+      self.putc(self.anshead() + bytearray([0x07]) + self.mem[SERIAL_NUMBER:SERIAL_NUMBER+6] + bytearray([self.mem[ECUID]]))
+    else:
+      self.anserr(0x07)
+
+  # -------------------------------------------------------------------------------------
+  # Terminal (term.asm), entered by 't' out of frame. Keys are echoed, Flash is written
+  # without fingerprint. Dump and MCU ID are not simulated.
+  def Terminal(self):
+    self.stats["terminal"] += 1
+    self.putc(b"\nSerial terminal. Here is some help:\n")
+    while self.running:
+      key = self.Key()
+      if key in (None, ord('x'), ord('r')): # Illegal opcode reset, also on timeout
+        self.Reset()
+        return
+      if key == ord('?'):
+        self.putc(b"\nSerial terminal. Here is some help:\n")
+      elif key == ord('e'):
+        self.TermResponse(self.Nvm(self.TermAddress(), b"", False))
+      elif key in (ord('h'), ord('s')):
+        address = self.TermAddress()
+        data = bytearray()
+        while len(data) < 0x7F:
+          c = self.Key()
+          if c in (None, 0x0D):
+            break
+          if key == ord('h'):
+            c = (self.HexValue(c) << 4) | self.HexValue(self.Key())
+          data.append(c)
+        if 0 < len(data):
+          self.TermResponse(self.Nvm(address, data, False))
+
+  def Key(self):
+    c = self.getc(key_timeout)
+    if c == 0x0A: # Linux ENTER
+      c = 0x0D
+    if c is not None and c != 0x0D:
+      self.putc(bytes([c]))
+    return c
+
+  def HexValue(self, c):
+    # convtoval: not hexa character is 0
+    try:
+      return int(chr(c), 16)
+    except (TypeError, ValueError):
+      return 0
+
+  def TermAddress(self):
+    address = 0
+    for i in range(4):
+      address = (address << 4) | self.HexValue(self.Key())
+    return address
+
+  def TermResponse(self, code):
+    self.stats["terminal_nvm"] += 1
+    self.putc(b"\nOK" if code == 0 else b"\nError!")
+
+class SciLine:
+  # Pty of downloader, shared by ECUs like RS485. Byte time is byte_us, or 10 bits at
+  # ECU baud rate if negative. Baud rate of downloader side is compared with ECU baud rate.
+
+  def __init__(self, fd, byte_us=0.0):
+    self.fd = fd
+    self.byte_s = byte_us / 1e6
+    self.txlock = threading.Lock()
+    self.ecus = []
+
+  def HostBaud(self):
+    try:
+      t2 = fcntl.ioctl(self.fd, 0x802C542A, bytes(44)) # TCGETS2, ospeed at offset 40
+      return struct.unpack_from("<I", t2, 40)[0]
+    except (OSError, NameError):
+      return 0
+
+  def ByteTime(self, ecu):
+    if self.byte_s < 0:
+      return 10.0 / ecu.baud
+    return self.byte_s
+
+  def Write(self, ecu, data):
+    hostbaud = self.HostBaud()
+    if hostbaud and abs(hostbaud - ecu.baud) > 0.05 * ecu.baud:
+      data = bytes(ecu.rnd.randrange(256) for b in data)
+    with self.txlock:
+      time.sleep(self.ByteTime(ecu) * len(data))
+      os.write(self.fd, bytes(data))
+
+  def Run(self):
+    for ecu in self.ecus:
+      threading.Thread(target=ecu.Run, daemon=True).start()
+    while self.ecus[0].running:
+      r, w, x = select.select([self.fd], [], [], 0.1)
+      if 0 == len(r):
+        continue
+      try:
+        data = os.read(self.fd, 4096)
+      except OSError:
+        break
+      hostbaud = self.HostBaud() # Baud rate when bytes were sent
+      time.sleep(self.ByteTime(self.ecus[0]) * len(data)) # Bytes arrive at line rate
+      for ecu in self.ecus:
+        ecu.Receive(data, hostbaud)
+
+# ---------------------------------------------------------------------------------------
+class CanEcu(Ecu):
+  # ECU on CAN (can.asm). DLC is the service, data of write and read are in 8 byte frames.
+
+  def __init__(self, bus, **kw):
+    Ecu.__init__(self, **kw)
+    self.bus = bus
+    self.frames = collections.deque()
+    self.cv = threading.Condition()
+
+  def Receive(self, ident, data):
+    if self.Fault("corrupt") and 0 < len(data):
+      data = bytes([data[0] ^ 0x01]) + data[1:]
+    with self.cv:
+      self.frames.append((ident, data))
+      self.cv.notify()
+
+  def Next(self, timeout):
+    deadline = time.monotonic() + timeout
+    with self.cv:
+      while 0 == len(self.frames):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self.running:
+          return None
+        self.cv.wait(min(remaining, 0.1))
+      return self.frames.popleft()
+
+  def Send(self, data):
+    if self.Fault("drop"):
+      return
+    self.bus.Write(HEADER | (self.diag_sa << 8) | self.mem[ECUID], data)
+
+  def Pack(self, cs, data, checksum):
+    # 8 byte frames of data and checksum, checksum is XORed by frame number after each frame
+    payload = bytearray(data)
+    frames = []
+    number = 0
+    i = 0
+    while i <= len(payload):
+      frame = bytearray()
+      while len(frame) < 8:
+        if i < len(payload):
+          cs = (cs + payload[i]) & 0xFF
+          frame.append(payload[i])
+        elif i == len(payload):
+          frame.append(cs if checksum is None else checksum)
+        else:
+          frame.append(FILLER)
+        i += 1
+      number += 1
+      cs ^= number
+      frames.append(frame)
+    return frames
+
+  def Run(self):
+    while self.running:
+      frame = self.Next(0.1)
+      if frame is None:
+        continue
+      ident, data = frame
+      self.diag_sa = ident & 0xFF
+      if (ident >> 8) & 0xFF == 0xFF:
+        self.Broadcast(data)
+      else:
+        self.stats["frame"] += 1
+        self.Request(data)
+
+  def Request(self, data):
+    dlc = len(data)
+    if dlc == 0: # Tester present
+      self.Send(b"")
+    elif dlc == 1:
+      if data[0] == 0x52:
+        self.stats["run"] += 1
+      elif data[0] == 0x11:
+        self.Reset()
+      else:
+        self.Send([0x08])
+    elif dlc == 2: # Erase
+      self.Send([self.Nvm((data[0] << 8) | data[1], b"")])
+    elif dlc == 3: # Read
+      code = self.ReadCode(data[2]) or self.WriteCode(data[2])
+      if code:
+        return self.Send([code])
+      address = (data[0] << 8) | data[1]
+      content = bytes(self.mem[(address+i) & 0xFFFF] for i in range(data[2]))
+      for frame in self.Pack(data[0] + data[1] + data[2], content, None):
+        self.Send(frame)
+    elif dlc == 4: # Write
+      self.Write(data)
+    elif dlc == 6:
+      self.Send([self.Fingerprint(data)])
+    else:
+      self.Send([0x07])
+
+  def Write(self, header):
+    code = self.WriteCode(header[2])
+    if code:
+      return self.Send([code])
+    length = header[2]
+    received = bytearray()
+    count = (length + 1 + 7) // 8
+    while len(received) < count * 8:
+      frame = self.Next(byte_timeout)
+      if frame is None:
+        self.stats["timeout"] += 1
+        return self.Send([0x0E])
+      if 8 != len(frame[1]):
+        return self.Send([0x02]) # Not data frame, protocol violation
+      received += frame[1]
+    data = received[:length]
+    expected = self.Pack(header[0] + header[1] + header[2], data, None)
+    if b"".join(expected) != bytes(received[:len(expected)*8]):
+      if received[length] != b"".join(expected)[length]:
+        return self.Send([0x0C])
+      return self.Send([0x0D]) # Filler byte is not 0xFB
+    if self.Fault("nack"):
+      return self.Send([0x0C])
+    self.Send([self.Nvm((header[0] << 8) | header[1], data)])
+
+  def Broadcast(self, data):
+    if len(data) == 7:
+      if data[:6] == self.mem[SERIAL_NUMBER:SERIAL_NUMBER+6]:
+        code = self.SetId(data[6])
+        self.Send([code]) # From new ID
+    elif len(data) == 1:
+      if data[0] != 0x22:
+        return self.Send([0x08])
+      self.Send(self.mem[SERIAL_NUMBER:SERIAL_NUMBER+6] + bytearray([self.mem[ECUID]]))
+    else:
+      self.Send([0x07])
+
+class CanBus:
+  # SocketCAN interface (e.g. vcan0) or any socket of struct can_frame records. Frame time
+  # is frame_us, or frame length at bitrate if negative.
+
+  def __init__(self, sock, frame_us=0.0, bitrate=500000):
+    self.sock = sock
+    self.frame_s = frame_us / 1e6
+    self.bitrate = bitrate
+    self.txlock = threading.Lock()
+    self.ecus = []
+
+  def FrameTime(self, dlc):
+    if self.frame_s < 0:
+      return (67 + 8 * dlc) / float(self.bitrate) # Extended frame without stuff bits
+    return self.frame_s
+
+  def Write(self, ident, data):
+    with self.txlock:
+      time.sleep(self.FrameTime(len(data)))
+      self.sock.send(CAN_FRAME.pack(ident | CAN_EFF_FLAG, len(data), bytes(data)))
+
+  def Run(self):
+    for ecu in self.ecus:
+      threading.Thread(target=ecu.Run, daemon=True).start()
+    while self.ecus[0].running:
+      r, w, x = select.select([self.sock], [], [], 0.1)
+      if 0 == len(r):
+        continue
+      try:
+        frame = self.sock.recv(CAN_FRAME.size)
+      except OSError:
+        break
+      if len(frame) < CAN_FRAME.size:
+        break
+      ident, dlc, data = CAN_FRAME.unpack(frame)
+      if not ident & CAN_EFF_FLAG or (ident & 0x1FFF0000) != HEADER:
+        continue
+      time.sleep(self.FrameTime(dlc))
+      target = (ident >> 8) & 0xFF
+      for ecu in self.ecus:
+        if target == 0xFF or target == ecu.mem[ECUID]:
+          ecu.Receive(ident & 0x1FFFFFFF, data[:dlc])
+
+# ---------------------------------------------------------------------------------------
+def Stop(line):
+  for ecu in line.ecus:
+    ecu.running = False
+
+def PrintHelp():
+  p = sys.stdout.write
+  p("dzsim.py - Bootloader protocol simulator of MC9S08DZ60\n")
+  p("Name of serial port (pty) is printed in first line, use it as -p of dzdl.py\n")
+  p("Options:\n")
+  p("  -p can:if    Simulate ECUs on SocketCAN interface (e.g. can:vcan0) instead of a new pty\n")
+  p("  -l us        Time of a byte on SCI or a frame on CAN (default 0). auto is the time at\n")
+  p("               ECU baud rate (10 bits, baud = 1000000 / EEPROM 0x17E0) or at --bitrate\n")
+  p("  --bitrate=n  CAN bit rate of auto frame time (default 500000)\n")
+  p("  -e ms        Erase time of a sector (default 20)\n")
+  p("  -w us        Write time of a byte (default 40)\n")
+  p("  -r n         Bytes received by SCI while Flash is written, others are lost (default 1)\n")
+  p("  -b file      Bootloader image in memory of ECUs (default prg.s19 next to dzsim.py)\n")
+  p("  -m file      64k memory image of (first) ECU, loaded at start and saved at exit\n")
+  p("  -n n         Number of ECUs on bus, all with ECU ID 0x0E and different serial number\n")
+  p("  --ids=a,b,.. ECU ID of every ECU on bus (0xFF is not assigned)\n")
+  p("  --nack=rate  Rate of write frames answered by checksum error (e.g. 0.01)\n")
+  p("  --corrupt=rate  Rate of received bytes (CAN frames) with wrong bit\n")
+  p("  --corrupt-above=baud  Corrupt bytes only above this ECU baud rate (turbo)\n")
+  p("  --drop=rate  Rate of lost answers\n")
+  p("Byte t out of frame enters terminal of SCI ECU when enabled by BLCR (0xFFAC, enabled if erased)\n")
+  p("Statistics of every ECU are printed at exit (SIGTERM or Ctrl+C)\n")
+
+def Main(argv):
+  try:
+    opts, args = getopt.getopt(argv, "p:l:e:w:r:b:m:n:h", ["port=", "bootloader=", "latency=", "bitrate=", "erase=", "write=", "rxbuf=", "memory=", "ids=", "nack=", "corrupt=", "corrupt-above=", "drop=", "help"])
+  except getopt.GetoptError as e:
+    sys.stderr.write("ERROR! "+str(e)+"\n")
+    return 1
+  port = ""
+  latency = 0.0
+  bitrate = 500000
+  rxbuf = 1
+  kw = {}
+  faults = {}
+  memfile = None
+  ids = [0x0E]
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      PrintHelp()
+      return 0
+    elif opt in ("-p", "--port"): port = arg
+    elif opt in ("-l", "--latency"): latency = -1.0 if arg == "auto" else float(arg)
+    elif opt == "--bitrate": bitrate = int(arg, 0)
+    elif opt in ("-e", "--erase"): kw["erase_ms"] = float(arg)
+    elif opt in ("-w", "--write"): kw["write_us"] = float(arg)
+    elif opt in ("-r", "--rxbuf"): rxbuf = int(arg)
+    elif opt in ("-b", "--bootloader"): kw["image"] = arg
+    elif opt in ("-m", "--memory"): memfile = arg
+    elif opt == "-n": ids = [0x0E] * int(arg)
+    elif opt == "--ids": ids = [int(i, 0) for i in arg.split(",")]
+    elif opt in ("--nack", "--corrupt", "--drop"): faults[opt[2:]] = float(arg)
+    elif opt == "--corrupt-above": faults["corrupt_above"] = float(arg)
+
+  try:
+    kw["image"] = dzimage.ReadImage(kw.get("image", bootloader))[0]
+  except (OSError, dzimage.ImageError) as e:
+    sys.stderr.write("ERROR! "+str(e)+"\n")
+    return 1
+
+  if port.startswith("can:"):
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    sock.bind((port[4:],))
+    line = CanBus(sock, latency, bitrate)
+    line.ecus = [CanEcu(line, ecuid=ecuid, serialnum=bytes([0x23, 0x10, 0x24, 0x20, 0x20, 0x25+i]), faults=faults, seed=i, **kw) for i, ecuid in enumerate(ids)]
+    print(port, flush=True)
+  else:
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    line = SciLine(master, latency)
+    line.ecus = [SciEcu(line, rxbuf, ecuid=ecuid, serialnum=bytes([0x23, 0x10, 0x24, 0x20, 0x20, 0x25+i]), faults=faults, seed=i, **kw) for i, ecuid in enumerate(ids)]
+    print(os.ttyname(slave), flush=True)
+
+  ecu = line.ecus[0]
+  if memfile and os.path.exists(memfile):
+    with open(memfile, "rb") as f:
+      ecu.mem[:] = f.read()
+    if hasattr(ecu, "Init"):
+      ecu.Init()
+  signal.signal(signal.SIGTERM, lambda signum, frame: Stop(line))
+  try:
+    line.Run()
+  except KeyboardInterrupt:
+    Stop(line)
+  if memfile:
+    with open(memfile, "wb") as f:
+      f.write(ecu.mem)
+  for ecu in line.ecus:
+    sys.stderr.write(hex(ecu.mem[ECUID])+" "+str(dict(ecu.stats))+"\n")
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
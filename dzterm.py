@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Serial terminal of dzdl.py with text and hex dump view"""
+
+# Import statements
+import sys, shutil, threading, time
+import serial
+if sys.platform.startswith("win"): # Windows
+  import msvcrt
+else:
+  import curses # https://docs.python.org/3/library/curses.html#module-curses
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+# Received bytes are rendered and keyboard is polled in this period (s)
+refresh_period = 0.03
+
+# Bytes in a line of hex dump
+hex_width = 16
+
+# Translation of received bytes to text view and to ASCII column of hex view,
+# not printable characters are shown as '.'
+text_table = bytes(c if (0x20 <= c < 0x7F or c in b"\n\r\t\b") else 0x2E for c in range(256))
+ascii_table = bytes(c if 0x20 <= c < 0x7F else 0x2E for c in range(256))
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+def HexLine(offset, data):
+  # One line of hex dump: offset, hex values and ASCII
+  hexa = data.hex(" ").upper()
+  return format(offset,"06X") + "  " + hexa.ljust(hex_width*3-1) + "  |" + data.translate(ascii_table).decode("ascii") + "|"
+
+# ---------------------------------------------------------------------------------------
+class Terminal:
+  # Received bytes are read in bulk by a reader thread and collected till next refresh,
+  # so neither reading nor rendering is done byte by byte.
+
+  def __init__(self, ser, log, hexview=False):
+    self.ser = ser
+    self.log = log # dzlog.LogWriter
+    self.hexview = hexview
+    self.rx = bytearray()
+    self.lock = threading.Lock()
+    self.refresh = 0 # Time (time.perf_counter()) of next refresh
+    self.running = True
+    self.error = None
+    self.offset = 0 # Number of bytes shown in hex view
+    self.line = bytearray() # Not yet complete line of hex view
+
+  def Reader(self):
+    self.ser.timeout = refresh_period
+    while self.running:
+      try:
+        data = self.ser.read(max(1, self.ser.in_waiting))
+      except (serial.SerialException, OSError, TypeError):
+        self.error = "Port " + self.ser.port + " broken"
+        break
+      if 0 < len(data):
+        self.log.Raw(data)
+        with self.lock:
+          self.rx += data
+
+  def Take(self):
+    # All received bytes since last call
+    with self.lock:
+      data = bytes(self.rx)
+      del self.rx[:]
+    return data
+
+  def WaitRefresh(self):
+    # Received bytes are collected till next refresh, keyboard is polled at the same rate
+    delay = self.refresh - time.perf_counter()
+    if 0 < delay:
+      time.sleep(delay)
+    self.refresh = time.perf_counter() + refresh_period
+
+  def Send(self, data):
+    self.ser.write(data)
+    self.log.Raw(data)
+
+  # -------------------------------------------------------------------------------------
+  def TextLines(self, data, rows):
+    # Text of received bytes. Lines which would scroll out of screen immediately are dropped.
+    text = data.translate(text_table).decode("ascii")
+    if rows < text.count("\n"):
+      text = "\n" + "\n".join(text.split("\n")[-rows:])
+    return text
+
+  def HexLines(self, data, rows):
+    # Complete lines of hex view of received bytes and not complete last line
+    self.line += data
+    n = (len(self.line) // hex_width) * hex_width
+    complete = self.line[:n]
+    del self.line[:n]
+    lines = []
+    first = max(0, len(complete) // hex_width - rows) # Lines which would scroll out at once
+    for i in range(first * hex_width, len(complete), hex_width):
+      lines.append(HexLine(self.offset + i, bytes(complete[i:i+hex_width])))
+    self.offset += len(complete)
+    return lines
+
+  # -------------------------------------------------------------------------------------
+  def Run(self):
+    # Returns error text if port is broken, None if terminal is closed by ESC button
+    reader = threading.Thread(target=self.Reader, daemon=True)
+    reader.start()
+    try:
+      if sys.platform.startswith("win"): # Windows
+        self.RunConsole()
+      else:
+        curses.wrapper(self.RunCurses)
+    finally:
+      self.running = False
+      reader.join()
+    return self.error
+
+  def RunConsole(self):
+    rows = shutil.get_terminal_size().lines
+    while self.error is None:
+      # From keyboard to UART
+      keys = bytearray()
+      while msvcrt.kbhit():
+        c = ord(msvcrt.getch())
+        if c == 0x1B: # ESC button
+          return
+        keys.append(c)
+      if 0 < len(keys):
+        self.Send(keys)
+      # From UART to display, at most once in refresh_period
+      self.WaitRefresh()
+      data = self.Take()
+      if 0 < len(data):
+        if self.hexview:
+          lines = self.HexLines(data, rows)
+          sys.stdout.write("".join(line + "\n" for line in lines))
+        else:
+          sys.stdout.write(self.TextLines(data, rows))
+        sys.stdout.flush()
+
+  def RunCurses(self, stdscr):
+    curses.noecho() # switch off echo
+    stdscr.nodelay(True) # set getch() non-blocking
+    stdscr.scrollok(True)
+    stdscr.idlok(True)
+    while self.error is None:
+      # From keyboard to UART
+      keys = bytearray()
+      c = stdscr.getch()
+      while c != -1:
+        if c == 0x1B: # ESC button
+          return
+        if c < 0x100:
+          keys.append(c)
+        c = stdscr.getch()
+      if 0 < len(keys):
+        self.Send(keys)
+
+      # From UART to display, at most once in refresh_period
+      self.WaitRefresh()
+      data = self.Take()
+      if 0 == len(data):
+        continue
+      rows, cols = stdscr.getmaxyx()
+      try:
+        if self.hexview:
+          y, x = stdscr.getyx()
+          stdscr.move(y, 0) # Not complete line is drawn again
+          stdscr.clrtoeol()
+          for line in self.HexLines(data, rows):
+            stdscr.addstr(line[:cols-1] + "\n")
+          if 0 < len(self.line):
+            stdscr.addstr(HexLine(self.offset, bytes(self.line))[:cols-1])
+        else:
+          stdscr.addstr(self.TextLines(data, rows))
+      except curses.error:
+        pass # Text at bottom right corner
+      stdscr.refresh()
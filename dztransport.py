@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+# Docstring
+"""Bootloader frames on SCI (serial port) and CAN (SocketCAN) for dzdl.py"""
+
+# Import statements
+import time, struct, socket, select, errno, collections
+import serial
+
+# Authorship information
+__author__ = "Janos BENCSIK"
+__copyright__ = "Copyright 2023, butyi.hu"
+__license__ = "GPL"
+
+# Code
+
+# ---------------------------------------------------------------------------------------
+# Global variables
+# ---------------------------------------------------------------------------------------
+
+# Port name prefix of SocketCAN interfaces, e.g. can:can0 or can:vcan0
+CAN_PREFIX = "can:"
+
+# Message header is CAN ID 0x1CDATTSS, TT is target, SS is source
+HEADER = 0x1CDA0000
+
+# struct can_frame of Linux: CAN ID, DLC, padding, 8 data bytes
+CAN_FRAME = struct.Struct("=IB3x8s")
+
+# Not used bytes of CAN data frames
+FILLER = 0xFB
+
+# Longest write and read data length of bootloader on CAN (length byte with highest bit is refused)
+CAN_MAX_FRAME = 127
+
+# Received CAN frames kept for later answers (e.g. of other ECUs on bus)
+can_queue = 1024
+
+# Read timeout of serial port (s). It is set only at open, pyserial reconfigures the port
+# at every change of it.
+read_timeout = 0.01
+
+# ---------------------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------------------
+
+def IsCan(port):
+  return port.startswith(CAN_PREFIX)
+
+def Protocol(port):
+  # Protocol of write request bodies of port, see WRITE_BODY
+  return "can" if IsCan(port) else "sci"
+
+def NewTransport(port, baud, log):
+  # Transport of port name: SocketCAN interface with prefix can:, serial port otherwise
+  if IsCan(port):
+    return CanTransport(port[len(CAN_PREFIX):], log)
+  return SerialTransport(port, baud, log)
+
+# ---------------------------------------------------------------------------------------
+# Body of write request is everything after the IDs of target and source. It does not
+# depend on IDs, so download plan can be serialized once for any number of targets.
+
+def SciBody(address, data, valid=True):
+  # DLC 4, address, length, timeout (not yet supported), data and checksum
+  addr_hi = (address >> 8) & 0xFF
+  addr_lo = address & 0xFF
+  cs = (addr_hi + addr_lo + len(data) + sum(data)) & 0xFF
+  if not valid:
+    cs ^= 0xFF # Wrong checksum
+    if cs in (0x1C, 0x74): # Must not look like frame start or terminal request in case length is refused
+      cs ^= 0x01
+  return bytes([0x04, addr_hi, addr_lo, len(data), 0x00]) + bytes(data) + bytes([cs])
+
+def CanBody(address, data, valid=True):
+  # Data of header frame (address, length, timeout) and of 8 byte data frames
+  addr_hi = (address >> 8) & 0xFF
+  addr_lo = address & 0xFF
+  body = bytearray([addr_hi, addr_lo, len(data), 0x00])
+  cs = (addr_hi + addr_lo + len(data)) & 0xFF
+  number = 0
+  i = 0
+  while i <= len(data): # Last frame contains checksum
+    for k in range(8):
+      if i < len(data):
+        cs = (cs + data[i]) & 0xFF
+        body.append(data[i])
+      elif i == len(data):
+        body.append(cs if valid else cs ^ 0xFF)
+      else:
+        body.append(FILLER)
+      i += 1
+    number += 1
+    cs ^= number
+  return bytes(body)
+
+WRITE_BODY = {"sci":SciBody, "can":CanBody}
+
+# ---------------------------------------------------------------------------------------
+# Every transport has the same methods, session does not know the link below:
+#   Open(), Close()
+#   Send(tag, target, source, data)       Request with DLC = len(data), True if sent
+#   SendWrite(tag, target, source, address, data, valid=True)
+#                                         Write request with data, wrong checksum if not valid
+#   SendBody(tag, target, source, body)   Write request of body built by Body(address, data, valid)
+#   Poll(timeout)                         Wait at most timeout (s) for received bytes or frames
+#   Take(target, source)                  (source, data) of first received answer, or None.
+#                                         Source None means answer of any source.
+#   TakeRead(target, source, address, length, final)
+#                                         (0, data) of read answer, (code, None) of negative
+#                                         answer, (None, None) if there is no answer at final,
+#                                         None if answer is not yet complete
+#   Break(), Flush(), Drain(), SetBaud(baud), Speed()
+#   WireTime(length)                      Time (s) of length bytes on wire, None if unknown
+# and counters tx_bytes, rx_bytes of bytes sent and received.
+
+class SerialTransport:
+  # SCI frame is header 1C DA TT SS, DLC and data. Write request is followed by data and
+  # checksum, read answer is header, data and checksum without DLC.
+  kind = "serial port"
+  proto = "sci"
+  Body = staticmethod(SciBody)
+  changeable_baud = True # Baud rate can be changed for turbo download
+  max_frame = 0 # Longest write frame is probed
+  max_read = 0xFF # Longest read request
+
+  def __init__(self, port, baud, log):
+    self.port = port
+    self.baud = baud
+    self.log = log # dzlog.LogWriter
+    self.ser = None
+    self.rx = bytearray()
+    self.tag = "   " # Received bytes are logged with tag of last request
+    self.tx_bytes = 0
+    self.rx_bytes = 0
+
+  def Open(self):
+    self.ser = serial.Serial(self.port, self.baud, timeout=read_timeout)
+
+  def Close(self):
+    if self.ser is not None:
+      self.ser.close()
+      self.ser = None
+
+  def Speed(self):
+    return str(self.ser.baudrate)+" baud"
+
+  def SetBaud(self, baud):
+    self.ser.baudrate = baud
+
+  def WireTime(self, length):
+    return length * 10.0 / self.ser.baudrate # Start bit, 8 data bits, stop bit
+
+  def Write(self, tag, buff):
+    self.tag = tag
+    self.log.Tx(tag, buff)
+    self.tx_bytes += len(buff)
+    return len(buff) <= self.ser.write(buff)
+
+  def Send(self, tag, target, source, data):
+    return self.Write(tag, bytes([0x1C, 0xDA, target, source, len(data)]) + bytes(data))
+
+  def SendWrite(self, tag, target, source, address, data, valid=True):
+    return self.SendBody(tag, target, source, SciBody(address, data, valid))
+
+  def SendBody(self, tag, target, source, body):
+    return self.Write(tag, bytes([0x1C, 0xDA, target, source]) + body)
+
+  def Poll(self, timeout):
+    # Waiting is select on the port, or blocking reads of read_timeout where port has no
+    # file descriptor (Windows), so it does not load CPU
+    deadline = time.perf_counter() + timeout
+    data = b""
+    while 0 == len(data):
+      if 0 < self.ser.in_waiting:
+        data = self.ser.read(self.ser.in_waiting)
+        break
+      remaining = deadline - time.perf_counter()
+      if remaining <= 0:
+        break
+      if hasattr(self.ser, "fileno"):
+        select.select([self.ser.fileno()], [], [], remaining)
+      else:
+        data = self.ser.read(1)
+    if 0 < len(data) and 0 < self.ser.in_waiting:
+      data += self.ser.read(self.ser.in_waiting)
+    if 0 < len(data):
+      self.log.Rx(self.tag, data)
+      self.rx += data
+      self.rx_bytes += len(data)
+
+  def Take(self, target, source):
+    # Bytes before the answer are dropped, they are garbage or answers of nobody waits for
+    start = bytes([0x1C, 0xDA, target])
+    while True:
+      i = self.rx.find(start)
+      if i == -1:
+        del self.rx[:max(0, len(self.rx)-2)] # Keep beginning of header
+        return None
+      del self.rx[:i]
+      if len(self.rx) < 5:
+        return None
+      dlc = self.rx[4]
+      if 8 < dlc or (source is not None and self.rx[3] != source):
+        del self.rx[:1] # Not an answer or not from source
+        continue
+      if len(self.rx) < 5+dlc:
+        return None
+      answer = (self.rx[3], bytes(self.rx[5:5+dlc]))
+      del self.rx[:5+dlc]
+      return answer
+
+  def TakeRead(self, target, source, address, length, final):
+    start = bytes([0x1C, 0xDA, target, source])
+    i = self.rx.find(start)
+    if i != -1 and i+4+length+1 <= len(self.rx):
+      answer = self.rx[i:i+4+length+1]
+      del self.rx[:i+4+length+1]
+      data = bytes(answer[4:4+length])
+      cs = (((address>>8)&0xFF) + (address&0xFF) + length + sum(data)) & 0xFF
+      if cs != answer[-1]:
+        return (0x0C, None) # Checksum error
+      return (0, data)
+    if not final:
+      return None
+    # Negative answer is header, 0x01 and error code. It is only known by the time.
+    if i != -1 and i+6 == len(self.rx) and self.rx[i+4] == 0x01:
+      code = self.rx[i+5]
+      del self.rx[:]
+      return (code, None)
+    del self.rx[:]
+    return (None, None)
+
+  def Break(self):
+    self.ser.send_break() # Send brake to reset application software for auto connect without need of manual reset
+
+  def Flush(self):
+    self.ser.reset_input_buffer()
+    del self.rx[:]
+
+  def Drain(self):
+    self.ser.flush()
+    time.sleep(0.05) # USB serial adapters may still send from own buffer, keep baud rate till that
+
+# ---------------------------------------------------------------------------------------
+class CanTransport:
+  # CAN frame has extended ID 0x1CDATTSS and DLC, data is at most 8 bytes. Data of write
+  # request and read answer are sent in 8 byte frames, followed by checksum and filler bytes.
+  # Checksum is simple addition of address, length and data, and it is XORed by number of
+  # frame after every frame to detect frame order change.
+  kind = "CAN interface"
+  proto = "can"
+  Body = staticmethod(CanBody)
+  changeable_baud = False # Bit rate is set by 'ip link set can0 type can bitrate 500000'
+  max_frame = CAN_MAX_FRAME
+  max_read = CAN_MAX_FRAME
+
+  def __init__(self, interface, log):
+    self.interface = interface
+    self.log = log # dzlog.LogWriter
+    self.sock = None
+    self.rx = collections.deque(maxlen=can_queue) # (CAN ID, data)
+    self.tag = "   "
+    self.tx_bytes = 0 # ID, DLC and data
+    self.rx_bytes = 0
+
+  def Open(self):
+    self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    try:
+      # Receive only bootloader frames (0x1CDAxxxx)
+      self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+        struct.pack("=II", HEADER | socket.CAN_EFF_FLAG, 0x1FFF0000 | socket.CAN_EFF_FLAG))
+      self.sock.bind((self.interface,))
+    except OSError:
+      self.Close()
+      raise
+    self.sock.setblocking(False)
+
+  def Close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+  def Speed(self):
+    return self.interface
+
+  def SetBaud(self, baud):
+    pass
+
+  def WireTime(self, length):
+    return None # Bit rate of interface is not known here
+
+  def Frame(self, tag, ident, data):
+    self.tag = tag
+    self.log.Tx(tag, ident.to_bytes(4, "big") + bytes([len(data)]) + bytes(data))
+    self.tx_bytes += 5 + len(data)
+    frame = CAN_FRAME.pack(ident | socket.CAN_EFF_FLAG, len(data), bytes(data))
+    while True:
+      try:
+        return len(frame) <= self.sock.send(frame)
+      except BlockingIOError:
+        select.select([], [self.sock], [], 0.01)
+      except OSError as e:
+        if e.errno != errno.ENOBUFS:
+          raise
+        time.sleep(0.001) # Transmit queue of interface is full
+
+  def Send(self, tag, target, source, data):
+    return self.Frame(tag, HEADER | (target << 8) | source, data)
+
+  def SendWrite(self, tag, target, source, address, data, valid=True):
+    return self.SendBody(tag, target, source, CanBody(address, data, valid))
+
+  def SendBody(self, tag, target, source, body):
+    # Header frame of 4 bytes, then 8 byte data frames
+    ident = HEADER | (target << 8) | source
+    ok = self.Frame(tag, ident, body[:4])
+    for i in range(4, len(body), 8):
+      ok = self.Frame(tag, ident, body[i:i+8]) and ok
+    return ok
+
+  def Poll(self, timeout):
+    readable, w, x = select.select([self.sock], [], [], timeout)
+    if 0 == len(readable):
+      return
+    while True:
+      try:
+        frame = self.sock.recv(CAN_FRAME.size)
+      except BlockingIOError:
+        break
+      ident, dlc, data = CAN_FRAME.unpack(frame)
+      if not ident & socket.CAN_EFF_FLAG:
+        continue
+      ident &= socket.CAN_EFF_MASK
+      data = data[:dlc]
+      self.log.Rx(self.tag, ident.to_bytes(4, "big") + bytes([dlc]) + data)
+      self.rx_bytes += 5 + dlc
+      self.rx.append((ident, data))
+
+  def Match(self, target, source):
+    # Received frames of target (and source if not None), other frames are kept
+    return [i for i, (ident, data) in enumerate(self.rx)
+      if (ident >> 8) == ((HEADER >> 8) | target) and (source is None or (ident & 0xFF) == source)]
+
+  def Take(self, target, source):
+    found = self.Match(target, source)
+    if 0 == len(found):
+      return None
+    ident, data = self.rx[found[0]]
+    del self.rx[found[0]]
+    return (ident & 0xFF, data)
+
+  def TakeRead(self, target, source, address, length, final):
+    found = self.Match(target, source)
+    frames = (length + 1 + 7) // 8 # Data and checksum
+    if 0 < len(found) and 1 == len(self.rx[found[0]][1]):
+      code = self.rx[found[0]][1][0] # Negative answer
+      del self.rx[found[0]]
+      return (code, None)
+    if len(found) < frames:
+      if final:
+        for i in reversed(found):
+          del self.rx[i]
+        return (None, None)
+      return None
+    payload = bytearray()
+    for i in found[:frames]:
+      payload += self.rx[i][1].ljust(8, bytes([FILLER]))
+    for i in reversed(found[:frames]):
+      del self.rx[i]
+    cs = (((address>>8)&0xFF) + (address&0xFF) + length) & 0xFF
+    for i in range(length):
+      cs = (cs + payload[i]) & 0xFF
+      if i % 8 == 7:
+        cs ^= (i // 8) + 1
+    if cs != payload[length]:
+      return (0x0C, None) # Checksum error
+    return (0, bytes(payload[:length]))
+
+  def Break(self):
+    pass # Application on CAN shall reset itself into bootloader
+
+  def Flush(self):
+    self.Poll(0)
+    self.rx.clear()
+
+  def Drain(self):
+    pass